@@ -0,0 +1,232 @@
+import os
+import csv
+import time
+import random
+import asyncio
+from tqdm import tqdm
+
+from compliance_checker import check_feature_async
+from batch_journal import BatchJournal, row_key, versioned_job_name
+from prompt_builder import count_tokens, load_tokenizer
+
+# --- Configuration ---
+# Maximum number of analyses in flight at once.
+DEFAULT_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "8"))
+# Gemini quotas for the analysis model; tune these to the project's tier.
+DEFAULT_REQUESTS_PER_MINUTE = int(os.getenv("GEMINI_REQUESTS_PER_MINUTE", "150"))
+DEFAULT_TOKENS_PER_MINUTE = int(os.getenv("GEMINI_TOKENS_PER_MINUTE", "2000000"))
+# Rough token cost of one analysis beyond the feature text itself: instructions,
+# retrieved context, few-shot examples and the (thinking) response.
+PROMPT_OVERHEAD_TOKENS = int(os.getenv("GEMINI_PROMPT_OVERHEAD_TOKENS", "4000"))
+# Retry policy for rate-limited (HTTP 429) analyses.
+MAX_RATE_LIMIT_RETRIES = 6
+INITIAL_BACKOFF_SECONDS = 2.0
+MAX_BACKOFF_SECONDS = 120.0
+
+
+def estimate_tokens(text: str) -> int:
+    """Estimates the tokens one analysis of `text` will consume: the text itself plus the fixed overhead."""
+    return count_tokens(text) + PROMPT_OVERHEAD_TOKENS
+
+
+class TokenBucket:
+    """An asyncio token bucket refilled continuously at `per_minute` units per minute."""
+
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """Returns how long to wait before `amount` units are available (0 if they are)."""
+        self._refill()
+        amount = min(amount, self.capacity)
+        return 0.0 if self.tokens >= amount else (amount - self.tokens) / self.rate
+
+    def consume(self, amount: float):
+        self.tokens -= min(amount, self.capacity)
+
+
+class RateLimiter:
+    """
+    Paces calls against both a requests-per-minute and a tokens-per-minute budget.
+
+    On a 429, callers report it via `backoff()`, which pauses every caller for an
+    exponentially growing, jittered delay; successes shrink the delay back down.
+    """
+
+    def __init__(self, requests_per_minute: int, tokens_per_minute: int):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self._lock = asyncio.Lock()
+        self._paused_until = 0.0
+        self._backoff = INITIAL_BACKOFF_SECONDS
+
+    async def acquire(self, estimated_tokens: int):
+        async with self._lock:
+            while True:
+                delay = max(
+                    self._paused_until - time.monotonic(),
+                    self.requests.wait_time(1),
+                    self.tokens.wait_time(estimated_tokens),
+                )
+                if delay <= 0:
+                    break
+                await asyncio.sleep(delay)
+            self.requests.consume(1)
+            self.tokens.consume(estimated_tokens)
+
+    def backoff(self) -> float:
+        """Pauses all callers after a rate-limit error and returns the pause length."""
+        delay = self._backoff * (0.5 + random.random())
+        self._paused_until = max(self._paused_until, time.monotonic() + delay)
+        self._backoff = min(self._backoff * 2, MAX_BACKOFF_SECONDS)
+        return delay
+
+    def success(self):
+        self._backoff = max(INITIAL_BACKOFF_SECONDS, self._backoff / 2)
+
+
+class OrderedCSVWriter:
+    """Streams rows to a CSV file in input order, buffering rows that finish early."""
+
+    def __init__(self, path: str, columns: list, start_index: int = 0):
+        self._file = open(path, "w", newline="", encoding="utf-8")
+        self._writer = csv.DictWriter(self._file, fieldnames=columns, extrasaction="ignore")
+        self._writer.writeheader()
+        self._pending = {}
+        self._next = start_index
+
+    def add(self, index: int, row: dict):
+        self._pending[index] = row
+        while self._next in self._pending:
+            self._writer.writerow(self._pending.pop(self._next))
+            self._next += 1
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def is_rate_limited(result: dict) -> bool:
+    """Returns True if an analysis failed because the LLM quota was exhausted."""
+    return result.get("flag") == "Error" and (
+        result.get("error_code") == 429 or "RESOURCE_EXHAUSTED" in str(result.get("reasoning", ""))
+    )
+
+
+async def analyze_with_retries(text: str, limiter: RateLimiter) -> dict:
+    """Runs one analysis under the rate limiter, retrying with backoff when rate-limited."""
+    for attempt in range(MAX_RATE_LIMIT_RETRIES + 1):
+        await limiter.acquire(estimate_tokens(text))
+        try:
+            result = await check_feature_async(text)
+        except Exception as e:
+            return {"flag": "Error", "reasoning": str(e), "related_regulations": [], "citations": []}
+        if not is_rate_limited(result):
+            limiter.success()
+            return result
+        if attempt < MAX_RATE_LIMIT_RETRIES:
+            delay = limiter.backoff()
+            print(f"Rate limited by the LLM API; backing off for {delay:.1f}s (attempt {attempt + 1}).")
+    return result
+
+
+async def run_batch_async(rows: list, build_input, build_output, output_path: str, output_columns: list,
+                          concurrency: int = None, requests_per_minute: int = None,
+                          tokens_per_minute: int = None, desc: str = "Processing Features",
+                          job_name: str = None, max_attempts: int = None, fresh: bool = False) -> list:
+    """
+    Analyzes rows with bounded concurrency under the Gemini rate limits.
+
+    When `job_name` is given, every finished row is checkpointed to the batch
+    journal (see batch_journal). Re-running the same job skips rows that already
+    succeeded and retries failed rows until they have used `max_attempts` attempts.
+    The journal is kept per prompt template version and knowledge-base build, so
+    results from an older prompt or knowledge base are never replayed.
+
+    Args:
+        rows (list): Input rows (dictionaries), e.g. from DataFrame.to_dict("records").
+        build_input: Callable mapping a row to the feature text passed to check_feature.
+        build_output: Callable mapping (row, analysis_result) to an output row dictionary.
+        output_path (str): CSV file that output rows are streamed to, in input order.
+        output_columns (list): Column order of the output CSV.
+        concurrency (int, optional): Maximum analyses in flight. Defaults to BATCH_CONCURRENCY.
+        requests_per_minute (int, optional): Request quota. Defaults to GEMINI_REQUESTS_PER_MINUTE.
+        tokens_per_minute (int, optional): Token quota. Defaults to GEMINI_TOKENS_PER_MINUTE.
+        desc (str): Progress bar label.
+        job_name (str, optional): Enables checkpointing under this name.
+        max_attempts (int, optional): Attempts per row across restarts. Defaults to BATCH_MAX_ATTEMPTS.
+        fresh (bool): Discard the job's checkpoints first and re-run every row.
+
+    Returns:
+        list: The output rows, in input order.
+    """
+    # Load the token counter off the loop before any rows are budgeted with it.
+    await asyncio.get_running_loop().run_in_executor(None, load_tokenizer)
+    limiter = RateLimiter(requests_per_minute or DEFAULT_REQUESTS_PER_MINUTE,
+                          tokens_per_minute or DEFAULT_TOKENS_PER_MINUTE)
+    semaphore = asyncio.Semaphore(concurrency or DEFAULT_CONCURRENCY)
+    journal = BatchJournal(versioned_job_name(job_name), max_attempts=max_attempts) if job_name else None
+    if journal and fresh:
+        journal.clear()
+    writer = OrderedCSVWriter(output_path, output_columns)
+    outputs = [None] * len(rows)
+    keys = [row_key(row) for row in rows] if journal else [None] * len(rows)
+
+    # Rows finished in a previous run are replayed from the journal without any LLM call.
+    pending = []
+    for index, (row, key) in enumerate(zip(rows, keys)):
+        journaled = journal.lookup(key) if journal else None
+        if journaled is not None:
+            outputs[index] = build_output(row, journaled)
+            writer.add(index, outputs[index])
+        else:
+            pending.append(index)
+    resumed = len(rows) - len(pending)
+    if resumed:
+        print(f"Resuming job '{job_name}': {resumed} of {len(rows)} rows already done, {len(pending)} left.")
+
+    # tqdm's rate and ETA only count rows processed in this run, so they stay accurate on resume.
+    progress = tqdm(total=len(rows), initial=resumed, desc=desc)
+    failures = 0
+    started = time.monotonic()
+
+    async def process(index: int):
+        nonlocal failures
+        row = rows[index]
+        async with semaphore:
+            result = await analyze_with_retries(build_input(row), limiter)
+        succeeded = result.get("flag") != "Error"
+        if not succeeded:
+            failures += 1
+        if journal:
+            journal.record(keys[index], index, result, succeeded)
+        outputs[index] = build_output(row, result)
+        writer.add(index, outputs[index])
+        progress.update(1)
+
+    try:
+        await asyncio.gather(*(process(index) for index in pending))
+    finally:
+        progress.close()
+        writer.close()
+        if journal:
+            journal.close()
+
+    elapsed = time.monotonic() - started
+    throughput = len(pending) / elapsed if elapsed > 0 else 0.0
+    print(f"Processed {len(pending)} rows in {elapsed:.1f}s ({throughput:.2f} rows/s); "
+          f"{resumed} resumed from checkpoint, {failures} failed.")
+    return outputs
+
+
+def run_batch(rows: list, build_input, build_output, output_path: str, output_columns: list, **kwargs) -> list:
+    """Synchronous entry point for scripts; see run_batch_async for arguments."""
+    return asyncio.run(run_batch_async(rows, build_input, build_output, output_path, output_columns, **kwargs))
@@ -0,0 +1,115 @@
+import os
+import json
+import hashlib
+import datetime
+
+from database_utils import DATABASE_NAME, get_connection, retry_on_busy
+from response_cache import KB_VERSION_FILE
+from prompt_builder import PROMPT_TEMPLATE_VERSION
+
+# --- Configuration ---
+# Number of times a failed row is attempted in total (across restarts) before the
+# journal stops retrying it and keeps its last error as the final result.
+DEFAULT_MAX_ATTEMPTS = int(os.getenv("BATCH_MAX_ATTEMPTS", "3"))
+
+
+def row_key(row: dict) -> str:
+    """Returns a stable hash identifying an input row by its content."""
+    return hashlib.sha256(json.dumps(row, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def versioned_job_name(job_name: str) -> str:
+    """
+    Qualifies a job name with the prompt template version and the knowledge-base stamp.
+
+    Journaled results are only valid for the prompt and knowledge base they were
+    produced with, so after either changes the same input starts a fresh journal.
+    """
+    try:
+        with open(os.getenv("KB_VERSION_FILE", KB_VERSION_FILE), encoding="utf-8") as f:
+            kb_version = f.read().strip() or "none"
+    except OSError:
+        kb_version = "none"
+    return f"{job_name}@prompt-v{PROMPT_TEMPLATE_VERSION}@kb-{kb_version}"
+
+
+class BatchJournal:
+    """
+    A durable, per-row checkpoint log for a batch job, stored next to analysis_log.
+
+    Every finished row is committed to the 'batch_journal' table as soon as it
+    completes, keyed by (job name, hash of the input row). A restarted job looks
+    rows up here and only re-runs those that have not succeeded yet, up to
+    `max_attempts` attempts per row.
+    """
+
+    def __init__(self, job_name: str, db_path: str = None, max_attempts: int = None):
+        self.job_name = job_name
+        self.db_path = db_path or DATABASE_NAME
+        self.max_attempts = max_attempts or DEFAULT_MAX_ATTEMPTS
+        self._conn = get_connection(self.db_path)
+        self._conn.execute("""
+        CREATE TABLE IF NOT EXISTS batch_journal (
+            job_name TEXT NOT NULL,
+            row_key TEXT NOT NULL,
+            row_index INTEGER,
+            status TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            result TEXT,
+            updated_at DATETIME NOT NULL,
+            PRIMARY KEY (job_name, row_key)
+        )
+        """)
+        self._conn.commit()
+        self._entries = {
+            key: {"status": status, "attempts": attempts, "result": json.loads(result) if result else None}
+            for key, status, attempts, result in self._conn.execute(
+                "SELECT row_key, status, attempts, result FROM batch_journal WHERE job_name = ?", (job_name,)
+            )
+        }
+
+    def lookup(self, key: str):
+        """
+        Returns the stored result for a row if it should not be run again.
+
+        Returns:
+            dict or None: The journaled result for rows that succeeded or have used up
+                          their attempts; None for rows that still need to run.
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry["status"] == "done" or entry["attempts"] >= self.max_attempts:
+            return entry["result"]
+        return None
+
+    def record(self, key: str, row_index: int, result: dict, succeeded: bool):
+        """Durably records the outcome of one attempt at a row."""
+        entry = self._entries.setdefault(key, {"status": None, "attempts": 0, "result": None})
+        entry["status"] = "done" if succeeded else "failed"
+        entry["attempts"] += 1
+        entry["result"] = result
+        # Only the write is retried while SQLite is busy, so an attempt is counted once.
+        self._write(key, row_index, entry)
+
+    @retry_on_busy
+    def _write(self, key: str, row_index: int, entry: dict):
+        self._conn.execute("""
+        INSERT INTO batch_journal (job_name, row_key, row_index, status, attempts, result, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(job_name, row_key) DO UPDATE SET
+            row_index = excluded.row_index, status = excluded.status, attempts = excluded.attempts,
+            result = excluded.result, updated_at = excluded.updated_at
+        """, (self.job_name, key, row_index, entry["status"], entry["attempts"], json.dumps(entry["result"]),
+              datetime.datetime.now()))
+        self._conn.commit()
+
+    def clear(self):
+        """Forgets every checkpoint of this job so the next run starts from scratch."""
+        self._conn.execute("DELETE FROM batch_journal WHERE job_name = ?", (self.job_name,))
+        self._conn.commit()
+        self._entries.clear()
+
+    def close(self):
+        # The connection is the thread's shared one (see database_utils.get_connection); just drop the reference.
+        self._conn = None
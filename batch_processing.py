@@ -1,7 +1,7 @@
+import argparse
 import pandas as pd
-import json
 import os
-from compliance_checker import check_feature # Import your existing function
+from batch_engine import run_batch
 
 # --- CONFIGURATION ---
 INPUT_CSV_PATH = r"C:\Users\..."
@@ -11,7 +11,7 @@ OUTPUT_CSV_PATH = r"C:\Users\..."
 # You can customize this based on your project's specific legal framework.
 LEGAL_CONTEXT = "The system must comply with GDPR. Key principles include data minimization, purpose limitation, and requiring explicit consent for processing sensitive data like biometrics (Article 9)."
 
-def process_batch():
+def process_batch(fresh: bool = False):
     """
     Reads features from an input CSV, processes them, and saves the results to a new CSV.
     """
@@ -25,53 +25,43 @@ def process_batch():
     # 2. Read the input CSV into a pandas DataFrame
     input_df = pd.read_csv(INPUT_CSV_PATH, encoding='windows-1252')
     
-    # List to store the results for each row
-    results_list = []
+    # 3. Concatenate the two columns as requested
+    def build_input(row):
+        return f"{row['feature_name']}: {row['feature_description']}"
 
-    # 3. Iterate through each row of the input DataFrame
-    for index, row in input_df.iterrows():
-        feature_name = row['feature_name']
-        feature_description = row['feature_description']
-        
-        # Concatenate the two columns as requested
-        combined_input = f"{feature_name}: {feature_description}"
-        
-        print(f"⚙️ Processing row {index + 1}/{len(input_df)}: '{feature_name}'")
-        
-        try:
-            # 4. Call your existing analysis function
-            analysis_result = check_feature(combined_input)
-            
-            # Parse the JSON string output from the checker
-            #analysis_result = json.loads(analysis_json_string)
-            
-            # 5. Store the results in a dictionary
-            result_row = {
-                'feature_name': feature_name,
-                'feature_description': feature_description,
-                'output_flag': analysis_result.get('flag', 'ERROR'),
-                'output_reasoning': analysis_result.get('reasoning', 'Could not parse reasoning.')
-            }
-            results_list.append(result_row)
-            
-        except Exception as e:
-            print(f"❗️ An error occurred on row {index + 1}: {e}")
-            # Optionally, add an error entry to the results
-            results_list.append({
-                'feature_name': feature_name,
-                'feature_description': feature_description,
-                'output_flag': 'ERROR',
-                'output_reasoning': str(e)
-            })
+    # 4. Store the results for each row in a dictionary. Failed analyses come
+    #    back with an 'Error' flag and the error message as their reasoning.
+    def build_output(row, analysis_result):
+        flag = analysis_result.get('flag', 'ERROR')
+        return {
+            'feature_name': row['feature_name'],
+            'feature_description': row['feature_description'],
+            'output_flag': 'ERROR' if flag == 'Error' else flag,
+            'output_reasoning': analysis_result.get('reasoning', 'Could not parse reasoning.')
+        }
 
-    # 6. Convert the list of results into a DataFrame and save to CSV
-    if results_list:
-        results_df = pd.DataFrame(results_list)
-        results_df.to_csv(OUTPUT_CSV_PATH, index=False)
-        print(f"✅ Success! Processing complete. Results saved to '{OUTPUT_CSV_PATH}'.")
-    else:
+    if input_df.empty:
         print("⚠️ No results to save.")
+        return
+
+    # 5. Run the analyses through the shared batch engine, which bounds concurrency,
+    #    respects the Gemini rate limits, streams rows to the output CSV in order and
+    #    checkpoints each row so an interrupted run can be resumed.
+    run_batch(
+        input_df.to_dict('records'),
+        build_input,
+        build_output,
+        OUTPUT_CSV_PATH,
+        ['feature_name', 'feature_description', 'output_flag', 'output_reasoning'],
+        desc="⚙️ Processing rows",
+        job_name=f"batch_processing:{INPUT_CSV_PATH}",
+        fresh=fresh
+    )
+    print(f"✅ Success! Processing complete. Results saved to '{OUTPUT_CSV_PATH}'.")
 
 # --- Main execution block ---
 if __name__ == "__main__":
-    process_batch()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Analyze every feature of the input CSV.")
+    parser.add_argument("--fresh", action="store_true",
+                        help="ignore checkpoints of earlier runs and analyze every row again")
+    process_batch(fresh=parser.parse_args().fresh)
\ No newline at end of file
@@ -0,0 +1,456 @@
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import asyncio
+import hashlib
+import argparse
+import platform
+import datetime
+import tempfile
+import contextlib
+from types import SimpleNamespace
+import numpy as np
+import pandas as pd
+
+# --- Configuration ---
+# Feature descriptions the benchmarks cycle through (the same file evaluate.py reads).
+DATASET_CSV_PATH = "test_dataset.csv"
+DESCRIPTION_COLUMN = "feature_description"
+# Bundled ChromaDB store; the benchmark queries a temporary copy so the original is never modified.
+BUNDLED_CHROMA_PATH = "chroma_db_store"
+# The bundled store was built with LangChain's default collection name.
+BUNDLED_CHROMA_COLLECTION = "langchain"
+# Simulated Gemini latency per call (in milliseconds); the real model takes seconds.
+DEFAULT_LLM_LATENCY_MS = 100
+# Iterations of each component benchmark, and of the end-to-end analysis.
+DEFAULT_ITERATIONS = 50
+DEFAULT_END_TO_END_ITERATIONS = 20
+# Concurrency levels of the API load test, and the requests sent per level (at least
+# REQUESTS_PER_WORKER per concurrent client, so every level runs long enough to measure).
+DEFAULT_CONCURRENCY_LEVELS = (1, 4, 16, 64)
+MIN_REQUESTS_PER_LEVEL = 32
+REQUESTS_PER_WORKER = 4
+# A metric regresses when it is worse than the baseline by more than this fraction...
+DEFAULT_TOLERANCE = 0.25
+# ...and by more than this many milliseconds, so microsecond-scale jitter is never flagged.
+NOISE_FLOOR_MS = 0.5
+# Bump when the report layout changes; baselines of another version are not compared.
+REPORT_VERSION = 1
+
+BENCHMARKS = ("jargon_expansion", "embedding", "embedding_cached", "retrieval", "prompt_build",
+              "sqlite_write", "sqlite_read_page", "sqlite_search", "end_to_end", "api_load")
+
+
+# --- Offline stand-in for the Gemini client ---
+
+class FakeGeminiClient:
+    """
+    A deterministic, offline replacement for google.genai.Client.
+
+    Implements the parts of the async API compliance_checker uses (generate_content,
+    generate_content_stream and caches.create). Each call sleeps for the configured
+    latency and answers with a well-formed analysis derived from a hash of the
+    prompt: the same prompt always gets the same flag, and the citations are the
+    sources actually present in the prompt.
+    """
+
+    def __init__(self, latency_ms: float = DEFAULT_LLM_LATENCY_MS):
+        self.latency_seconds = latency_ms / 1000.0
+        self.calls = 0
+        self.aio = SimpleNamespace(
+            models=SimpleNamespace(generate_content=self._generate_content,
+                                   generate_content_stream=self._generate_content_stream),
+            caches=SimpleNamespace(create=self._create_cache),
+        )
+
+    @staticmethod
+    def _answer(contents: str) -> dict:
+        digest = hashlib.sha256(contents.encode("utf-8")).digest()
+        sources = []
+        for line in contents.splitlines():
+            if line.startswith("Source Document: [") and line.endswith("]"):
+                source = line[len("Source Document: ["):-1]
+                if source not in sources:
+                    sources.append(source)
+        return {
+            "flag": ("Yes", "No", "Uncertain")[digest[0] % 3],
+            "reasoning": f"Offline benchmark analysis {digest[:4].hex()}.",
+            "related_regulations": [os.path.splitext(os.path.basename(s))[0] for s in sources[:2]],
+            "citations": sources[:2],
+        }
+
+    @staticmethod
+    def _response(parts: list, contents: str, output: str, final: bool = True):
+        usage = SimpleNamespace(
+            prompt_token_count=len(contents) // 4 + 1, cached_content_token_count=None,
+            candidates_token_count=len(output) // 4 + 1, thoughts_token_count=16,
+        ) if final else None
+        return SimpleNamespace(candidates=[SimpleNamespace(content=SimpleNamespace(parts=parts))], usage_metadata=usage)
+
+    async def _generate_content(self, model: str, contents: str, config=None):
+        self.calls += 1
+        await asyncio.sleep(self.latency_seconds)
+        output = json.dumps(self._answer(contents))
+        parts = [SimpleNamespace(thought=True, text="Comparing the feature with the retrieved texts."),
+                 SimpleNamespace(thought=False, text=output)]
+        return self._response(parts, contents, output)
+
+    async def _generate_content_stream(self, model: str, contents: str, config=None):
+        self.calls += 1
+        output = json.dumps(self._answer(contents))
+
+        async def chunks():
+            await asyncio.sleep(self.latency_seconds / 2)
+            yield self._response([SimpleNamespace(thought=True, text="Comparing the feature with the retrieved texts.")],
+                                 contents, output, final=False)
+            await asyncio.sleep(self.latency_seconds / 2)
+            yield self._response([SimpleNamespace(thought=False, text=output)], contents, output)
+        return chunks()
+
+    async def _create_cache(self, model: str, config=None):
+        return SimpleNamespace(name="cachedContents/offline-benchmark")
+
+
+# --- Measurement helpers ---
+
+def summarize(latencies: list, wall_seconds: float = None) -> dict:
+    """
+    Summarizes per-call latencies (in seconds) as milliseconds.
+
+    Args:
+        latencies (list): One duration per call.
+        wall_seconds (float, optional): Elapsed time of the whole run; defaults to the
+            sum of the latencies (i.e. sequential calls). Used for the throughput.
+    """
+    values = np.asarray(latencies, dtype=np.float64) * 1000.0
+    wall_seconds = wall_seconds if wall_seconds is not None else float(np.sum(latencies))
+    return {
+        "count": int(values.size),
+        "mean_ms": round(float(values.mean()), 3),
+        "p50_ms": round(float(np.percentile(values, 50)), 3),
+        "p95_ms": round(float(np.percentile(values, 95)), 3),
+        "p99_ms": round(float(np.percentile(values, 99)), 3),
+        "min_ms": round(float(values.min()), 3),
+        "max_ms": round(float(values.max()), 3),
+        "throughput_per_s": round(values.size / wall_seconds, 2) if wall_seconds > 0 else None,
+    }
+
+
+def measure(func, inputs: list, warmup: int = 1) -> dict:
+    """Calls `func` once per input (after `warmup` untimed calls) and summarizes the latencies."""
+    for item in inputs[:warmup]:
+        func(item)
+    latencies = []
+    for item in inputs:
+        started = time.perf_counter()
+        func(item)
+        latencies.append(time.perf_counter() - started)
+    return summarize(latencies)
+
+
+@contextlib.contextmanager
+def quiet(enabled: bool = True):
+    """Silences the pipeline's progress prints while a benchmark runs."""
+    if not enabled:
+        yield
+        return
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+
+
+def _cycle(items: list, count: int, unique: bool = False) -> list:
+    """Repeats items up to `count` entries; with `unique`, each entry gets a distinct suffix."""
+    repeated = [items[i % len(items)] for i in range(count)]
+    return [f"{text} (benchmark run {i})" for i, text in enumerate(repeated)] if unique else repeated
+
+
+# --- Environment ---
+
+def prepare_environment(workdir: str, llm_latency_ms: float):
+    """
+    Points every stateful component at throw-away locations before the app is imported.
+
+    The audit log, the embedding cache and the ChromaDB store live in `workdir`, so a
+    benchmark run neither needs credentials nor touches the repository's data.
+    Retrieval and embedding settings (RETRIEVAL_BACKEND, RETRIEVAL_MODE, RERANK,
+    EMBEDDING_BACKEND, ...) are left to the caller's environment, so each
+    configuration can be benchmarked.
+    """
+    chroma_path = os.path.join(workdir, "chroma_db_store")
+    shutil.copytree(BUNDLED_CHROMA_PATH, chroma_path)
+    os.environ.update({
+        "CHROMA_MODE": "local",
+        "CHROMA_LOCAL_PATH": chroma_path,
+        "CHROMA_LOCAL_COLLECTION": os.getenv("CHROMA_LOCAL_COLLECTION", BUNDLED_CHROMA_COLLECTION),
+        "AUDIT_DB_PATH": os.path.join(workdir, "audit_log.db"),
+        "EMBEDDING_CACHE_DB": os.path.join(workdir, "embedding_cache.db"),
+        "KB_VERSION_FILE": os.path.join(workdir, "kb_version"),
+    })
+    # Imported only now, so the modules read the configuration above.
+    import compliance_checker
+    compliance_checker.set_gemini_client(FakeGeminiClient(llm_latency_ms))
+    return compliance_checker
+
+
+def environment_report(args) -> dict:
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "embedding_backend": os.getenv("EMBEDDING_BACKEND", "torch"),
+        "retrieval_backend": os.getenv("RETRIEVAL_BACKEND", "chroma"),
+        "retrieval_mode": os.getenv("RETRIEVAL_MODE", "hybrid"),
+        "rerank": os.getenv("RERANK", "none"),
+        "llm_latency_ms": args.llm_latency_ms,
+    }
+
+
+# --- Benchmarks ---
+
+def run_component_benchmarks(checker, features: list, selected: set, iterations: int, e2e_iterations: int,
+                             verbose: bool) -> dict:
+    """Times each pipeline stage on its own, then the whole analysis through check_feature."""
+    import database_utils
+    from jargon import get_expander
+    from prompt_builder import build_prompt
+
+    results = {}
+
+    def record(name: str, func, inputs: list, warmup: int = 1):
+        if name not in selected:
+            return
+        print(f"Benchmarking {name} ({len(inputs)} calls)...")
+        with quiet(not verbose):
+            results[name] = measure(func, inputs, warmup)
+        print(f"  p50 {results[name]['p50_ms']:.2f} ms, p95 {results[name]['p95_ms']:.2f} ms")
+
+    with quiet(not verbose):
+        database_utils.init_db()
+        checker.warm_up()
+    inputs = _cycle(features, iterations)
+
+    expander = get_expander()
+    record("jargon_expansion", expander.expand, inputs)
+
+    # Distinct texts bypass the embedding cache and time the model itself.
+    embedder = checker.get_embedding_model().model
+    record("embedding", embedder.encode, _cycle(features, iterations, unique=True))
+    record("embedding_cached", checker.encode, inputs)
+
+    expanded = {feature: expander.expand(feature)[0] for feature in features}
+    embeddings = {feature: checker.encode(expanded[feature]).tolist() for feature in features}
+    record("retrieval", lambda feature: checker.run_sync(checker.find_relevant_laws_async(
+        expanded[feature], "regulatory_docs", query_embedding=embeddings[feature])), inputs)
+
+    with quiet(not verbose):
+        chunks = {feature: checker.find_relevant_laws(expanded[feature], "regulatory_docs") for feature in features}
+    examples = [{"feature": f, "correct_analysis": json.dumps({"flag": "Yes", "reasoning": "Benchmark example."})}
+                for f in features[:3]]
+    record("prompt_build", lambda feature: build_prompt(expanded[feature], chunks[feature], examples), inputs)
+
+    written = []
+
+    def write(feature: str):
+        result = FakeGeminiClient._answer(feature)
+        result.update({"thought": "Benchmark thought process. " * 20, "expanded_query": expanded[feature],
+                       "expanded_terms": [], "token_usage": {"total": 1000}})
+        written.append(database_utils.save_analysis(result, feature))
+
+    record("sqlite_write", write, inputs)
+    # Mark some analyses as corrected, so the end-to-end runs include few-shot examples.
+    with quiet(not verbose):
+        for log_id in written[:10]:
+            database_utils.update_feedback(log_id, "corrected", "Yes", "Corrected during the benchmark.")
+    record("sqlite_read_page", lambda _: database_utils.fetch_logs_page(limit=50), inputs)
+    record("sqlite_search", lambda feature: database_utils.search_logs(feature.split()[0]), inputs)
+
+    # Distinct inputs keep the response cache and single-flight from short-circuiting the run.
+    record("end_to_end", checker.check_feature, _cycle(features, e2e_iterations, unique=True))
+    return results
+
+
+async def _load_level(client, features: list, concurrency: int, requests: int, offset: int) -> dict:
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, errors = [], 0
+
+    async def one(i: int):
+        nonlocal errors
+        async with semaphore:
+            started = time.perf_counter()
+            response = await client.post("/analyze", json={"feature_description": f"{features[i % len(features)]} (load {offset + i})"})
+            latencies.append(time.perf_counter() - started)
+            if response.status_code != 200 or response.json()["result"].get("flag") == "Error":
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(requests)))
+    summary = summarize(latencies, time.perf_counter() - started)
+    summary.update({"concurrency": concurrency, "errors": errors})
+    return summary
+
+
+async def _run_load_test(features: list, levels: list, verbose: bool) -> dict:
+    import httpx
+    import main
+
+    results = {}
+    with quiet(not verbose):
+        await main.on_startup()
+    try:
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=None) as client:
+            offset = 0
+            for concurrency in levels:
+                requests = max(MIN_REQUESTS_PER_LEVEL, REQUESTS_PER_WORKER * concurrency)
+                print(f"Load testing POST /analyze at concurrency {concurrency} ({requests} requests)...")
+                with quiet(not verbose):
+                    summary = await _load_level(client, features, concurrency, requests, offset)
+                offset += requests
+                results[f"concurrency_{concurrency}"] = summary
+                print(f"  {summary['throughput_per_s']} req/s, p50 {summary['p50_ms']:.1f} ms, "
+                      f"p95 {summary['p95_ms']:.1f} ms, {summary['errors']} errors")
+    finally:
+        with quiet(not verbose):
+            await main.on_shutdown()
+    return results
+
+
+def run_load_test(features: list, levels: list, verbose: bool) -> dict:
+    """
+    Load-tests the FastAPI app in process at rising concurrency.
+
+    Requests go through httpx's ASGI transport, so the whole app (routing,
+    validation, the analysis and the batched audit write) is exercised without
+    opening a socket.
+    """
+    return asyncio.run(_run_load_test(features, levels, verbose))
+
+
+# --- Baseline comparison ---
+
+def _comparable_metrics(report: dict) -> dict:
+    """Flattens a report into {metric name: (value, higher is better)}."""
+    metrics = {}
+    for name, summary in report.get("benchmarks", {}).items():
+        for key in ("p50_ms", "p95_ms"):
+            metrics[f"{name}.{key}"] = (summary[key], False)
+    for level, summary in report.get("load", {}).items():
+        for key in ("p50_ms", "p95_ms"):
+            metrics[f"api_load.{level}.{key}"] = (summary[key], False)
+        metrics[f"api_load.{level}.throughput_per_s"] = (summary["throughput_per_s"], True)
+        metrics[f"api_load.{level}.errors"] = (summary["errors"], False)
+    return metrics
+
+
+def compare_to_baseline(report: dict, baseline: dict, tolerance: float = DEFAULT_TOLERANCE) -> list:
+    """
+    Finds the metrics that got worse than the baseline by more than the tolerance.
+
+    Latencies must also worsen by more than NOISE_FLOOR_MS, and any new error is a
+    regression. Metrics missing from either report are skipped.
+
+    Returns:
+        list: One dict per regression with the metric, both values and the change.
+    """
+    if baseline.get("version") != REPORT_VERSION:
+        print(f"Baseline has report version {baseline.get('version')}, expected {REPORT_VERSION}; not comparing.")
+        return []
+    changed = sorted(key for key, value in report.get("environment", {}).items()
+                     if key in baseline.get("environment", {}) and baseline["environment"][key] != value)
+    if changed:
+        print(f"Note: the baseline was recorded with a different {', '.join(changed)}; differences may not be regressions.")
+    current, previous = _comparable_metrics(report), _comparable_metrics(baseline)
+    regressions = []
+    for metric, (value, higher_is_better) in current.items():
+        if metric not in previous or value is None or previous[metric][0] is None:
+            continue
+        old = previous[metric][0]
+        if metric.endswith(".errors"):
+            worse = value > old
+        elif higher_is_better:
+            worse = value < old * (1 - tolerance)
+        else:
+            worse = value > old * (1 + tolerance) and value - old > NOISE_FLOOR_MS
+        if worse:
+            change = (value - old) / old if old else None
+            regressions.append({"metric": metric, "baseline": old, "current": value,
+                                "change": round(change, 3) if change is not None else None})
+    return regressions
+
+
+# --- Entry point ---
+
+def run(args) -> dict:
+    features = pd.read_csv(DATASET_CSV_PATH)[DESCRIPTION_COLUMN].dropna().astype(str).tolist()
+    selected = set(args.only or BENCHMARKS)
+    with tempfile.TemporaryDirectory(prefix="regtok-benchmark-", ignore_cleanup_errors=True) as workdir:
+        print(f"Preparing offline environment in '{workdir}' (LLM latency {args.llm_latency_ms} ms)...")
+        with quiet(not args.verbose):
+            checker = prepare_environment(workdir, args.llm_latency_ms)
+        report = {
+            "version": REPORT_VERSION,
+            "created": datetime.datetime.now().isoformat(timespec="seconds"),
+            "environment": environment_report(args),
+            "benchmarks": run_component_benchmarks(
+                checker, features, selected, args.iterations, args.end_to_end_iterations, args.verbose
+            ),
+            "load": run_load_test(features, args.concurrency, args.verbose) if "api_load" in selected else {},
+        }
+        # Release the SQLite files before the temporary directory is removed.
+        with quiet(not args.verbose):
+            import database_utils
+            database_utils.close_connection()
+    return report
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(
+        description="Benchmark RegTok offline, with the bundled ChromaDB store and a simulated Gemini model."
+    )
+    parser.add_argument("--output", default="benchmark_report.json", help="where to write the JSON report")
+    parser.add_argument("--baseline", help="compare with this earlier report and exit 1 on regressions")
+    parser.add_argument("--save-baseline", metavar="PATH", help="also write the report to PATH as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help=f"allowed slowdown as a fraction of the baseline (default {DEFAULT_TOLERANCE})")
+    parser.add_argument("--llm-latency-ms", type=float, default=DEFAULT_LLM_LATENCY_MS,
+                        help="simulated Gemini latency per call")
+    parser.add_argument("--iterations", type=int, default=DEFAULT_ITERATIONS)
+    parser.add_argument("--end-to-end-iterations", type=int, default=DEFAULT_END_TO_END_ITERATIONS)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=list(DEFAULT_CONCURRENCY_LEVELS),
+                        help="API load-test concurrency levels")
+    parser.add_argument("--only", nargs="+", choices=BENCHMARKS, help="run only these benchmarks")
+    parser.add_argument("--quick", action="store_true", help="few iterations and low concurrency, for smoke tests")
+    parser.add_argument("--verbose", action="store_true", help="show the pipeline's own output")
+    args = parser.parse_args(argv)
+    if args.quick:
+        args.iterations, args.end_to_end_iterations, args.concurrency = 10, 5, [1, 4]
+
+    report = run(args)
+    if args.baseline:
+        try:
+            with open(args.baseline, encoding="utf-8") as f:
+                baseline = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Error reading baseline '{args.baseline}': {e}")
+            return 2
+        report["regressions"] = compare_to_baseline(report, baseline, args.tolerance)
+
+    for path in filter(None, (args.output, args.save_baseline)):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"Wrote benchmark report to '{path}'.")
+
+    regressions = report.get("regressions", [])
+    for regression in regressions:
+        change = f"{regression['change']:+.0%}" if regression["change"] is not None else "new"
+        print(f"REGRESSION {regression['metric']}: {regression['baseline']} -> {regression['current']} ({change})")
+    if args.baseline:
+        print(f"{len(regressions)} regression(s) against '{args.baseline}' (tolerance {args.tolerance:.0%}).")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
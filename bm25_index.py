@@ -0,0 +1,173 @@
+import os
+import re
+import json
+import threading
+from collections import Counter
+import numpy as np
+
+from vector_index import DEFAULT_INDEX_DIR, CHUNKS_FILE, metadata_mask
+
+# --- Configuration ---
+# Lexical index file, written next to the local vector index and aligned with its chunks.
+BM25_FILE = "bm25.json"
+# Bump when tokenization or the file layout changes; older files are then rebuilt.
+BM25_VERSION = 1
+# Standard Okapi BM25 parameters: term-frequency saturation and length normalization.
+BM25_K1 = 1.5
+BM25_B = 0.75
+# How many times the words of a chunk's source file name are added to its text, so a
+# query naming a state or law ("California", "Florida") favors that document's chunks.
+SOURCE_NAME_WEIGHT = 2
+
+# Common English words that carry no signal for matching statutes.
+STOPWORDS = frozenset("""
+a an and are as at be by for from has have if in into is it its of on or our that the their this
+to was were which will with such any all may must not no shall should can than then these those
+""".split())
+
+# Bill designators written as "SB976", "S.B. 976" or "SB 976" all become one token, "sb976".
+_BILL = re.compile(r"\b(sb|hb|ab|sf|hf)\.?\s*(\d+[a-z]?)\b")
+# Periods inside abbreviations ("u.s.c.") are dropped so they survive as one token ("usc").
+_ABBREVIATION_DOT = re.compile(r"(?<=\b[a-z])\.(?=[a-z]\b)")
+_TOKEN = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text: str) -> list:
+    """
+    Splits text into lowercase BM25 terms, keeping statute numbers and ages intact.
+
+    "18 U.S.C. 2258A" yields ["18", "usc", "2258a"] and "S.B. 976" yields ["sb976"].
+    Numbers are always kept (age thresholds matter); stopwords and single letters are not.
+    """
+    text = _ABBREVIATION_DOT.sub("", text.lower())
+    text = _BILL.sub(r"\1\2", text)
+    return [t for t in _TOKEN.findall(text) if t.isdigit() or (len(t) > 1 and t not in STOPWORDS)]
+
+
+def _source_terms(metadata: dict) -> list:
+    source = os.path.splitext(os.path.basename(str(metadata.get("source", ""))))[0]
+    return tokenize(source.replace("_", " ")) * SOURCE_NAME_WEIGHT
+
+
+def build_bm25_index(index_dir: str = None):
+    """
+    Builds the BM25 inverted index for the chunks of a local vector index.
+
+    Reads the chunk file written by vector_index.IndexWriter, so row i of the lexical
+    index is row i of the vector index. The file is replaced atomically.
+    """
+    index_dir = index_dir or os.getenv("LOCAL_INDEX_DIR", DEFAULT_INDEX_DIR)
+    postings = {}  # term -> [[row, ...], [term frequency, ...]]
+    lengths = []
+    with open(os.path.join(index_dir, CHUNKS_FILE), encoding="utf-8") as f:
+        for row, line in enumerate(f):
+            record = json.loads(line)
+            terms = tokenize(record["document"]) + _source_terms(record["metadata"])
+            lengths.append(len(terms))
+            for term, frequency in Counter(terms).items():
+                rows, frequencies = postings.setdefault(term, ([], []))
+                rows.append(row)
+                frequencies.append(frequency)
+
+    path = os.path.join(index_dir, BM25_FILE)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump({"version": BM25_VERSION, "count": len(lengths), "lengths": lengths, "postings": postings}, f)
+    os.replace(path + ".tmp", path)
+    print(f"Wrote BM25 index with {len(postings)} terms over {len(lengths)} chunks to '{index_dir}'.")
+
+
+class LexicalIndex:
+    """
+    An in-process BM25 index over the knowledge-base chunks.
+
+    Postings are held as NumPy arrays, so a query costs one vectorized update per
+    query term; it complements the embedding search on exact tokens such as bill
+    numbers, U.S.C. sections and age thresholds that sentence embeddings blur.
+    """
+
+    def __init__(self, index_dir: str = DEFAULT_INDEX_DIR):
+        self.index_dir = index_dir
+        with open(os.path.join(index_dir, BM25_FILE), encoding="utf-8") as f:
+            data = json.load(f)
+        if data.get("version") != BM25_VERSION:
+            raise ValueError(f"BM25 index at '{index_dir}' has an old format; re-run prepare_knowledge_base.py.")
+        self.count = data["count"]
+        self.postings = {
+            term: (np.asarray(rows, dtype=np.int32), np.asarray(frequencies, dtype=np.float32))
+            for term, (rows, frequencies) in data["postings"].items()
+        }
+        lengths = np.asarray(data["lengths"], dtype=np.float32)
+        average = float(lengths.mean()) if self.count else 1.0
+        # Per-document part of the BM25 denominator, computed once.
+        self._length_norm = BM25_K1 * (1 - BM25_B + BM25_B * lengths / (average or 1.0))
+
+        self.documents, self.metadatas = [], []
+        with open(os.path.join(index_dir, CHUNKS_FILE), encoding="utf-8") as f:
+            for line in f:
+                record = json.loads(line)
+                self.documents.append(record["document"])
+                self.metadatas.append(record["metadata"])
+        if len(self.documents) != self.count:
+            raise ValueError(f"BM25 index at '{index_dir}' is out of date: {self.count} entries, {len(self.documents)} chunks.")
+
+    def scores(self, query: str) -> np.ndarray:
+        """Returns the BM25 score of every chunk for a query."""
+        scores = np.zeros(self.count, dtype=np.float32)
+        for term in set(tokenize(query)):
+            posting = self.postings.get(term)
+            if posting is None:
+                continue
+            rows, frequencies = posting
+            idf = np.log(1 + (self.count - len(rows) + 0.5) / (len(rows) + 0.5))
+            scores[rows] += idf * frequencies * (BM25_K1 + 1) / (frequencies + self._length_norm[rows])
+        return scores
+
+    def query(self, query: str, n_results: int = 3, where: dict = None) -> list:
+        """
+        Returns the n_results chunks with the highest BM25 score for a query.
+
+        Args:
+            query (str): Free text; tokenized like the indexed chunks.
+            n_results (int): Number of chunks to return.
+            where (dict, optional): Chroma-style metadata filter, as in LocalVectorIndex.query.
+
+        Returns:
+            list: (document, metadata) tuples ordered by descending score; chunks that
+                  share no term with the query are never returned.
+        """
+        if not self.count or n_results <= 0:
+            return []
+        scores = self.scores(query)
+        if where:
+            for key, condition in where.items():
+                scores[~metadata_mask(self.metadatas, key, condition)] = 0.0
+        matching = int(np.count_nonzero(scores))
+        k = min(n_results, matching)
+        if k == 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(self.documents[i], self.metadatas[i]) for i in top]
+
+
+# --- Process-wide index ---
+_index = None
+_index_stamp = None
+_index_lock = threading.Lock()
+
+
+def get_lexical_index(index_dir: str = None) -> LexicalIndex:
+    """
+    Returns the process-wide LexicalIndex, reloading it if the index was rebuilt.
+
+    Raises:
+        FileNotFoundError: If no BM25 index has been built yet.
+    """
+    global _index, _index_stamp
+    index_dir = index_dir or os.getenv("LOCAL_INDEX_DIR", DEFAULT_INDEX_DIR)
+    stamp = (index_dir, os.stat(os.path.join(index_dir, BM25_FILE)).st_mtime_ns)
+    with _index_lock:
+        if _index is None or _index_stamp != stamp:
+            _index = LexicalIndex(index_dir)
+            _index_stamp = stamp
+        return _index
@@ -0,0 +1,212 @@
+import os
+import threading
+import time
+import chromadb
+
+# --- Configuration ---
+# Selects which ChromaDB deployment to talk to: "cloud" (Chroma Cloud) or "local"
+# (an on-disk PersistentClient, useful for offline work and tests).
+DEFAULT_CHROMA_MODE = "cloud"
+# Directory of the bundled local vector store used when CHROMA_MODE=local.
+DEFAULT_LOCAL_PATH = "chroma_db_store"
+# Minimum number of seconds between two heartbeat checks of a live client.
+HEALTH_CHECK_INTERVAL_SECONDS = 30.0
+# Backoff bounds (in seconds) for the background reconnect loop.
+RECONNECT_INITIAL_DELAY_SECONDS = 1.0
+RECONNECT_MAX_DELAY_SECONDS = 60.0
+
+
+class ChromaClientManager:
+    """
+    Owns a single, long-lived ChromaDB client and a cache of collection handles.
+
+    The client is created once per process and reused across requests. Collection
+    handles are cached by name so repeated queries skip the lookup round-trip. The
+    client is periodically heart-beaten, and after a failure it is dropped and a
+    background thread reconnects with exponential backoff, so request threads never
+    block on a reconnect loop.
+
+    Configuration is read from the environment when the manager is created:
+    CHROMA_MODE ("cloud" or "local"), CHROMA_LOCAL_PATH, CHROMA_LOCAL_COLLECTION and,
+    for cloud mode, CHROMA_API_KEY, CHROMA_TENANT and CHROMA_DATABASE.
+    """
+
+    def __init__(self, mode: str = None, local_path: str = None):
+        self.mode = (mode or os.getenv("CHROMA_MODE", DEFAULT_CHROMA_MODE)).lower()
+        self.local_path = local_path or os.getenv("CHROMA_LOCAL_PATH", DEFAULT_LOCAL_PATH)
+        # The bundled local store was built with LangChain's default collection name,
+        # so local runs may need to remap the requested collection name.
+        self.local_collection = os.getenv("CHROMA_LOCAL_COLLECTION")
+        self._client = None
+        self._collections = {}
+        self._last_health_check = 0.0
+        self._lock = threading.RLock()
+        self._reconnect_thread = None
+
+    def _connect(self):
+        """Creates a new ChromaDB client for the configured mode."""
+        if self.mode == "local":
+            print(f"Opening local ChromaDB store at '{self.local_path}'...")
+            return chromadb.PersistentClient(path=self.local_path)
+        if self.mode != "cloud":
+            raise ValueError(f"Unknown CHROMA_MODE '{self.mode}'. Expected 'cloud' or 'local'.")
+        print("Connecting to ChromaDB Cloud...")
+        api_key = os.getenv("CHROMA_API_KEY")
+        tenant = os.getenv("CHROMA_TENANT")
+        database = os.getenv("CHROMA_DATABASE")
+        if not all([api_key, tenant, database]):
+            raise ValueError("ChromaDB credentials not found.")
+        return chromadb.CloudClient(api_key=api_key, tenant=tenant, database=database)
+
+    def _resolve_name(self, name: str) -> str:
+        if self.mode == "local" and self.local_collection:
+            return self.local_collection
+        return name
+
+    def get_client(self):
+        """
+        Returns the shared client, connecting on first use.
+
+        Raises:
+            ConnectionError: If a background reconnect is currently in progress.
+        """
+        with self._lock:
+            if self._client is None:
+                if self._reconnect_thread is not None and self._reconnect_thread.is_alive():
+                    raise ConnectionError("ChromaDB is unavailable; reconnecting in the background.")
+                self._client = self._connect()
+                self._last_health_check = time.monotonic()
+            elif time.monotonic() - self._last_health_check > HEALTH_CHECK_INTERVAL_SECONDS:
+                if not self.check_health():
+                    raise ConnectionError("ChromaDB health check failed; reconnecting in the background.")
+            return self._client
+
+    def get_collection(self, name: str):
+        """Returns a cached handle for the named collection, fetching it on first use."""
+        with self._lock:
+            client = self.get_client()
+            resolved = self._resolve_name(name)
+            collection = self._collections.get(resolved)
+            if collection is None:
+                collection = client.get_collection(name=resolved)
+                self._collections[resolved] = collection
+            return collection
+
+    def get_or_create_collection(self, name: str):
+        """Returns a cached handle for the named collection, creating the collection if needed."""
+        with self._lock:
+            client = self.get_client()
+            resolved = self._resolve_name(name)
+            collection = self._collections.get(resolved)
+            if collection is None:
+                collection = client.get_or_create_collection(name=resolved)
+                self._collections[resolved] = collection
+            return collection
+
+    def delete_collection(self, name: str):
+        """Deletes the named collection if it exists and forgets its cached handle."""
+        with self._lock:
+            client = self.get_client()
+            resolved = self._resolve_name(name)
+            self._collections.pop(resolved, None)
+            try:
+                client.delete_collection(name=resolved)
+            except Exception:
+                # An exception is expected if the collection does not exist.
+                pass
+
+    def check_health(self) -> bool:
+        """
+        Heart-beats the current client.
+
+        Returns:
+            bool: True if the client responded. On failure the client is dropped and
+                  a background reconnect is scheduled.
+        """
+        with self._lock:
+            if self._client is None:
+                return False
+            try:
+                self._client.heartbeat()
+                self._last_health_check = time.monotonic()
+                return True
+            except Exception as e:
+                print(f"ChromaDB health check failed: {e}")
+                self.report_failure()
+                return False
+
+    def report_failure(self):
+        """Discards the current client and cached handles and starts a background reconnect."""
+        with self._lock:
+            self._client = None
+            self._collections.clear()
+            if self._reconnect_thread is None or not self._reconnect_thread.is_alive():
+                self._reconnect_thread = threading.Thread(
+                    target=self._reconnect_loop, name="chroma-reconnect", daemon=True
+                )
+                self._reconnect_thread.start()
+
+    def _reconnect_loop(self):
+        delay = RECONNECT_INITIAL_DELAY_SECONDS
+        while True:
+            try:
+                client = self._connect()
+                client.heartbeat()
+            except Exception as e:
+                print(f"ChromaDB reconnect failed, retrying in {delay:.0f}s: {e}")
+                time.sleep(delay)
+                delay = min(delay * 2, RECONNECT_MAX_DELAY_SECONDS)
+                continue
+            with self._lock:
+                self._client = client
+                self._collections.clear()
+                self._last_health_check = time.monotonic()
+            print("Reconnected to ChromaDB.")
+            return
+
+    def reset(self):
+        """Drops the client and all cached collection handles (e.g. after a rebuild)."""
+        with self._lock:
+            self._client = None
+            self._collections.clear()
+
+
+def is_connection_error(error: BaseException) -> bool:
+    """
+    Tells transport failures (unreachable server, dropped connection, timeout) apart
+    from query errors such as an invalid `where` filter or a dimension mismatch.
+
+    Only the former mean the shared client is unusable; the exception's cause chain
+    is checked, since clients wrap transport errors in their own types.
+    """
+    try:
+        import httpx
+        transport_errors = (ConnectionError, TimeoutError, OSError, httpx.TransportError)
+    except ImportError:
+        transport_errors = (ConnectionError, TimeoutError, OSError)
+    seen = set()
+    while error is not None and id(error) not in seen:
+        if isinstance(error, transport_errors):
+            return True
+        seen.add(id(error))
+        error = error.__cause__ or error.__context__
+    return False
+
+
+# --- Process-wide manager ---
+_manager = None
+_manager_lock = threading.Lock()
+
+
+def get_manager() -> ChromaClientManager:
+    """Returns the process-wide ChromaClientManager, creating it on first use."""
+    global _manager
+    with _manager_lock:
+        if _manager is None:
+            _manager = ChromaClientManager()
+        return _manager
+
+
+def get_collection(name: str):
+    """Convenience wrapper returning a cached collection handle from the shared manager."""
+    return get_manager().get_collection(name)
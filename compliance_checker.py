@@ -1,84 +1,393 @@
 import os
 import json
-import re
-import pandas as pd
-import chromadb
-from sentence_transformers import SentenceTransformer
-import google.generativeai as genai
+import asyncio
+import threading
+import time
+import functools
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
 
 from dotenv import load_dotenv
 
-from database_utils import init_db, save_analysis, fetch_corrected_examples
+from database_utils import init_db, save_analysis, register_feedback_listener, feedback_generation
+from vector_index import get_local_index
+from bm25_index import get_lexical_index
+from reranker import get_reranker, DEFAULT_RERANK_CANDIDATES, DEFAULT_RERANK_BUDGET_MS
+from embedding_cache import CachedEncoder
+from embedding_backend import load_embedder, cache_namespace
+from jargon import get_expander as get_jargon_expander
+from response_cache import get_response_cache, chunk_id
+from corrections_index import CorrectionsIndex
+from singleflight import get_single_flight
+from metrics import span, traced, trace_request, record_analysis, record_llm_call, CACHE_EVENTS
+from prompt_builder import build_prompt, usage_from_response, load_tokenizer, ContextCache, PROMPT_TEMPLATE_VERSION
 
 # Load environment variables from a .env file for secure credential management.
+# This is cheap and must happen before any configuration below is read.
 load_dotenv()
 
-# Initialize the sentence transformer model for creating vector embeddings.
-embedding_model = SentenceTransformer('all-MiniLM-L6-v2')
+# The sentence-transformer model used for vector embeddings. The model, the Gemini
+# client and the vector-store connection are heavy, so none of them is created at
+# import time: each is built on first use, or ahead of time by warm_up().
+EMBEDDING_MODEL_NAME = 'all-MiniLM-L6-v2'
+
+# Selects the retrieval backend used by find_relevant_laws: "chroma" (remote or local
+# ChromaDB, see chroma_client) or "local" (the embedded NumPy index, see vector_index).
+RETRIEVAL_BACKEND = os.getenv("RETRIEVAL_BACKEND", "chroma").lower()
+
+# "hybrid" fuses the vector ranking with a BM25 ranking over the same chunks (see
+# bm25_index), which catches exact tokens like bill numbers; "vector" uses embeddings only.
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "hybrid").lower()
+# Candidates taken from each ranking before fusion.
+HYBRID_CANDIDATES = int(os.getenv("HYBRID_CANDIDATES", "10"))
+# Reciprocal-rank fusion constant; larger values flatten the advantage of top ranks.
+RRF_K = 60
+
+# "cross-encoder" over-fetches candidates and reorders them with a local cross-encoder
+# (see reranker) before the best ones go into the prompt; "none" keeps the retrieval order.
+RERANK = os.getenv("RERANK", "none").lower()
+# Candidates retrieved for the reranker, and the time it may take per request.
+RERANK_CANDIDATES = int(os.getenv("RERANK_CANDIDATES", DEFAULT_RERANK_CANDIDATES))
+RERANK_BUDGET_MS = float(os.getenv("RERANK_BUDGET_MS", DEFAULT_RERANK_BUDGET_MS))
+
+# --- Lazily Initialized Resources ---
+
+_embedding_model = None
+_gemini_client = None
+_gemini_client_ready = False
+_resources_lock = threading.Lock()
+
+def get_embedding_model() -> CachedEncoder:
+    """Returns the shared embedding model, loading it on first use.
+
+    Encodes go through a content-addressed cache shared with prepare_knowledge_base,
+    so repeated feature descriptions skip the forward pass entirely. The runtime
+    (PyTorch, ONNX or int8 ONNX) is chosen by EMBEDDING_BACKEND, see embedding_backend.
+    """
+    global _embedding_model
+    if _embedding_model is None:
+        with _resources_lock:
+            if _embedding_model is None:
+                embedder = load_embedder(model_name=EMBEDDING_MODEL_NAME)
+                _embedding_model = CachedEncoder(embedder, cache_namespace(EMBEDDING_MODEL_NAME, embedder.backend))
+    return _embedding_model
+
+def encode(sentences, **kwargs):
+    """Embeds a string or list of strings with the shared (cached) embedding model."""
+    return get_embedding_model().encode(sentences, **kwargs)
+
+def get_gemini_client():
+    """Returns the shared Gemini client, creating it on first use, or None if it cannot be created."""
+    global _gemini_client, _gemini_client_ready
+    if not _gemini_client_ready:
+        with _resources_lock:
+            if not _gemini_client_ready:
+                # The SDK itself is slow to import, so it is only loaded here.
+                from google import genai
+                try:
+                    _gemini_client = genai.Client()
+                except Exception as e:
+                    print(f"Error initializing Gemini client: {e}")
+                    _gemini_client = None
+                _gemini_client_ready = True
+    return _gemini_client
+
+def set_gemini_client(client):
+    """Replaces the shared Gemini client, e.g. with the offline stand-in used by benchmark.py."""
+    global _gemini_client, _gemini_client_ready
+    with _resources_lock:
+        _gemini_client = client
+        _gemini_client_ready = True
+
+# --- Async Execution Helpers ---
+
+# Thread pool for the blocking parts of the pipeline (embedding, jargon expansion,
+# ChromaDB queries and SQLite reads), so they never stall the event loop.
+BLOCKING_WORKERS = int(os.getenv("BLOCKING_WORKERS", "32"))
+_blocking_executor = ThreadPoolExecutor(max_workers=BLOCKING_WORKERS, thread_name_prefix="regtok-blocking")
+
+async def run_blocking(func, *args):
+    """Runs a blocking callable on the shared thread pool and awaits its result.
+
+    The caller's context is carried over, so spans recorded on the worker thread
+    land in the caller's trace.
+    """
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(
+        _blocking_executor, functools.partial(context.run, func, *args)
+    )
+
+# A single background event loop drives the async pipeline for synchronous callers,
+# so the async Gemini client is always used from the same loop.
+_sync_loop = None
+_sync_loop_lock = threading.Lock()
+
+def run_sync(coro):
+    """Runs a coroutine to completion from synchronous code and returns its result."""
+    global _sync_loop
+    with _sync_loop_lock:
+        if _sync_loop is None:
+            _sync_loop = asyncio.new_event_loop()
+            threading.Thread(target=_sync_loop.run_forever, name="regtok-sync-loop", daemon=True).start()
+    return asyncio.run_coroutine_threadsafe(coro, _sync_loop).result()
+
+def _query_chroma(query_embedding: list, collection_name: str, n_results: int, where: dict = None) -> list:
+    """Queries ChromaDB through the shared client and returns (document, metadata) tuples."""
+    # Imported here so processes that never query ChromaDB don't load its client.
+    from chroma_client import get_collection, get_manager as get_chroma_manager, is_connection_error
+    try:
+        # Reuse the process-wide client and cached collection handle instead of
+        # reconnecting to ChromaDB on every analysis.
+        collection = get_collection(collection_name)
+    except Exception as e:
+        print(f"Error: {e}")
+        return []
 
-def find_relevant_laws(feature_description: str, collection_name: str, n_results: int = 3) -> list:
-    """Embeds a feature description and queries ChromaDB for relevant legal texts.
+    # Query the collection for the most relevant documents and their metadata.
+    try:
+        results = collection.query(
+            query_embeddings=[query_embedding],
+            n_results=n_results,
+            where=where or None,
+            include=['metadatas', 'documents'] # Ensure both documents and metadata are returned.
+        )
+    except Exception as e:
+        print(f"Error querying ChromaDB: {e}")
+        if is_connection_error(e):
+            # Drop the (possibly stale) connection so it is re-established in the background.
+            # A query error (bad filter, wrong dimension) leaves the shared client alone.
+            get_chroma_manager().report_failure()
+        return []
+    
+    # Combine the retrieved documents and metadata into a structured list.
+    docs = results.get('documents', [[]])[0]
+    metadatas = results.get('metadatas', [[]])[0]
+    
+    # Gracefully handle cases where documents or metadata might be missing in the results.
+    return list(zip(docs, metadatas)) if docs and metadatas else []
+
+def _query_local_index(query_embedding: list, n_results: int, where: dict = None) -> list:
+    """Queries the embedded in-process vector index and returns (document, metadata) tuples."""
+    try:
+        index = get_local_index()
+    except (OSError, ValueError) as e:
+        print(f"Error loading local vector index: {e}")
+        return []
+    return index.query(query_embedding, n_results=n_results, where=where)
 
-    This function connects to a ChromaDB cloud instance, converts the input text
-    into a vector embedding, and retrieves the most similar document chunks
-    along with their associated metadata, which is crucial for citations.
+_lexical_index_warned = False
+
+@traced("lexical_search")
+def _query_lexical_index(query: str, n_results: int, where: dict = None) -> list:
+    """Queries the in-process BM25 index and returns (document, metadata) tuples."""
+    global _lexical_index_warned
+    try:
+        index = get_lexical_index()
+    except (OSError, ValueError) as e:
+        if not _lexical_index_warned:
+            print(f"BM25 index unavailable, using vector retrieval only: {e}")
+            _lexical_index_warned = True
+        return []
+    return index.query(query, n_results=n_results, where=where)
+
+def _reciprocal_rank_fusion(rankings: list, n_results: int) -> list:
+    """Merges ranked (document, metadata) lists, scoring each chunk by the sum of 1 / (RRF_K + rank)."""
+    scores, chunks = {}, {}
+    for ranking in rankings:
+        for rank, (doc, meta) in enumerate(ranking, start=1):
+            key = chunk_id(doc)
+            scores[key] = scores.get(key, 0.0) + 1.0 / (RRF_K + rank)
+            chunks.setdefault(key, (doc, meta))
+    ranked = sorted(scores, key=scores.get, reverse=True)
+    return [chunks[key] for key in ranked[:n_results]]
+
+def find_relevant_laws(feature_description: str, collection_name: str, n_results: int = 3, where: dict = None) -> list:
+    """Embeds a feature description and retrieves relevant legal texts.
+
+    This function converts the input text into a vector embedding and retrieves
+    the most similar document chunks along with their associated metadata, which
+    is crucial for citations. Depending on RETRIEVAL_BACKEND, the lookup goes to
+    ChromaDB through the shared, long-lived client (see chroma_client) or to the
+    embedded, memory-mapped index written at ingest time (see vector_index).
 
     Args:
         feature_description: The string description of the product feature.
         collection_name: The name of the ChromaDB collection to query.
         n_results: The number of relevant documents to retrieve.
+        where: Optional metadata filter, e.g. {"source": "knowledge_base/EU_Digital_Service_Act.txt"}.
 
     Returns:
         A list of tuples, where each tuple contains the document text and its
         corresponding metadata dictionary, e.g., [('text', {'source': 'GDPR'})].
         Returns an empty list if an error occurs or no results are found.
     """
+    return run_sync(find_relevant_laws_async(feature_description, collection_name, n_results, where))
+
+@traced("retrieval")
+async def find_relevant_laws_async(feature_description: str, collection_name: str, n_results: int = 3, where: dict = None,
+                                   query_embedding: list = None) -> list:
+    """Async variant of find_relevant_laws; see its docstring for arguments and return value.
+
+    The embedding and the ChromaDB query run on the blocking thread pool, so many
+    retrievals can be in flight on one event loop. Callers that already embedded
+    the description can pass `query_embedding` to skip that step. In hybrid mode
+    the BM25 search runs concurrently with the vector search and the two rankings
+    are merged with reciprocal-rank fusion. With RERANK=cross-encoder, extra
+    candidates are fetched and the cross-encoder picks the best `n_results`.
+    """
+    async def vector_search(limit: int) -> list:
+        embedding = query_embedding
+        # Convert the user's query into a vector embedding for semantic search.
+        if embedding is None:
+            with span("embedding"):
+                embedding = (await run_blocking(encode, feature_description)).tolist()
+        with span("vector_search"):
+            if RETRIEVAL_BACKEND == "local":
+                # The in-process index answers in microseconds; no need to leave the loop.
+                return _query_local_index(embedding, limit, where)
+            return await run_blocking(_query_chroma, embedding, collection_name, limit, where)
+
+    async def search(limit: int) -> list:
+        if RETRIEVAL_MODE != "hybrid":
+            return await vector_search(limit)
+        candidates = max(limit, HYBRID_CANDIDATES)
+        vector_hits, lexical_hits = await asyncio.gather(
+            vector_search(candidates),
+            run_blocking(_query_lexical_index, feature_description, candidates, where)
+        )
+        if not lexical_hits:
+            return vector_hits[:limit]
+        return _reciprocal_rank_fusion([vector_hits, lexical_hits], limit)
+
+    if RERANK != "cross-encoder":
+        return await search(n_results)
+    candidates = await search(max(n_results, RERANK_CANDIDATES))
+    return await _rerank(feature_description, candidates, n_results)
+
+# Reranking gets its own small pool, so cross-encoder passes never compete with
+# embedding and ChromaDB work on the shared pool. A pass that overruns its budget
+# keeps its worker until it finishes, so when every worker is busy new requests
+# skip reranking instead of queueing more model work.
+RERANK_WORKERS = int(os.getenv("RERANK_WORKERS", "2"))
+_rerank_executor = ThreadPoolExecutor(max_workers=RERANK_WORKERS, thread_name_prefix="regtok-rerank")
+_rerank_slots = threading.BoundedSemaphore(RERANK_WORKERS)
+
+@traced("rerank")
+async def _rerank(query: str, candidates: list, n_results: int) -> list:
+    """Reranks candidates with the cross-encoder, keeping the retrieval order if it is saturated or over budget."""
+    reranker = get_reranker()
+    if not _rerank_slots.acquire(blocking=False):
+        reranker.record_skip()
+        return candidates[:n_results]
+    context = contextvars.copy_context()
+    future = _rerank_executor.submit(context.run, reranker.rerank, query, candidates, n_results)
+    # The slot is held until the pass really ends, even if this request stops waiting
+    # for it; the callback runs on the worker thread, independent of any event loop.
+    future.add_done_callback(lambda _: _rerank_slots.release())
     try:
-        # Establish connection to the ChromaDB cloud service using environment variables.
-        print("Connecting to ChromaDB Cloud...")
-        api_key = os.getenv("CHROMA_API_KEY")
-        tenant = os.getenv("CHROMA_TENANT")
-        database = os.getenv("CHROMA_DATABASE")
-        if not all([api_key, tenant, database]):
-            raise ValueError("ChromaDB credentials not found.")
-        cloud_client = chromadb.CloudClient(api_key=api_key, tenant=tenant, database=database)
-        collection = cloud_client.get_collection(name=collection_name)
+        return await asyncio.wait_for(asyncio.wrap_future(future), timeout=RERANK_BUDGET_MS / 1000)
+    except asyncio.TimeoutError:
+        # The pass cannot be interrupted; it finishes on its reserved worker and fills
+        # the score cache, so a repeat of this query is reranked from cache.
+        reranker.record_timeout()
+        print(f"Reranking exceeded its {RERANK_BUDGET_MS:.0f} ms budget; using retrieval order.")
     except Exception as e:
-        print(f"Error: {e}")
-        return []
-
-    # Convert the user's query into a vector embedding for semantic search.
-    query_embedding = embedding_model.encode(feature_description).tolist()
-    
-    # Query the collection for the most relevant documents and their metadata.
-    results = collection.query(
-        query_embeddings=[query_embedding],
-        n_results=n_results,
-        include=['metadatas', 'documents'] # Ensure both documents and metadata are returned.
-    )
-    
-    # Combine the retrieved documents and metadata into a structured list.
-    docs = results.get('documents', [[]])[0]
-    metadatas = results.get('metadatas', [[]])[0]
-    
-    # Gracefully handle cases where documents or metadata might be missing in the results.
-    return list(zip(docs, metadatas)) if docs and metadatas else []
+        print(f"Error reranking retrieved chunks: {e}")
+    return candidates[:n_results]
 
 # --- Language Model and Prompting Setup ---
 
-# Initialize the Gemini client for generative AI capabilities.
-try:
-    gemini_client = genai.Client()
-except Exception as e:
-    print(f"Error initializing Gemini client: {e}")
-    gemini_client = None
+# The Gemini model that performs the analysis.
+GEMINI_MODEL = "gemini-2.5-pro"
+
+# Prompts are assembled by prompt_builder: a byte-stable system instruction (reused
+# from Gemini's context cache) plus a token-budgeted, request-specific user turn.
+context_cache = ContextCache()
+
+# Any recorded human correction can change the few-shot examples and the expected
+# answers, so cached analyses are dropped whenever feedback lands. The listener only
+# hears this process's feedback; lookups also check the shared feedback generation.
+register_feedback_listener(get_response_cache().invalidate)
+
+# Human-corrected analyses, embedded and searched by similarity to pick the few-shot
+# examples for each analysis. Kept current as corrections are recorded.
+corrections_index = CorrectionsIndex(encode)
+register_feedback_listener(corrections_index.on_feedback)
+
+# --- Warm-up and Readiness ---
+
+# Seconds each component took to warm up, filled in by warm_up().
+_warm_up_timings = {}
+_warm_up_error = None
+
+def _connect_chroma():
+    from chroma_client import get_collection
+    return get_collection("regulatory_docs")
+
+def _warm_up_corrections_index():
+    # CorrectionsIndex reports load failures by staying unloaded (searches then fall
+    # back to recent corrections), so turn that into a warm-up error here.
+    corrections_index.size
+    if not corrections_index.loaded:
+        raise RuntimeError(corrections_index.load_error or "the corrections index did not load")
+
+def warm_up():
+    """Creates every heavy resource ahead of the first request.
+
+    Loads the embedding model (and runs one encode so lazy kernels are initialized),
+    the Gemini client, the vector store, the jargon expander, the local tokenizer
+    and the corrections index. Meant to be called once at server startup, off the event loop; the
+    readiness() report flips to ready once it has finished.
+    """
+    global _warm_up_error
+    steps = [
+        ("embedding_model", lambda: encode("warm-up")),
+        ("gemini_client", get_gemini_client),
+        ("jargon_expander", get_jargon_expander),
+        ("token_counter", load_tokenizer),
+        ("corrections_index", _warm_up_corrections_index),
+        ("vector_store", get_local_index if RETRIEVAL_BACKEND == "local" else _connect_chroma),
+    ]
+    if RETRIEVAL_MODE == "hybrid":
+        steps.append(("lexical_index", get_lexical_index))
+    if RERANK == "cross-encoder":
+        steps.append(("reranker", lambda: get_reranker().warm_up()))
+    for name, step in steps:
+        started = time.perf_counter()
+        try:
+            step()
+        except Exception as e:
+            # A failing component leaves the service unready but must not stop startup.
+            print(f"Error warming up {name}: {e}")
+            _warm_up_error = f"{name}: {e}"
+            continue
+        _warm_up_timings[name] = round(time.perf_counter() - started, 3)
+        print(f"Warmed up {name} in {_warm_up_timings[name]:.2f}s.")
+
+def readiness() -> dict:
+    """Reports which heavy resources are initialized and whether the service is ready to analyze."""
+    components = {
+        "embedding_model": _embedding_model is not None,
+        "gemini_client": _gemini_client is not None,
+        # Live, so a corrections index that failed to warm up but loaded later counts.
+        "corrections_index": corrections_index.loaded,
+        # Until the tokenizer has loaded, prompts are budgeted with the length heuristic.
+        "token_counter": "token_counter" in _warm_up_timings,
+        "vector_store": "vector_store" in _warm_up_timings,
+    }
+    return {
+        "ready": all(components.values()),
+        "components": components,
+        "warm_up_seconds": dict(_warm_up_timings),
+        "error": _warm_up_error,
+    }
 
 def expand_query_from_file(user_query: str) -> str:
     """Expands technical terms in a user query with simpler explanations.
 
-    This function reads a local CSV file containing a mapping of terms to
-    explanations. It then substitutes any occurrences of these terms in the
-    user's query to provide more context for the language model.
+    This is a thin wrapper around the shared JargonExpander (see jargon), which
+    merges Terminologies.csv, glossary.json and terminology.json once and
+    substitutes every term in a single pass.
 
     Args:
         user_query: The original query string from the user.
@@ -86,27 +395,39 @@ def expand_query_from_file(user_query: str) -> str:
     Returns:
         The query string with technical terms replaced by their explanations.
     """
-    file_path = "/Users/kc/Work/RegTok/Terminologies.csv"
-    try:
-        mapping_df = pd.read_csv(file_path) if file_path.endswith('.csv') else pd.read_excel(file_path)
-    except FileNotFoundError:
-        return user_query
-    if 'term' not in mapping_df.columns or 'explanation' not in mapping_df.columns:
-        return user_query
-    expanded_query = user_query.lower()
-    for _, row in mapping_df.iterrows():
-        # Use regex for whole-word matching to avoid replacing parts of other words.
-        pattern = r'\b' + re.escape(row['term'].lower()) + r'\b'
-        expanded_query = re.sub(pattern, row['explanation'].lower(), expanded_query)
+    expanded_query, _ = get_jargon_expander().expand(user_query)
     return expanded_query
 
+async def _generation_config(gemini_client, prompt) -> object:
+    """Returns the Gemini config: JSON output with the model's thought process included.
+
+    The static prompt prefix is referenced from an explicit context cache when one
+    is configured, and otherwise sent as the system instruction.
+    """
+    from google.genai import types
+    cache_name = await context_cache.get_name(gemini_client, GEMINI_MODEL)
+    return types.GenerateContentConfig(
+        temperature=0.1, 
+        response_mime_type="application/json", 
+        thinking_config=types.ThinkingConfig(include_thoughts=True),
+        system_instruction=None if cache_name else prompt.system_instruction,
+        cached_content=cache_name)
+
+def _parse_response(response) -> tuple:
+    """Separates the model's thought process from the final JSON output."""
+    result_dict, thought_text = {}, ""
+    for part in response.candidates[0].content.parts:
+        if part.thought:
+            thought_text += part.text
+        else:
+            result_dict = json.loads(part.text)
+    return result_dict, thought_text
+
 def check_feature(feature_description: str) -> dict:
     """Analyzes a product feature for compliance using an LLM and vector search.
 
-    This function orchestrates the entire compliance check process. It expands the
-    user query, retrieves relevant legal context from a vector database, fetches
-    high-quality examples, and constructs a detailed prompt for the Gemini model.
-    The final output is a structured JSON analysis.
+    This is a synchronous wrapper around check_feature_async, for scripts and
+    other callers that are not running an event loop.
 
     Args:
         feature_description: The description of the product feature to be analyzed.
@@ -115,93 +436,219 @@ def check_feature(feature_description: str) -> dict:
         A dictionary containing the compliance analysis, including a flag,
         reasoning, list of related regulations, and source citations.
     """
-    expanded_query = expand_query_from_file(feature_description)
-    if not gemini_client:
-        return {"flag": "Error", "reasoning": "Gemini client not initialized.", "related_regulations": [], "citations": []}
+    return run_sync(check_feature_async(feature_description))
 
+async def _retrieve_context(expanded_query: str) -> tuple:
+    """Fetches the relevant legal chunks and the few-shot examples concurrently."""
     # Step 1: Retrieve relevant legal documents from the vector database.
-    print("Step 1: Searching for relevant regulations and sources...")
-    relevant_chunks_with_meta = find_relevant_laws(expanded_query, collection_name="regulatory_docs")
-    
-    # Construct the context string, embedding the source of each legal document.
-    # This ensures the LLM can trace its reasoning back to specific source texts.
-    context_parts = []
-    if relevant_chunks_with_meta:
-        for doc, meta in relevant_chunks_with_meta:
-            # The 'source' key in the metadata is crucial for generating citations.
-            source = meta.get('source', 'Unknown Source')
-            context_parts.append(f"Source Document: [{source}]\nContent: {doc}\n---")
-        context = "\n".join(context_parts)
-    else:
-        context = "No specific regulatory documents were found for context."
-
-    # Step 2: Fetch human-corrected "Golden Examples" for few-shot prompting.
+    # Step 2: Fetch the human-corrected "Golden Examples" most similar to this feature.
     # These examples guide the model to produce a more accurate and well-formatted response.
-    print("Step 2: Fetching diverse, human-corrected examples...")
-    golden_examples = fetch_corrected_examples()
-    examples_prompt_section = ""
-    if golden_examples:
-        examples_str = "\n".join([f"### Example:\nProduct Feature: \"{ex['feature']}\"\nCorrect Analysis:\n{ex['correct_analysis']}" for ex in golden_examples])
-        examples_prompt_section = f"Here are some high-quality examples of correct analyses:\n{examples_str}\n---"
-        
-    # The system prompt instructs the LLM on its role, the context, and the required output format.
-    # Explicitly requiring a "citations" key in the JSON response forces the model to cite its sources.
-    system_prompt = f"""
-You are an expert compliance officer. Your task is to analyze a product feature and determine if it requires geo-specific logic, based on the provided legal texts.
+    # Both searches use the same query embedding and run concurrently.
+    print("Step 1/2: Searching for relevant regulations and fetching human-corrected examples...")
+    with span("embedding"):
+        query_embedding = (await run_blocking(encode, expanded_query)).tolist()
+    relevant_chunks_with_meta, golden_examples = await asyncio.gather(
+        find_relevant_laws_async(expanded_query, collection_name="regulatory_docs", query_embedding=query_embedding),
+        run_blocking(_few_shot_examples, query_embedding)
+    )
+    return relevant_chunks_with_meta, golden_examples
+
+@traced("few_shot")
+def _few_shot_examples(query_embedding: list) -> list:
+    return corrections_index.search(query_embedding)
+
+async def _lookup_cached_analysis(expanded_query: str, relevant_chunks_with_meta: list, golden_examples: list) -> tuple:
+    """Checks the response cache for this request.
+
+    Returns:
+        A (cache_key, query_embedding, generation, cached_result, hit_kind) tuple;
+        cached_result and hit_kind are None on a miss. The key, embedding and feedback
+        generation are needed to store the fresh analysis afterwards.
+    """
+    # Serve repeated (or, if enabled, near-identical) requests from the response cache.
+    # The key covers everything that shapes the answer, so a hit is a safe reuse.
+    response_cache = get_response_cache()
+    with span("response_cache"):
+        generation = await run_blocking(feedback_generation)
+        cache_key = response_cache.make_key(
+            expanded_query,
+            [chunk_id(doc) for doc, _ in relevant_chunks_with_meta],
+            golden_examples,
+            PROMPT_TEMPLATE_VERSION,
+            generation
+        )
+        query_embedding = await run_blocking(encode, expanded_query) if response_cache.semantic_enabled else None
+        cached_result, hit_kind = response_cache.get(cache_key, query_embedding, generation)
+    CACHE_EVENTS.inc(cache="response", result=hit_kind or "miss")
+    return cache_key, query_embedding, generation, cached_result, hit_kind
 
-{examples_prompt_section}
+def _error_result(e: Exception, expanded_query: str, expanded_terms: list) -> dict:
+    print(f"An error occurred during LLM analysis: {e}")
+    # Surface the API status code (e.g. 429) so batch callers can back off and retry.
+    return {"flag": "Error", "reasoning": f"An exception occurred: {e}", "related_regulations": [], "citations": [], "expanded_query": expanded_query, "expanded_terms": expanded_terms, "error_code": getattr(e, "code", None)}
 
-First, in your thought process, analyze the user's feature and compare it to the examples provided. 
-Then, review the "Relevant Legal Texts". Each text is tagged with a "Source Document".
+async def check_feature_async(feature_description: str) -> dict:
+    """Analyzes a product feature for compliance using an LLM and vector search.
 
-After your thought process, provide your final analysis as a structured JSON. The JSON must have four keys:
-1.  "flag": A single string ("Yes", "No", or "Uncertain").
-2.  "reasoning": A concise explanation for your flag. Your reasoning must mention the law that applies.
-3.  "related_regulations": A list of strings of specific regulation names (e.g., ["GDPR", "COPPA"]).
-4.  "citations": A list of strings containing the exact "Source Document" tags (e.g., ["GDPR Article 8", "Utah S.B. 152 Section 3a"]) you used to arrive at your conclusion. If no source was relevant, provide an empty list [].
-"""
+    This function orchestrates the entire compliance check process. It expands the
+    user query, retrieves relevant legal context from a vector database, fetches
+    high-quality examples, and constructs a detailed prompt for the Gemini model.
+    The final output is a structured JSON analysis.
 
-    # The user prompt combines the specific feature and the retrieved context for the LLM's analysis.
-    user_prompt = f"""
-## Product Feature:
-"{expanded_query}"
+    Blocking work (jargon expansion, embedding, ChromaDB, SQLite) runs on a thread
+    pool, the few-shot fetch runs concurrently with retrieval, and the Gemini call
+    uses the client's native async API, so one worker can keep many analyses in flight.
+    Concurrent calls whose expanded queries match (after normalization) share a
+    single run; see singleflight.
 
-## Relevant Legal Texts:
-"{context}"
+    Args:
+        feature_description: The description of the product feature to be analyzed.
 
-Provide your analysis in the required JSON format.
-"""
+    Returns:
+        A dictionary containing the compliance analysis, including a flag,
+        reasoning, list of related regulations, and source citations, plus the
+        "run_id" of the (possibly shared) run and whether this call was "coalesced".
+    """
+    # Every stage is timed into the stage histograms and this request's trace (see metrics).
+    with trace_request("analysis"):
+        with span("jargon_expansion"):
+            expanded_query, expanded_terms = await run_blocking(get_jargon_expander().expand, feature_description)
+        gemini_client = get_gemini_client()
+        if not gemini_client:
+            result = {"flag": "Error", "reasoning": "Gemini client not initialized.", "related_regulations": [], "citations": []}
+        else:
+            result = await get_single_flight().do(
+                expanded_query, lambda: _analyze(expanded_query, expanded_terms, gemini_client)
+            )
+        record_analysis(result)
+        return result
+
+async def _analyze(expanded_query: str, expanded_terms: list, gemini_client) -> dict:
+    """Runs retrieval, the response-cache lookup and the LLM call for one expanded query."""
+    relevant_chunks_with_meta, golden_examples = await _retrieve_context(expanded_query)
+    with span("prompt_build"):
+        prompt = await run_blocking(build_prompt, expanded_query, relevant_chunks_with_meta, golden_examples)
+
+    cache_key, query_embedding, generation, cached_result, hit_kind = await _lookup_cached_analysis(
+        expanded_query, prompt.chunks, prompt.examples
+    )
+    if cached_result is not None:
+        print(f"Step 3: Served analysis from the response cache ({hit_kind} match).")
+        cached_result['expanded_query'] = expanded_query
+        cached_result['expanded_terms'] = expanded_terms
+        cached_result['cache_hit'] = hit_kind
+        cached_result['token_usage'] = prompt.token_usage
+        return cached_result
 
     print("Step 3: Sending enhanced prompt with citation requirement to LLM...")
     try:
-        # Combine system and user prompts to form the complete request.
-        full_prompt = f"{system_prompt}\n\n{user_prompt}"
         # Make the API call to the Gemini model, configured to return JSON and include thought processes.
-        response = gemini_client.models.generate_content(
-            model="gemini-2.5-pro", contents=full_prompt,
-            config=types.GenerateContentConfig(
-                temperature=0.1, 
-                response_mime_type="application/json", 
-                thinking_config=types.ThinkingConfig(include_thoughts=True))
-        )
+        with span("llm"):
+            response = await gemini_client.aio.models.generate_content(
+                model=GEMINI_MODEL, contents=prompt.contents, config=await _generation_config(gemini_client, prompt)
+            )
         
         # Parse the response, separating the model's thought process from the final JSON output.
-        result_dict, thought_text = {}, ""
-        for part in response.candidates[0].content.parts:
-            if part.thought:
-                thought_text += part.text
-            else:
-                result_dict = json.loads(part.text)
+        result_dict, thought_text = _parse_response(response)
 
         # Append the thought process and expanded query to the result for better traceability.
         result_dict['thought'] = thought_text
         result_dict['expanded_query'] = expanded_query
+        result_dict['expanded_terms'] = expanded_terms
+        # Local estimates next to the counts Gemini reports (including cached prefix tokens).
+        result_dict['token_usage'] = {**prompt.token_usage, **usage_from_response(response)}
+        get_response_cache().put(cache_key, result_dict, query_embedding, generation)
         print("Step 4: Analysis with citations complete.")
-        return result_dict
-
     except Exception as e:
-        print(f"An error occurred during LLM analysis: {e}")
-        return {"flag": "Error", "reasoning": f"An exception occurred: {e}", "related_regulations": [], "citations": [], "expanded_query": expanded_query}
+        result_dict = _error_result(e, expanded_query, expanded_terms)
+    # Token and error metrics are recorded here, once per Gemini call, not once per
+    # caller: coalesced callers and response-cache hits share this result.
+    record_llm_call(result_dict)
+    return result_dict
+
+async def check_feature_stream(feature_description: str):
+    """Runs the compliance check and yields stage events as soon as each one finishes.
+
+    This is the streaming counterpart of check_feature_async, for clients that want
+    to show progress while the (slow) thinking model works. The Gemini call uses
+    the streaming API so thought text is forwarded incrementally.
+
+    Args:
+        feature_description: The description of the product feature to be analyzed.
+
+    Yields:
+        (event, data) tuples, in order: "expanded_query", "sources", "examples",
+        zero or more "thought" events, and finally "result" with the same dictionary
+        check_feature_async would return.
+    """
+    with trace_request("analysis_stream"):
+        with span("jargon_expansion"):
+            expanded_query, expanded_terms = await run_blocking(get_jargon_expander().expand, feature_description)
+        yield "expanded_query", {"expanded_query": expanded_query, "expanded_terms": expanded_terms}
+        gemini_client = get_gemini_client()
+        if not gemini_client:
+            result_dict = {"flag": "Error", "reasoning": "Gemini client not initialized.", "related_regulations": [], "citations": []}
+            record_analysis(result_dict)
+            yield "result", result_dict
+            return
+
+        relevant_chunks_with_meta, golden_examples = await _retrieve_context(expanded_query)
+        with span("prompt_build"):
+            prompt = await run_blocking(build_prompt, expanded_query, relevant_chunks_with_meta, golden_examples)
+        yield "sources", [
+            {"source": meta.get('source', 'Unknown Source'), "content": doc}
+            for doc, meta in prompt.chunks
+        ]
+        yield "examples", [{"feature": ex['feature']} for ex in prompt.examples]
+
+        cache_key, query_embedding, generation, cached_result, hit_kind = await _lookup_cached_analysis(
+            expanded_query, prompt.chunks, prompt.examples
+        )
+        if cached_result is not None:
+            print(f"Step 3: Served analysis from the response cache ({hit_kind} match).")
+            cached_result['expanded_query'] = expanded_query
+            cached_result['expanded_terms'] = expanded_terms
+            cached_result['cache_hit'] = hit_kind
+            cached_result['token_usage'] = prompt.token_usage
+            record_analysis(cached_result)
+            yield "result", cached_result
+            return
+
+        print("Step 3: Streaming enhanced prompt with citation requirement to LLM...")
+        try:
+            # The llm span includes the time spent forwarding thoughts to the client.
+            with span("llm"):
+                stream = await gemini_client.aio.models.generate_content_stream(
+                    model=GEMINI_MODEL, contents=prompt.contents, config=await _generation_config(gemini_client, prompt)
+                )
+                # Thought parts are forwarded as they arrive; the JSON answer is accumulated
+                # and parsed once the stream ends. Token counts arrive with the last chunk.
+                thought_text, answer_text, reported_usage = "", "", {}
+                async for chunk in stream:
+                    reported_usage = usage_from_response(chunk) or reported_usage
+                    if not chunk.candidates or not chunk.candidates[0].content or not chunk.candidates[0].content.parts:
+                        continue
+                    for part in chunk.candidates[0].content.parts:
+                        if not part.text:
+                            continue
+                        if part.thought:
+                            thought_text += part.text
+                            yield "thought", {"text": part.text}
+                        else:
+                            answer_text += part.text
+
+            result_dict = json.loads(answer_text)
+            result_dict['thought'] = thought_text
+            result_dict['expanded_query'] = expanded_query
+            result_dict['expanded_terms'] = expanded_terms
+            result_dict['token_usage'] = {**prompt.token_usage, **reported_usage}
+            get_response_cache().put(cache_key, result_dict, query_embedding, generation)
+            print("Step 4: Analysis with citations complete.")
+        except Exception as e:
+            result_dict = _error_result(e, expanded_query, expanded_terms)
+        record_llm_call(result_dict)
+        record_analysis(result_dict)
+        yield "result", result_dict
 
 # --- Script Execution ---
 if __name__ == "__main__":
@@ -0,0 +1,198 @@
+import os
+import sqlite3
+import threading
+import numpy as np
+
+from database_utils import fetch_corrections, fetch_corrected_examples, correction_example, feedback_generation
+from prompt_builder import count_tokens, format_example
+
+# --- Configuration ---
+# Maximum number of corrected examples placed in a prompt.
+DEFAULT_FEW_SHOT_EXAMPLES = int(os.getenv("FEW_SHOT_EXAMPLES", "3"))
+# Token budget for all few-shot examples together (counted with prompt_builder.count_tokens).
+DEFAULT_FEW_SHOT_TOKEN_BUDGET = int(os.getenv("FEW_SHOT_TOKEN_BUDGET", "1500"))
+
+
+def estimate_example_tokens(example: dict) -> int:
+    """Returns the prompt tokens one example takes, formatted as it appears in the prompt."""
+    return count_tokens(format_example(example))
+
+
+class CorrectionsIndex:
+    """
+    An in-memory vector index over the human-corrected analyses.
+
+    Each correction is embedded once (by its expanded query, the same text an
+    analysis is retrieved with) and kept in a normalized matrix, so choosing the
+    few-shot examples for an analysis is one matrix-vector product instead of
+    database scans. The index is loaded lazily from analysis_log on first use and
+    then maintained incrementally through the feedback listener hook (see
+    database_utils.register_feedback_listener). That hook only hears feedback
+    recorded by this process, so every lookup also compares the shared feedback
+    generation and reloads the index when another process has recorded feedback.
+    """
+
+    def __init__(self, encode):
+        """
+        Args:
+            encode: Callable mapping a string or list of strings to embeddings, e.g.
+                    the CachedEncoder's encode method.
+        """
+        self.encode = encode
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._load_error = None   # why the last load failed, if it did
+        self._generation = None   # feedback generation the index reflects
+        self._ids = []            # analysis_log IDs, aligned with the matrix rows
+        self._flags = []          # corrected flag of each row
+        self._examples = []       # formatted few-shot example of each row
+        self._matrix = None       # float32 (n, dim), rows L2-normalized
+
+    def _embed(self, rows: list) -> np.ndarray:
+        texts = [row[2] or row[1] for row in rows]
+        vectors = np.asarray(self.encode(texts), dtype=np.float32).reshape(len(texts), -1)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
+
+    def _ensure_loaded(self):
+        generation = feedback_generation()
+        if self._loaded:
+            if generation is None or generation == self._generation:
+                return
+            print("Feedback was recorded by another process; reloading the corrections index.")
+        try:
+            rows = fetch_corrections()
+        except sqlite3.Error as e:
+            # The table may not exist yet; try again on the next lookup.
+            print(f"Error loading corrections index: {e}")
+            self._load_error = f"loading corrections: {e}"
+            return
+        try:
+            matrix = self._embed(rows) if rows else None
+        except Exception as e:
+            print(f"Error embedding corrections for the corrections index: {e}")
+            self._load_error = f"embedding corrections: {e}"
+            return
+        self._ids = [row[0] for row in rows]
+        self._flags = [row[3] for row in rows]
+        self._examples = [correction_example(row) for row in rows]
+        self._matrix = matrix
+        self._generation = generation
+        self._loaded = True
+        self._load_error = None
+        print(f"Loaded corrections index with {len(rows)} examples.")
+
+    def _remove(self, log_id: int):
+        if log_id not in self._ids:
+            return
+        position = self._ids.index(log_id)
+        del self._ids[position], self._flags[position], self._examples[position]
+        self._matrix = np.delete(self._matrix, position, axis=0) if self._ids else None
+
+    def _adopt_generation(self):
+        # This feedback bumped the generation by one. If it moved further, another
+        # process recorded feedback too, and the next lookup reloads the index.
+        generation = feedback_generation()
+        if generation is not None and self._generation is not None and generation == self._generation + 1:
+            self._generation = generation
+
+    def on_feedback(self, log_id, status):
+        """Feedback listener: adds, replaces or drops the affected correction."""
+        with self._lock:
+            if log_id is None:
+                # The audit log was reset; reload from scratch on the next lookup.
+                self._loaded = False
+                self._ids, self._flags, self._examples, self._matrix = [], [], [], None
+                return
+            if not self._loaded:
+                return
+            self._remove(log_id)
+            if status == "corrected":
+                try:
+                    rows = fetch_corrections(log_id)
+                except sqlite3.Error as e:
+                    print(f"Error updating corrections index: {e}")
+                    self._loaded = False
+                    return
+                if rows:
+                    vector = self._embed(rows)
+                    self._ids.append(rows[0][0])
+                    self._flags.append(rows[0][3])
+                    self._examples.append(correction_example(rows[0]))
+                    self._matrix = vector if self._matrix is None else np.vstack([self._matrix, vector])
+            self._adopt_generation()
+
+    def search(self, query_embedding, k: int = None, token_budget: int = None) -> list:
+        """
+        Selects the corrections most similar to a query, diversified across flags.
+
+        Candidates are ranked by cosine similarity. The best match of every flag is
+        taken first (most similar flag first), then the remaining slots are filled
+        by similarity alone. Examples that would exceed the token budget are skipped.
+
+        Args:
+            query_embedding: Embedding of the expanded query.
+            k (int, optional): Maximum examples. Defaults to FEW_SHOT_EXAMPLES.
+            token_budget (int, optional): Token budget. Defaults to FEW_SHOT_TOKEN_BUDGET.
+
+        Returns:
+            list: Formatted example dictionaries, most relevant first. If the index
+                  cannot be loaded, the most recent corrections are used instead
+                  (see database_utils.fetch_corrected_examples).
+        """
+        k = DEFAULT_FEW_SHOT_EXAMPLES if k is None else k
+        token_budget = DEFAULT_FEW_SHOT_TOKEN_BUDGET if token_budget is None else token_budget
+        with self._lock:
+            self._ensure_loaded()
+            loaded = self._loaded
+        if not loaded:
+            return fetch_corrected_examples(k) if k > 0 else []
+        with self._lock:
+            if self._matrix is None or k <= 0:
+                return []
+            query = np.asarray(query_embedding, dtype=np.float32).reshape(-1)
+            norm = np.linalg.norm(query)
+            scores = self._matrix @ (query / norm if norm else query)
+            ranked = [int(i) for i in np.argsort(-scores)]
+            # Copies: on_feedback edits the lists in place once the lock is released.
+            flags, examples = list(self._flags), list(self._examples)
+
+        # One representative per flag first, in order of similarity, then the rest.
+        seen_flags = set()
+        leaders, rest = [], []
+        for i in ranked:
+            if flags[i] not in seen_flags:
+                seen_flags.add(flags[i])
+                leaders.append(i)
+            else:
+                rest.append(i)
+
+        selected, used_tokens = [], 0
+        for i in leaders + rest:
+            if len(selected) >= k:
+                break
+            cost = estimate_example_tokens(examples[i])
+            if used_tokens + cost > token_budget:
+                continue
+            selected.append(i)
+            used_tokens += cost
+        # Present the chosen examples in order of similarity.
+        selected.sort(key=ranked.index)
+        return [examples[i] for i in selected]
+
+    @property
+    def loaded(self) -> bool:
+        """Whether the index is loaded; until then searches fall back to recent corrections."""
+        return self._loaded
+
+    @property
+    def load_error(self) -> str:
+        """Why the last load failed, or None."""
+        return self._load_error
+
+    @property
+    def size(self) -> int:
+        with self._lock:
+            self._ensure_loaded()
+            return len(self._ids)
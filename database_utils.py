@@ -1,11 +1,246 @@
+import os
+import re
 import sqlite3
 import datetime
+import threading
+import queue
+import time
+import random
+import functools
+import zlib
+import base64
+import binascii
+from concurrent.futures import Future
 import pandas as pd
 import json
 
+from metrics import traced
+
 # --- Constants ---
-# Defines the filename for the SQLite database.
-DATABASE_NAME = "audit_log.db"
+# Defines the filename for the SQLite database (AUDIT_DB_PATH points it elsewhere, e.g. for benchmarks).
+DATABASE_NAME = os.getenv("AUDIT_DB_PATH", "audit_log.db")
+
+# Connection tuning. WAL lets readers (e.g. /logs) proceed while an analysis is
+# being written, and synchronous=NORMAL is durable across application crashes in WAL mode.
+BUSY_TIMEOUT_MS = 5000
+CONNECTION_PRAGMAS = [
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-16000",     # ~16 MB page cache per connection.
+    "PRAGMA mmap_size=268435456",   # Memory-map up to 256 MB of the database file.
+]
+# Size of each connection's prepared-statement cache.
+STATEMENT_CACHE_SIZE = 256
+# Retry policy for 'database is locked' / 'database is busy' errors that outlast busy_timeout.
+MAX_BUSY_RETRIES = 5
+BUSY_RETRY_BASE_DELAY_SECONDS = 0.05
+# Group-commit settings for the batched audit-log writer.
+WRITER_MAX_BATCH_SIZE = int(os.getenv("AUDIT_WRITER_MAX_BATCH", "64"))
+WRITER_MAX_WAIT_SECONDS = float(os.getenv("AUDIT_WRITER_MAX_WAIT_MS", "5")) / 1000.0
+
+# --- Connection Management ---
+
+_thread_local = threading.local()
+
+def get_connection(db_path: str = None) -> sqlite3.Connection:
+    """
+    Returns this thread's long-lived, tuned connection to an SQLite database.
+
+    Connections are opened once per thread and database file and then reused, so
+    each call skips the open/close and pragma setup, and repeated statements are
+    served from the connection's prepared-statement cache.
+
+    Args:
+        db_path (str, optional): Database file. Defaults to DATABASE_NAME.
+    """
+    db_path = db_path or DATABASE_NAME
+    connections = getattr(_thread_local, "connections", None)
+    if connections is None:
+        connections = _thread_local.connections = {}
+    conn = connections.get(db_path)
+    if conn is None:
+        conn = sqlite3.connect(db_path, timeout=BUSY_TIMEOUT_MS / 1000.0,
+                               cached_statements=STATEMENT_CACHE_SIZE)
+        for pragma in CONNECTION_PRAGMAS:
+            conn.execute(pragma)
+        connections[db_path] = conn
+    return conn
+
+def close_connection():
+    """Closes this thread's connections, e.g. before the thread exits."""
+    for conn in getattr(_thread_local, "connections", {}).values():
+        conn.close()
+    _thread_local.connections = {}
+
+def _is_busy_error(e: Exception) -> bool:
+    message = str(e).lower()
+    return isinstance(e, sqlite3.OperationalError) and ("locked" in message or "busy" in message)
+
+def retry_on_busy(func):
+    """Retries a database operation with jittered exponential backoff while SQLite reports it busy."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        for attempt in range(MAX_BUSY_RETRIES + 1):
+            try:
+                return func(*args, **kwargs)
+            except sqlite3.OperationalError as e:
+                if not _is_busy_error(e) or attempt == MAX_BUSY_RETRIES:
+                    raise
+                for conn in getattr(_thread_local, "connections", {}).values():
+                    if conn.in_transaction:
+                        conn.rollback()
+                time.sleep(BUSY_RETRY_BASE_DELAY_SECONDS * (2 ** attempt) * (0.5 + random.random()))
+    return wrapper
+
+# Indexes on analysis_log. Every filtered listing is ordered by (timestamp, id), so
+# each equality filter gets a composite index ending in those columns.
+LOG_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS idx_analysis_log_timestamp_id ON analysis_log (timestamp, id)",
+    "CREATE INDEX IF NOT EXISTS idx_analysis_log_status_timestamp_id ON analysis_log (status, timestamp, id)",
+    "CREATE INDEX IF NOT EXISTS idx_analysis_log_flag_timestamp_id ON analysis_log (flag, timestamp, id)",
+    # Finds the other analyses that shared a coalesced run.
+    "CREATE INDEX IF NOT EXISTS idx_analysis_log_run_id ON analysis_log (run_id) WHERE run_id IS NOT NULL",
+]
+# Full-text index over the searchable analysis_log columns. It is an external-content
+# FTS5 table (the text lives only in analysis_log) kept in sync by the triggers below.
+FTS_COLUMNS = ['original_query', 'expanded_query', 'reasoning', 'related_regulations', 'citations']
+FTS_SCHEMA = [
+    f"""CREATE VIRTUAL TABLE IF NOT EXISTS analysis_log_fts USING fts5(
+        {', '.join(FTS_COLUMNS)},
+        content='analysis_log', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+    )""",
+    f"""CREATE TRIGGER IF NOT EXISTS analysis_log_fts_insert AFTER INSERT ON analysis_log BEGIN
+        INSERT INTO analysis_log_fts (rowid, {', '.join(FTS_COLUMNS)})
+        VALUES (new.id, {', '.join('new.' + c for c in FTS_COLUMNS)});
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS analysis_log_fts_delete AFTER DELETE ON analysis_log BEGIN
+        INSERT INTO analysis_log_fts (analysis_log_fts, rowid, {', '.join(FTS_COLUMNS)})
+        VALUES ('delete', old.id, {', '.join('old.' + c for c in FTS_COLUMNS)});
+    END""",
+    # Feedback updates only touch status columns, so re-index only when searchable text changes.
+    f"""CREATE TRIGGER IF NOT EXISTS analysis_log_fts_update AFTER UPDATE OF {', '.join(FTS_COLUMNS)} ON analysis_log BEGIN
+        INSERT INTO analysis_log_fts (analysis_log_fts, rowid, {', '.join(FTS_COLUMNS)})
+        VALUES ('delete', old.id, {', '.join('old.' + c for c in FTS_COLUMNS)});
+        INSERT INTO analysis_log_fts (rowid, {', '.join(FTS_COLUMNS)})
+        VALUES (new.id, {', '.join('new.' + c for c in FTS_COLUMNS)});
+    END""",
+]
+# Relative bm25 weights of FTS_COLUMNS: a match on a regulation or citation counts most.
+FTS_COLUMN_WEIGHTS = [1.0, 0.5, 1.0, 2.0, 2.0]
+# Page size limits for full-text search results.
+DEFAULT_SEARCH_PAGE_SIZE = 20
+MAX_SEARCH_PAGE_SIZE = 200
+
+# Structured side tables of analysis_log. Regulations and citations are stored one row
+# per element (indexed from both the analysis and the regulation/source side), and the
+# model's thought text lives apart from the log row, optionally compressed.
+DETAIL_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS analysis_regulations (
+        log_id INTEGER NOT NULL,
+        position INTEGER NOT NULL,
+        regulation TEXT NOT NULL,
+        PRIMARY KEY (log_id, position)
+    ) WITHOUT ROWID""",
+    "CREATE INDEX IF NOT EXISTS idx_analysis_regulations_regulation ON analysis_regulations (regulation, log_id)",
+    """CREATE TABLE IF NOT EXISTS analysis_citations (
+        log_id INTEGER NOT NULL,
+        position INTEGER NOT NULL,
+        source TEXT NOT NULL,
+        PRIMARY KEY (log_id, position)
+    ) WITHOUT ROWID""",
+    "CREATE INDEX IF NOT EXISTS idx_analysis_citations_source ON analysis_citations (source, log_id)",
+    """CREATE TABLE IF NOT EXISTS analysis_thoughts (
+        log_id INTEGER PRIMARY KEY,
+        encoding TEXT NOT NULL,
+        thought BLOB
+    )""",
+    # Rows deleted from analysis_log take their details with them.
+    """CREATE TRIGGER IF NOT EXISTS analysis_log_details_delete AFTER DELETE ON analysis_log BEGIN
+        DELETE FROM analysis_regulations WHERE log_id = old.id;
+        DELETE FROM analysis_citations WHERE log_id = old.id;
+        DELETE FROM analysis_thoughts WHERE log_id = old.id;
+    END""",
+]
+
+# A single-row counter bumped in the same transaction as every feedback write (and by
+# reset_database). Listeners only run in the process that recorded the feedback, so
+# caches in other workers compare this generation to notice corrections they missed.
+FEEDBACK_GENERATION_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS feedback_generation (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        generation INTEGER NOT NULL
+    )""",
+    "INSERT OR IGNORE INTO feedback_generation (id, generation) VALUES (1, 0)",
+]
+# Version stamped into PRAGMA user_version once migrate_db has upgraded a database.
+SCHEMA_VERSION = 2
+# Thoughts at least this long (in bytes) are zlib-compressed unless THOUGHT_COMPRESSION=none.
+THOUGHT_COMPRESSION = os.getenv("THOUGHT_COMPRESSION", "zlib").lower()
+THOUGHT_COMPRESSION_MIN_BYTES = 256
+
+# Page size limits for the paginated log listing.
+DEFAULT_LOG_PAGE_SIZE = 100
+MAX_LOG_PAGE_SIZE = 1000
+# Columns returned by the log listing and export, in presentation order.
+LOG_COLUMNS = [
+    'id', 'timestamp', 'original_query', 'flag', 'reasoning',
+    'status', 'human_feedback', 'citations', 'related_regulations', 'expanded_terms'
+]
+
+# Callbacks invoked after human feedback is recorded, e.g. to invalidate caches
+# that depend on the set of corrected examples.
+_feedback_listeners = []
+
+def register_feedback_listener(callback):
+    """
+    Registers a callable invoked as callback(log_id, status) after update_feedback commits.
+
+    reset_database also notifies listeners, as callback(None, None), since every
+    recorded feedback is gone afterwards.
+
+    Args:
+        callback: The function to call. Exceptions it raises are logged and ignored.
+    """
+    if callback not in _feedback_listeners:
+        _feedback_listeners.append(callback)
+
+def _bump_feedback_generation(conn):
+    conn.execute("UPDATE feedback_generation SET generation = generation + 1 WHERE id = 1")
+
+def feedback_generation():
+    """
+    Returns the current feedback generation, shared by every process using the database.
+
+    Returns:
+        int: A counter that increases whenever feedback is recorded or the database is
+             reset, or None if it cannot be read.
+    """
+    try:
+        row = get_connection().execute("SELECT generation FROM feedback_generation WHERE id = 1").fetchone()
+    except sqlite3.Error as e:
+        print(f"Error reading feedback generation: {e}")
+        return None
+    return row[0] if row else None
+
+def _notify_feedback_listeners(log_id, status):
+    for callback in list(_feedback_listeners):
+        try:
+            callback(log_id, status)
+        except Exception as e:
+            print(f"Feedback listener failed: {e}")
+
+def _ensure_column(cursor, table: str, column: str, declaration: str):
+    """
+    Adds a column to an existing table if it is missing.
+
+    'CREATE TABLE IF NOT EXISTS' leaves tables created by older versions untouched,
+    so columns introduced later are added here to keep existing databases usable.
+    """
+    cursor.execute(f"PRAGMA table_info({table})")
+    if column not in [row[1] for row in cursor.fetchall()]:
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {declaration}")
 
 def init_db():
     """
@@ -14,9 +249,8 @@ def init_db():
     This function defines the schema for storing analysis results, including user queries,
     model outputs, status, and human feedback. It ensures the database is ready for logging.
     """
-    conn = None # Initialize conn to None to ensure it's available in the finally block.
     try:
-        conn = sqlite3.connect(DATABASE_NAME)
+        conn = get_connection()
         cursor = conn.cursor()
         # The schema is defined with 'IF NOT EXISTS' to prevent errors on subsequent runs.
         cursor.execute("""
@@ -32,22 +266,246 @@ def init_db():
             status TEXT NOT NULL,
             human_feedback_flag TEXT,
             human_feedback_reasoning TEXT,
-            citations TEXT 
+            citations TEXT,
+            expanded_terms TEXT,
+            cache_hit TEXT,
+            token_usage TEXT,
+            run_id TEXT
         )
         """)
+        # Upgrade databases created before the columns above were introduced.
+        _ensure_column(cursor, "analysis_log", "expanded_terms", "TEXT")
+        _ensure_column(cursor, "analysis_log", "cache_hit", "TEXT")
+        _ensure_column(cursor, "analysis_log", "token_usage", "TEXT")
+        _ensure_column(cursor, "analysis_log", "run_id", "TEXT")
+        # Indexes backing keyset pagination on (timestamp, id) and the /logs filters.
+        for statement in LOG_INDEXES:
+            cursor.execute(statement)
+        # Create the full-text index; backfill it when it is new so existing rows become searchable.
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'analysis_log_fts'")
+        fts_exists = cursor.fetchone() is not None
+        for statement in FTS_SCHEMA:
+            cursor.execute(statement)
+        if not fts_exists:
+            cursor.execute("INSERT INTO analysis_log_fts (analysis_log_fts) VALUES ('rebuild')")
+        for statement in DETAIL_SCHEMA:
+            cursor.execute(statement)
+        for statement in FEEDBACK_GENERATION_SCHEMA:
+            cursor.execute(statement)
         conn.commit()
+        migrate_db()
         print("Database initialized successfully.")
     except sqlite3.Error as e:
         print(f"Database error during initialization: {e}")
-    finally:
-        # Ensure the database connection is always closed, even if errors occur.
-        if conn:
-            conn.close()
 
+def _split_legacy_list(value: str) -> list:
+    """Splits a ", "-joined list written by older versions of save_analysis."""
+    return [item.strip() for item in value.split(',') if item.strip()] if value else []
+
+def migrate_db():
+    """
+    Upgrades an existing audit database to SCHEMA_VERSION.
+
+    Version 2 moves regulations and citations of older rows into the
+    analysis_regulations / analysis_citations tables and their thought text into
+    analysis_thoughts, clearing analysis_log.thought_process. Legacy lists were
+    stored comma-joined, so they are split on commas one last time here. The
+    migration runs in one transaction and is recorded in PRAGMA user_version, so
+    it only ever runs once per database.
+    """
+    conn = get_connection()
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version >= SCHEMA_VERSION:
+        return
+    with conn:
+        rows = conn.execute(
+            "SELECT id, related_regulations, citations, thought_process FROM analysis_log"
+        ).fetchall()
+        for log_id, regulations, citations, thought in rows:
+            _insert_details(conn, log_id, _split_legacy_list(regulations), _split_legacy_list(citations), thought)
+        conn.execute("UPDATE analysis_log SET thought_process = NULL WHERE thought_process IS NOT NULL")
+        conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+    if rows:
+        print(f"Migrated {len(rows)} audit log rows to schema version {SCHEMA_VERSION}.")
+
+# Statement shared by the direct and the batched write paths. thought_process is
+# no longer written here; thoughts are stored in analysis_thoughts.
+INSERT_ANALYSIS_SQL = """
+INSERT INTO analysis_log (
+    timestamp, original_query, expanded_query, flag, reasoning, 
+    related_regulations, status, citations, expanded_terms, cache_hit, token_usage, run_id
+)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+def _encode_thought(thought: str) -> tuple:
+    """Returns (encoding, stored value) for a thought, compressing long ones."""
+    data = thought.encode("utf-8")
+    if THOUGHT_COMPRESSION == "zlib" and len(data) >= THOUGHT_COMPRESSION_MIN_BYTES:
+        return "zlib", zlib.compress(data)
+    return "utf-8", data
+
+def _decode_thought(encoding: str, value: bytes) -> str:
+    if value is None:
+        return ""
+    if encoding == "zlib":
+        value = zlib.decompress(value)
+    return value.decode("utf-8") if isinstance(value, bytes) else value
+
+def _insert_details(conn, log_id: int, regulations: list, citations: list, thought: str):
+    """Writes the regulations, citations and thought of one analysis to their side tables."""
+    conn.executemany(
+        "INSERT OR REPLACE INTO analysis_regulations (log_id, position, regulation) VALUES (?, ?, ?)",
+        [(log_id, position, regulation) for position, regulation in enumerate(regulations)]
+    )
+    conn.executemany(
+        "INSERT OR REPLACE INTO analysis_citations (log_id, position, source) VALUES (?, ?, ?)",
+        [(log_id, position, source) for position, source in enumerate(citations)]
+    )
+    if thought:
+        conn.execute(
+            "INSERT OR REPLACE INTO analysis_thoughts (log_id, encoding, thought) VALUES (?, ?, ?)",
+            (log_id, *_encode_thought(thought))
+        )
+
+def _analysis_row(result_dict: dict, original_query: str) -> tuple:
+    """
+    Builds everything stored for one analysis, providing defaults for missing keys.
+
+    Returns:
+        tuple: (analysis_log parameters, regulations, citations, thought).
+    """
+    timestamp = datetime.datetime.now()
+    flag = result_dict.get('flag', 'Error')
+    reasoning = result_dict.get('reasoning', '')
+    regulations = [str(reg) for reg in result_dict.get('related_regulations', [])]
+    citations = [str(cite) for cite in result_dict.get('citations', [])]
+    thought = result_dict.get('thought', '')
+    expanded_query = result_dict.get('expanded_query', original_query)
+    status = 'pending_review' # All new entries require human review.
+    # Regulations and citations are also kept as comma-joined display text (shown in the UI
+    # and full-text indexed); the side tables are the authoritative, structured copy.
+    regulations_text = ", ".join(regulations)
+    citations_text = ", ".join(citations)
+    # Record which glossary terms were expanded so reviewers can audit the rewrite.
+    expanded_terms = ", ".join(result_dict.get('expanded_terms', []))
+    # Mark analyses served from the response cache ('exact' or 'semantic').
+    cache_hit = result_dict.get('cache_hit')
+    # Prompt token accounting (local estimates and Gemini's reported counts), as JSON.
+    token_usage = json.dumps(result_dict['token_usage']) if result_dict.get('token_usage') else None
+    # Concurrent identical requests share one analysis run; each still gets its own row.
+    run_id = result_dict.get('run_id')
+    params = (timestamp, original_query, expanded_query, flag, reasoning, regulations_text, status, citations_text, expanded_terms, cache_hit, token_usage, run_id)
+    return params, regulations, citations, thought
+
+@traced("db.insert_analyses")
+@retry_on_busy
+def _insert_analyses(rows: list) -> list:
+    """Inserts analyses built by _analysis_row in a single transaction and returns their new IDs."""
+    conn = get_connection()
+    ids = []
+    with conn:
+        for params, regulations, citations, thought in rows:
+            log_id = conn.execute(INSERT_ANALYSIS_SQL, params).lastrowid
+            _insert_details(conn, log_id, regulations, citations, thought)
+            ids.append(log_id)
+    return ids
+
+class BatchedAuditWriter:
+    """
+    Groups analysis_log inserts from concurrent requests into shared transactions.
+
+    Callers enqueue a row and block on a Future; a single writer thread drains the
+    queue, waiting at most WRITER_MAX_WAIT_SECONDS for up to WRITER_MAX_BATCH_SIZE
+    rows, commits them in one transaction, and resolves each caller's Future with
+    its row ID. Under concurrency this turns many fsyncs into one.
+    """
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._thread = None
+        # Held by submit while it checks for and enqueues to the thread, and by stop
+        # until the thread has exited, so no row is enqueued after the final flush.
+        self._lock = threading.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        with self._lock:
+            if not self.running:
+                self._thread = threading.Thread(target=self._run, name="audit-writer", daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        """Flushes pending rows and stops the writer thread."""
+        with self._lock:
+            if self.running:
+                self._queue.put(None)
+                self._thread.join()
+            self._thread = None
+
+    def submit(self, row: tuple) -> int:
+        """Inserts a row through the writer thread, or directly if it is not running."""
+        with self._lock:
+            future = None
+            if self.running:
+                future = Future()
+                self._queue.put((row, future))
+        if future is None:
+            return _insert_analyses([row])[0]
+        return future.result()
+
+    def _run(self):
+        try:
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    return
+                batch = [item]
+                deadline = time.monotonic() + WRITER_MAX_WAIT_SECONDS
+                stopping = False
+                while len(batch) < WRITER_MAX_BATCH_SIZE:
+                    remaining = deadline - time.monotonic()
+                    try:
+                        item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is None:
+                        stopping = True
+                        break
+                    batch.append(item)
+                try:
+                    ids = _insert_analyses([row for row, _ in batch])
+                    for (_, future), last_id in zip(batch, ids):
+                        future.set_result(last_id)
+                except Exception as e:
+                    for _, future in batch:
+                        future.set_exception(e)
+                if stopping:
+                    return
+        finally:
+            close_connection()
+
+_audit_writer = BatchedAuditWriter()
+
+def start_batched_writer():
+    """Routes save_analysis through the group-committing writer thread (e.g. in the API server)."""
+    _audit_writer.start()
+
+def stop_batched_writer():
+    """Flushes and stops the group-committing writer; save_analysis then writes directly."""
+    _audit_writer.stop()
+
+@traced("db.save_analysis")
 def save_analysis(result_dict: dict, original_query: str) -> int:
     """
     Saves the results of a single analysis to the 'analysis_log' table.
 
+    When the batched writer is running, the insert is group-committed with other
+    concurrent analyses; otherwise it is written directly.
+
     Args:
         result_dict (dict): A dictionary containing the analysis output from the model.
         original_query (str): The user's original, unmodified query string.
@@ -57,83 +515,213 @@ def save_analysis(result_dict: dict, original_query: str) -> int:
     """
     last_id = None
     try:
-        conn = sqlite3.connect(DATABASE_NAME)
-        cursor = conn.cursor()
-        
-        # Prepare data for insertion, providing default values for missing keys.
-        timestamp = datetime.datetime.now()
-        flag = result_dict.get('flag', 'Error')
-        reasoning = result_dict.get('reasoning', '')
-        # Serialize list of regulations into a comma-separated string for DB storage.
-        regulations = ", ".join(result_dict.get('related_regulations', []))
-        thought = result_dict.get('thought', '')
-        expanded_query = result_dict.get('expanded_query', original_query)
-        status = 'pending_review' # All new entries require human review.
-        # Serialize list of citations into a comma-separated string for DB storage.
-        citations = ", ".join(result_dict.get('citations', []))
-        
-        cursor.execute("""
-        INSERT INTO analysis_log (
-            timestamp, original_query, expanded_query, flag, reasoning, 
-            related_regulations, thought_process, status, citations
-        )
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (timestamp, original_query, expanded_query, flag, reasoning, regulations, thought, status, citations))
-        
-        last_id = cursor.lastrowid # Retrieve the primary key of the new record.
-        conn.commit()
+        row = _analysis_row(result_dict, original_query)
+        last_id = _audit_writer.submit(row)
         print(f"Successfully saved analysis (ID: {last_id}).")
     except sqlite3.Error as e:
         print(f"Failed to save analysis to database: {e}")
-    finally:
-        if conn:
-            conn.close()
     return last_id
 
 def fetch_all_logs() -> pd.DataFrame:
     """
     Fetches all records from the 'analysis_log' table and formats them into a pandas DataFrame.
 
+    Prefer fetch_logs_page or iter_logs for large audit tables; this loads every row.
+
     Returns:
         pd.DataFrame: A DataFrame containing the formatted log data, sorted by timestamp.
                       Returns an empty DataFrame on error or if no logs exist.
     """
-    conn = None
+    # Define a specific column order for consistent presentation in the UI.
+    column_order = [
+        'timestamp', 'original_query', 'flag', 'reasoning', 
+        'status', 'human_feedback', 'citations', 'related_regulations', 'expanded_terms'
+    ]
     try:
-        conn = sqlite3.connect(DATABASE_NAME)
-        # Fetch all data, ordering by the most recent entries first.
-        df = pd.read_sql_query("SELECT * FROM analysis_log ORDER BY timestamp DESC", conn)
-
-        # If the database is empty, return a correctly structured empty DataFrame.
-        if df.empty:
-            return pd.DataFrame(columns=[
-                'timestamp', 'original_query', 'flag', 'reasoning', 
-                'status', 'human_feedback', 'citations', 'related_regulations'
-            ])
-
-        # A helper function to derive a user-friendly feedback summary column.
-        def determine_feedback(row):
-            if row['status'] == 'approved': return 'Approved'
-            elif row['status'] == 'corrected': return row['human_feedback_reasoning'] if pd.notna(row['human_feedback_reasoning']) else ''
-            else: return ''
-        df['human_feedback'] = df.apply(determine_feedback, axis=1)
-
-        # Define a specific column order for consistent presentation in the UI.
-        column_order = [
-            'timestamp', 'original_query', 'flag', 'reasoning', 
-            'status', 'human_feedback', 'citations', 'related_regulations'
-        ]
-        
-        # Return only the specified columns in the desired order.
-        return df[column_order]
-
-    except (sqlite3.Error, pd.errors.DatabaseError) as e:
+        # human_feedback is computed in SQL by the paginated reader, not row by row in pandas.
+        return pd.DataFrame(list(iter_logs()), columns=LOG_COLUMNS)[column_order]
+    except sqlite3.Error as e:
         print(f"Error fetching logs from database: {e}")
         return pd.DataFrame() # Return an empty DataFrame on failure.
-    finally:
-        if conn:
-            conn.close()
 
+def encode_log_cursor(timestamp: str, log_id: int) -> str:
+    """Encodes the (timestamp, id) position of a log row as an opaque pagination cursor."""
+    return base64.urlsafe_b64encode(json.dumps([timestamp, log_id]).encode("utf-8")).decode("ascii")
+
+def decode_log_cursor(cursor: str) -> tuple:
+    """
+    Decodes a cursor produced by encode_log_cursor.
+
+    Raises:
+        ValueError: If the cursor is malformed.
+    """
+    try:
+        timestamp, log_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        return str(timestamp), int(log_id)
+    except (ValueError, TypeError, UnicodeError, binascii.Error) as e:
+        raise ValueError(f"Invalid cursor: {cursor!r}") from e
+
+def _escape_like(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+def _log_filters(status: str = None, flag: str = None, regulation: str = None, citation: str = None,
+                 start: str = None, end: str = None) -> tuple:
+    """Builds the WHERE clauses and parameters shared by the log listing and export."""
+    clauses, params = [], []
+    if status:
+        clauses.append("status = ?")
+        params.append(status)
+    if flag:
+        clauses.append("flag = ?")
+        params.append(flag)
+    # Regulation and citation filters are indexed lookups on the side tables.
+    if regulation:
+        clauses.append("id IN (SELECT log_id FROM analysis_regulations WHERE regulation = ?)")
+        params.append(regulation)
+    if citation:
+        # Citation sources are file paths; match either the full path or its file name.
+        clauses.append("id IN (SELECT log_id FROM analysis_citations WHERE source = ? OR source LIKE ? ESCAPE '\\')")
+        params.extend([citation, f"%/{_escape_like(citation)}"])
+    # Timestamps are stored as 'YYYY-MM-DD HH:MM:SS.ffffff', so ISO 'T' separators are normalized to compare correctly.
+    if start:
+        clauses.append("timestamp >= ?")
+        params.append(start.replace("T", " "))
+    if end:
+        clauses.append("timestamp < ?")
+        params.append(end.replace("T", " "))
+    return clauses, params
+
+@traced("db.fetch_logs_page")
+def fetch_logs_page(limit: int = DEFAULT_LOG_PAGE_SIZE, cursor: str = None, **filters) -> tuple:
+    """
+    Fetches one page of audit logs, newest first, using keyset pagination.
+
+    Rather than an OFFSET scan, each page starts strictly after the (timestamp, id)
+    position encoded in `cursor`, so every page costs the same regardless of depth
+    and rows inserted meanwhile never shift the pages that follow.
+
+    Args:
+        limit (int): Maximum rows to return, capped at MAX_LOG_PAGE_SIZE.
+        cursor (str, optional): The `next_cursor` returned with the previous page.
+        **filters: Optional status, flag, regulation, citation, start and end
+                   (ISO timestamps; start inclusive, end exclusive).
+
+    Returns:
+        tuple: (rows, next_cursor), where rows is a list of dictionaries with the
+               LOG_COLUMNS keys and next_cursor is None on the last page.
+
+    Raises:
+        ValueError: If the cursor is malformed.
+    """
+    limit = max(1, min(int(limit), MAX_LOG_PAGE_SIZE))
+    clauses, params = _log_filters(**filters)
+    if cursor:
+        clauses.append("(timestamp, id) < (?, ?)")
+        params.extend(decode_log_cursor(cursor))
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    # human_feedback is derived in SQL: 'Approved', the correction's reasoning, or ''.
+    query = f"""
+    SELECT id, timestamp, original_query, flag, reasoning, status,
+        CASE status
+            WHEN 'approved' THEN 'Approved'
+            WHEN 'corrected' THEN COALESCE(human_feedback_reasoning, '')
+            ELSE ''
+        END AS human_feedback,
+        citations, related_regulations, expanded_terms
+    FROM analysis_log
+    {where}
+    ORDER BY timestamp DESC, id DESC
+    LIMIT ?
+    """
+    rows = get_connection().execute(query, params + [limit + 1]).fetchall()
+    next_cursor = encode_log_cursor(rows[limit - 1][1], rows[limit - 1][0]) if len(rows) > limit else None
+    return [dict(zip(LOG_COLUMNS, row)) for row in rows[:limit]], next_cursor
+
+def iter_logs(batch_size: int = MAX_LOG_PAGE_SIZE, **filters):
+    """
+    Yields every audit log matching the filters, newest first, one page at a time.
+
+    Each page is an independent keyset query, so memory stays bounded by
+    `batch_size` and no read transaction is held open between pages.
+    """
+    cursor = None
+    while True:
+        rows, cursor = fetch_logs_page(limit=batch_size, cursor=cursor, **filters)
+        yield from rows
+        if cursor is None:
+            return
+
+def _quote_fts_query(query: str) -> str:
+    """Turns free text into an FTS5 query matching all of its words literally."""
+    return " ".join(f'"{token}"' for token in re.findall(r"\w+", query))
+
+@traced("db.search_logs")
+def search_logs(query: str, limit: int = DEFAULT_SEARCH_PAGE_SIZE, offset: int = 0,
+                start: str = None, end: str = None) -> tuple:
+    """
+    Full-text searches the audit log, best matches first.
+
+    The query uses FTS5 syntax, so auditors can write phrases ("florida hb3"),
+    OR / NOT and prefixes (verif*). Input that is not valid FTS5 syntax is
+    searched as plain words instead. Matches are ranked with bm25, weighting hits
+    in regulations and citations above hits in free text.
+
+    Args:
+        query (str): The search expression.
+        limit (int): Maximum results to return, capped at MAX_SEARCH_PAGE_SIZE.
+        offset (int): Number of ranked results to skip.
+        start (str, optional): Only include analyses at or after this ISO timestamp.
+        end (str, optional): Only include analyses before this ISO timestamp.
+
+    Returns:
+        tuple: (results, next_offset). Each result is a log record with a 'score'
+               (lower is better) and a 'snippet' whose matches are wrapped in
+               <mark> tags; next_offset is None on the last page.
+
+    Raises:
+        ValueError: If the query is empty or cannot be searched even as plain words.
+    """
+    if not query or not query.strip():
+        raise ValueError("Search query must not be empty.")
+    limit = max(1, min(int(limit), MAX_SEARCH_PAGE_SIZE))
+    offset = max(0, int(offset))
+    clauses, params = _log_filters(start=start, end=end)
+    where = "".join(f" AND l.{clause}" for clause in clauses)
+    weights = ", ".join(str(w) for w in FTS_COLUMN_WEIGHTS)
+    sql = f"""
+    SELECT l.id, l.timestamp, l.original_query, l.flag, l.reasoning, l.status,
+        CASE l.status
+            WHEN 'approved' THEN 'Approved'
+            WHEN 'corrected' THEN COALESCE(l.human_feedback_reasoning, '')
+            ELSE ''
+        END AS human_feedback,
+        l.citations, l.related_regulations, l.expanded_terms,
+        bm25(analysis_log_fts, {weights}) AS score,
+        snippet(analysis_log_fts, -1, '<mark>', '</mark>', '…', 16) AS snippet
+    FROM analysis_log_fts
+    JOIN analysis_log AS l ON l.id = analysis_log_fts.rowid
+    WHERE analysis_log_fts MATCH ?{where}
+    ORDER BY score
+    LIMIT ? OFFSET ?
+    """
+    conn = get_connection()
+    try:
+        rows = conn.execute(sql, [query] + params + [limit + 1, offset]).fetchall()
+    except sqlite3.OperationalError:
+        # FTS5 reports malformed input in many ways ("syntax error", "no such column: x"
+        # for "age-sensitive" or "age:13", "unterminated string"), so any failure of the
+        # raw query is retried once with every word quoted.
+        literal_query = _quote_fts_query(query)
+        if not literal_query:
+            return [], None
+        try:
+            rows = conn.execute(sql, [literal_query] + params + [limit + 1, offset]).fetchall()
+        except sqlite3.OperationalError as e:
+            raise ValueError(f"Could not search for '{query}': {e}") from e
+    results = [dict(zip(LOG_COLUMNS + ['score', 'snippet'], row)) for row in rows[:limit]]
+    return results, offset + limit if len(rows) > limit else None
+
+@traced("db.update_feedback")
 def update_feedback(log_id: int, status: str, corrected_flag: str = None, corrected_reasoning: str = None):
     """
     Updates a specific log entry with human-provided feedback.
@@ -144,86 +732,225 @@ def update_feedback(log_id: int, status: str, corrected_flag: str = None, correc
         corrected_flag (str, optional): The corrected flag, if applicable.
         corrected_reasoning (str, optional): The corrected reasoning, if applicable.
     """
-    conn = None
+    @retry_on_busy
+    def write():
+        conn = get_connection()
+        with conn:
+            conn.execute("""
+            UPDATE analysis_log 
+            SET status = ?, human_feedback_flag = ?, human_feedback_reasoning = ?
+            WHERE id = ?
+            """, (status, corrected_flag, corrected_reasoning, log_id))
+            _bump_feedback_generation(conn)
+
     try:
-        conn = sqlite3.connect(DATABASE_NAME)
-        cursor = conn.cursor()
-        cursor.execute("""
-        UPDATE analysis_log 
-        SET status = ?, human_feedback_flag = ?, human_feedback_reasoning = ?
-        WHERE id = ?
-        """, (status, corrected_flag, corrected_reasoning, log_id))
-        conn.commit()
+        write()
     except sqlite3.Error as e:
         print(f"Error updating feedback in database: {e}")
-    finally:
-        if conn: conn.close()
+        return
+    # Notify listeners only once the feedback is durably stored.
+    _notify_feedback_listeners(log_id, status)
         
+# Columns describing a human correction, as read by the few-shot helpers below.
+CORRECTION_COLUMNS = "id, original_query, expanded_query, human_feedback_flag, human_feedback_reasoning"
+
+def _with_details(conn, rows: list) -> list:
+    """Appends each row's regulations and citations lists (read from the side tables)."""
+    ids = [row[0] for row in rows]
+    regulations = {log_id: [] for log_id in ids}
+    citations = {log_id: [] for log_id in ids}
+    # Chunk the IN lists to stay well below SQLite's bound-parameter limit.
+    for start in range(0, len(ids), 500):
+        chunk = ids[start:start + 500]
+        marks = ", ".join("?" * len(chunk))
+        for log_id, regulation in conn.execute(
+            f"SELECT log_id, regulation FROM analysis_regulations WHERE log_id IN ({marks}) ORDER BY log_id, position", chunk
+        ):
+            regulations[log_id].append(regulation)
+        for log_id, source in conn.execute(
+            f"SELECT log_id, source FROM analysis_citations WHERE log_id IN ({marks}) ORDER BY log_id, position", chunk
+        ):
+            citations[log_id].append(source)
+    return [tuple(row) + (regulations[row[0]], citations[row[0]]) for row in rows]
+
+def correction_example(row: tuple) -> dict:
+    """
+    Formats a correction row (CORRECTION_COLUMNS plus the regulations and citations
+    lists) as a few-shot example for the prompt.
+
+    Returns:
+        dict: {"feature": ..., "correct_analysis": ...}, with the corrected analysis
+              serialized as indented JSON.
+    """
+    correct_analysis = {
+        "flag": row[3],
+        "reasoning": row[4],
+        "related_regulations": list(row[5]),
+        "citations": list(row[6])
+    }
+    return {
+        "feature": row[1],
+        "correct_analysis": json.dumps(correct_analysis, indent=4)
+    }
+
+@traced("db.fetch_corrections")
+def fetch_corrections(log_id: int = None) -> list:
+    """
+    Fetches human-corrected analyses as rows of CORRECTION_COLUMNS followed by their
+    regulations and citations lists.
+
+    Args:
+        log_id (int, optional): Only fetch this row (if it is a correction).
+
+    Returns:
+        list: Row tuples, oldest first.
+
+    Raises:
+        sqlite3.Error: If the query fails.
+    """
+    query = f"SELECT {CORRECTION_COLUMNS} FROM analysis_log WHERE status = 'corrected'"
+    params = ()
+    if log_id is not None:
+        query += " AND id = ?"
+        params = (log_id,)
+    conn = get_connection()
+    return _with_details(conn, conn.execute(query + " ORDER BY timestamp, id", params).fetchall())
+
+@traced("db.fetch_corrected_examples")
 def fetch_corrected_examples(n_examples: int = 2) -> list:
     """
-    Fetches a diverse set of human-corrected examples for use in few-shot prompting.
+    Fetches a diverse set of recent human-corrected examples for use in few-shot prompting.
     
-    This function retrieves the most recent 'corrected' entry for both 'Yes' and 'No' flags
-    to provide the model with varied, high-quality examples.
+    Examples alternate between the corrected flags ('Yes', 'No', ...), newest first
+    within each flag, so the model sees varied, high-quality examples. This is the
+    recency-based fallback used when the corrections index cannot be loaded; normally
+    the most similar corrections are picked through the index instead.
 
     Args:
-        n_examples (int): The number of diverse examples to fetch (currently hardcoded to 2).
+        n_examples (int): The maximum number of examples to fetch.
 
     Returns:
         list: A list of formatted example dictionaries, ready for use in a prompt.
               Returns an empty list on error.
     """
-    examples = []
-    conn = None
     try:
-        conn = sqlite3.connect(DATABASE_NAME)
-        cursor = conn.cursor()
-
-        # Query for the most recent corrected example where the human feedback was 'Yes'.
-        cursor.execute("""
-        SELECT original_query, human_feedback_flag, human_feedback_reasoning, related_regulations, citations
-        FROM analysis_log
-        WHERE status = 'corrected' AND human_feedback_flag = 'Yes'
-        ORDER BY timestamp DESC
-        LIMIT 1
-        """)
-        yes_example = cursor.fetchone()
-
-        # Query for the most recent corrected example where the human feedback was 'No'.
-        cursor.execute("""
-        SELECT original_query, human_feedback_flag, human_feedback_reasoning, related_regulations, citations
-        FROM analysis_log
-        WHERE status = 'corrected' AND human_feedback_flag = 'No'
-        ORDER BY timestamp DESC
-        LIMIT 1
-        """)
-        no_example = cursor.fetchone()
-        
-        # Process the fetched rows into a structured dictionary format.
-        for row in [yes_example, no_example]:
-            if row:
-                # Reconstruct the dictionary, deserializing string fields back into lists.
-                correct_analysis = {
-                    "flag": row[1],
-                    "reasoning": row[2],
-                    "related_regulations": [reg.strip() for reg in row[3].split(',')] if row[3] else [],
-                    "citations": [cite.strip() for cite in row[4].split(',')] if row[4] else []
-                }
-                # Format the final output structure for the few-shot prompt.
-                examples.append({
-                    "feature": row[0],
-                    "correct_analysis": json.dumps(correct_analysis, indent=4)
-                })
-
+        # Rank corrections within each flag by recency, then interleave the flags.
+        rows = get_connection().execute(f"""
+        SELECT {CORRECTION_COLUMNS} FROM (
+            SELECT *, ROW_NUMBER() OVER (PARTITION BY human_feedback_flag ORDER BY timestamp DESC, id DESC) AS flag_rank
+            FROM analysis_log
+            WHERE status = 'corrected'
+        )
+        ORDER BY flag_rank, human_feedback_flag DESC
+        LIMIT ?
+        """, (n_examples,)).fetchall()
+        examples = [correction_example(row) for row in _with_details(get_connection(), rows)]
         print(f"Fetched {len(examples)} corrected examples for few-shot prompting.")
         return examples
         
     except sqlite3.Error as e:
         print(f"Error fetching corrected examples from database: {e}")
         return []
-    finally:
-        if conn:
-            conn.close()
+
+@traced("db.fetch_analysis_details")
+def fetch_analysis_details(log_id: int):
+    """
+    Fetches the structured details of one analysis.
+
+    Returns:
+        dict or None: {"id", "related_regulations", "citations", "thought", "token_usage",
+                      "run_id", "shared_with"}, or None if the analysis does not exist.
+                      shared_with lists the other analyses produced by the same run.
+
+    Raises:
+        sqlite3.Error: If the query fails.
+    """
+    conn = get_connection()
+    row = conn.execute("SELECT id, thought_process, token_usage, run_id FROM analysis_log WHERE id = ?", (log_id,)).fetchone()
+    if row is None:
+        return None
+    stored = conn.execute("SELECT encoding, thought FROM analysis_thoughts WHERE log_id = ?", (log_id,)).fetchone()
+    _, regulations, citations = _with_details(conn, [(log_id,)])[0]
+    return {
+        "id": log_id,
+        "related_regulations": regulations,
+        "citations": citations,
+        # Rows that were never migrated still carry their thought inline.
+        "thought": _decode_thought(*stored) if stored else (row[1] or ""),
+        "token_usage": json.loads(row[2]) if row[2] else None,
+        "run_id": row[3],
+        "shared_with": [r[0] for r in conn.execute(
+            "SELECT id FROM analysis_log WHERE run_id = ? AND id != ? ORDER BY id", (row[3], log_id)
+        )] if row[3] else [],
+    }
+
+@traced("db.regulation_flag_counts")
+def regulation_flag_counts(start: str = None, end: str = None) -> list:
+    """
+    Counts analyses per regulation and flag, most-cited regulations first.
+
+    Args:
+        start (str, optional): Only count analyses at or after this ISO timestamp.
+        end (str, optional): Only count analyses before this ISO timestamp.
+
+    Returns:
+        list: Dictionaries with 'regulation', 'flag' and 'count'.
+
+    Raises:
+        sqlite3.Error: If the query fails.
+    """
+    clauses, params = _log_filters(start=start, end=end)
+    where = f"WHERE {' AND '.join('l.' + clause for clause in clauses)}" if clauses else ""
+    # Grouping walks idx_analysis_regulations_regulation in order and probes analysis_log by primary key.
+    rows = get_connection().execute(f"""
+    SELECT r.regulation, l.flag, COUNT(*) AS count
+    FROM analysis_regulations AS r
+    JOIN analysis_log AS l ON l.id = r.log_id
+    {where}
+    GROUP BY r.regulation, l.flag
+    """, params).fetchall()
+    totals = {}
+    for regulation, _, count in rows:
+        totals[regulation] = totals.get(regulation, 0) + count
+    rows.sort(key=lambda row: (-totals[row[0]], row[0], -row[2]))
+    return [{"regulation": regulation, "flag": flag, "count": count} for regulation, flag, count in rows]
+
+@traced("db.citation_counts")
+def citation_counts(start: str = None, end: str = None) -> list:
+    """
+    Counts the analyses citing each source, most-cited first.
+
+    Args:
+        start (str, optional): Only count analyses at or after this ISO timestamp.
+        end (str, optional): Only count analyses before this ISO timestamp.
+
+    Returns:
+        list: Dictionaries with 'source' and 'count'.
+
+    Raises:
+        sqlite3.Error: If the query fails.
+    """
+    clauses, params = _log_filters(start=start, end=end)
+    if clauses:
+        where = f"WHERE {' AND '.join('l.' + clause for clause in clauses)}"
+        sql = f"""
+        SELECT c.source, COUNT(DISTINCT c.log_id) AS count
+        FROM analysis_citations AS c
+        JOIN analysis_log AS l ON l.id = c.log_id
+        {where}
+        GROUP BY c.source
+        ORDER BY count DESC, c.source
+        """
+    else:
+        # Without a date range the count is answered from idx_analysis_citations_source alone.
+        sql = """
+        SELECT source, COUNT(DISTINCT log_id) AS count
+        FROM analysis_citations
+        GROUP BY source
+        ORDER BY count DESC, source
+        """
+    rows = get_connection().execute(sql, params).fetchall()
+    return [{"source": source, "count": count} for source, count in rows]
 
 def reset_database():
     """
@@ -232,16 +959,22 @@ def reset_database():
     Warning: This is a destructive operation and will result in the loss of all logged data.
     It should be used with caution, primarily for testing or development purposes.
     """
-    conn = None
     try:
-        conn = sqlite3.connect(DATABASE_NAME)
-        cursor = conn.cursor()
-        cursor.execute("DROP TABLE IF EXISTS analysis_log")
-        conn.commit()
+        conn = get_connection()
+        with conn:
+            conn.execute("DROP TABLE IF EXISTS analysis_log")
+            conn.execute("DROP TABLE IF EXISTS analysis_log_fts")
+            for table in ("analysis_regulations", "analysis_citations", "analysis_thoughts"):
+                conn.execute(f"DROP TABLE IF EXISTS {table}")
         print("Database has been reset.")
     except sqlite3.Error as e:
         print(f"Error resetting database: {e}")
-    finally:
-        if conn: conn.close()
     # Re-create the table with the correct schema after dropping it.
-    init_db()
\ No newline at end of file
+    init_db()
+    try:
+        conn = get_connection()
+        with conn:
+            _bump_feedback_generation(conn)
+    except sqlite3.Error as e:
+        print(f"Error updating feedback generation: {e}")
+    _notify_feedback_listeners(None, None)
\ No newline at end of file
@@ -0,0 +1,227 @@
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+
+# --- Configuration ---
+# Default sentence-embedding model for the whole application.
+DEFAULT_MODEL_NAME = "all-MiniLM-L6-v2"
+# Selects the runtime that computes embeddings: "torch" (sentence-transformers, fp32),
+# "onnx" (ONNX Runtime, fp32) or "onnx-int8" (ONNX Runtime, dynamically quantized).
+DEFAULT_BACKEND = "torch"
+# Directory holding the exported ONNX model (model.onnx, model_int8.onnx, tokenizer.json).
+DEFAULT_ONNX_DIR = os.path.join("onnx_models", DEFAULT_MODEL_NAME)
+# Maximum tokens per text; matches the sentence-transformers setting for this model.
+MAX_SEQ_LENGTH = 256
+# Texts per forward pass.
+DEFAULT_BATCH_SIZE = 64
+# Minimum cosine similarity to the torch model a backend must reach in the parity check.
+DEFAULT_PARITY_THRESHOLD = 0.99
+
+ONNX_FILES = {"onnx": "model.onnx", "onnx-int8": "model_int8.onnx"}
+TOKENIZER_FILE = "tokenizer.json"
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+class TorchEmbedder:
+    """The reference backend: the sentence-transformers model on PyTorch (fp32, CPU)."""
+
+    def __init__(self, model_name: str = DEFAULT_MODEL_NAME, threads: int = None):
+        # Imported here so the ONNX backends never pay for importing torch.
+        import torch
+        from sentence_transformers import SentenceTransformer
+        if threads:
+            torch.set_num_threads(threads)
+        self.model_name = model_name
+        self.backend = "torch"
+        self.model = SentenceTransformer(model_name, device="cpu")
+
+    def encode(self, sentences, batch_size: int = DEFAULT_BATCH_SIZE, **kwargs):
+        """Mirrors SentenceTransformer.encode: a str gives a 1-D vector, a list a 2-D array."""
+        return self.model.encode(sentences, batch_size=batch_size, convert_to_numpy=True)
+
+
+class OnnxEmbedder:
+    """
+    Runs an exported copy of the model on ONNX Runtime, without importing torch.
+
+    Tokenization uses the standalone `tokenizers` library and the token embeddings
+    are mean-pooled and L2-normalized exactly like the sentence-transformers
+    pipeline of all-MiniLM-L6-v2, so vectors are interchangeable with the torch
+    backend (see the parity check below).
+    """
+
+    def __init__(self, model_dir: str = None, quantized: bool = False, threads: int = None,
+                 model_name: str = DEFAULT_MODEL_NAME):
+        try:
+            import onnxruntime
+            from tokenizers import Tokenizer
+        except ImportError as e:
+            raise ImportError("The ONNX embedding backends need the 'onnxruntime' and 'tokenizers' packages.") from e
+        self.model_name = model_name
+        self.backend = "onnx-int8" if quantized else "onnx"
+        model_dir = model_dir or os.getenv("ONNX_MODEL_DIR", DEFAULT_ONNX_DIR)
+        model_path = os.path.join(model_dir, ONNX_FILES[self.backend])
+        if not os.path.exists(model_path):
+            raise FileNotFoundError(
+                f"No exported model at '{model_path}'. Run: python embedding_backend.py export"
+            )
+
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_dir, TOKENIZER_FILE))
+        self.tokenizer.enable_truncation(max_length=MAX_SEQ_LENGTH)
+        self.tokenizer.enable_padding(pad_id=0, pad_token="[PAD]")
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        threads = threads or int(os.getenv("ONNX_THREADS", "0"))
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+        self._input_names = {i.name for i in self.session.get_inputs()}
+
+    def _encode_batch(self, texts: list) -> np.ndarray:
+        encodings = self.tokenizer.encode_batch(texts)
+        input_ids = np.array([e.ids for e in encodings], dtype=np.int64)
+        attention_mask = np.array([e.attention_mask for e in encodings], dtype=np.int64)
+        feeds = {"input_ids": input_ids, "attention_mask": attention_mask}
+        if "token_type_ids" in self._input_names:
+            feeds["token_type_ids"] = np.array([e.type_ids for e in encodings], dtype=np.int64)
+        token_embeddings = self.session.run(None, feeds)[0]
+        # Mean pooling over real (non-padding) tokens, then L2 normalization.
+        mask = attention_mask[:, :, None].astype(np.float32)
+        pooled = (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        return _normalize(pooled.astype(np.float32))
+
+    def encode(self, sentences, batch_size: int = DEFAULT_BATCH_SIZE, **kwargs):
+        """Mirrors SentenceTransformer.encode: a str gives a 1-D vector, a list a 2-D array."""
+        single = isinstance(sentences, str)
+        texts = [sentences] if single else list(sentences)
+        if not texts:
+            return np.zeros((0, 0), dtype=np.float32)
+        vectors = np.vstack([self._encode_batch(texts[i:i + batch_size]) for i in range(0, len(texts), batch_size)])
+        return vectors[0] if single else vectors
+
+
+def load_embedder(backend: str = None, model_name: str = DEFAULT_MODEL_NAME, threads: int = None):
+    """
+    Creates the embedding backend selected by `backend` or the EMBEDDING_BACKEND variable.
+
+    Raises:
+        ValueError: For an unknown backend name.
+    """
+    backend = (backend or selected_backend()).lower()
+    if backend == "torch":
+        return TorchEmbedder(model_name, threads=threads)
+    if backend in ONNX_FILES:
+        return OnnxEmbedder(quantized=backend == "onnx-int8", threads=threads, model_name=model_name)
+    raise ValueError(f"Unknown EMBEDDING_BACKEND '{backend}'. Expected 'torch', 'onnx' or 'onnx-int8'.")
+
+
+def selected_backend() -> str:
+    """Returns the backend name configured through EMBEDDING_BACKEND."""
+    return os.getenv("EMBEDDING_BACKEND", DEFAULT_BACKEND).lower()
+
+
+def cache_namespace(model_name: str, backend: str = None) -> str:
+    """
+    Name under which a backend's vectors are stored in the embedding cache.
+
+    Torch keeps the plain model name (so existing caches stay valid); the ONNX
+    variants get their own namespace, since their vectors differ slightly.
+    """
+    backend = backend or selected_backend()
+    return model_name if backend == "torch" else f"{model_name}@{backend}"
+
+
+# --- Export and parity check (command line) ---
+
+def export_onnx(model_name: str = DEFAULT_MODEL_NAME, output_dir: str = DEFAULT_ONNX_DIR):
+    """Exports the transformer to ONNX and writes an int8 dynamically quantized copy next to it."""
+    import torch
+    from sentence_transformers import SentenceTransformer
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+
+    os.makedirs(output_dir, exist_ok=True)
+    transformer = SentenceTransformer(model_name, device="cpu")[0]
+    model, tokenizer = transformer.auto_model.eval(), transformer.tokenizer
+    tokenizer.save_pretrained(output_dir)
+
+    sample = tokenizer(["an example sentence"], return_tensors="pt")
+    input_names = [name for name in ("input_ids", "attention_mask", "token_type_ids") if name in sample]
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names}
+    dynamic_axes["last_hidden_state"] = {0: "batch", 1: "sequence"}
+    fp32_path = os.path.join(output_dir, ONNX_FILES["onnx"])
+    with torch.no_grad():
+        torch.onnx.export(
+            model, tuple(sample[name] for name in input_names), fp32_path,
+            input_names=input_names, output_names=["last_hidden_state"],
+            dynamic_axes=dynamic_axes, opset_version=14
+        )
+    quantize_dynamic(fp32_path, os.path.join(output_dir, ONNX_FILES["onnx-int8"]), weight_type=QuantType.QInt8)
+    print(f"Exported '{model_name}' to '{output_dir}' (fp32 and int8).")
+
+
+def _knowledge_base_texts(index_dir: str, kb_dir: str) -> list:
+    """Chunk texts of the local vector index, or paragraphs of the knowledge base files as a fallback."""
+    chunks_path = os.path.join(index_dir, "chunks.jsonl")
+    if os.path.exists(chunks_path):
+        with open(chunks_path, encoding="utf-8") as f:
+            return [json.loads(line)["document"] for line in f]
+    texts = []
+    for root, _, files in os.walk(kb_dir):
+        for name in sorted(files):
+            if name.endswith(".txt"):
+                with open(os.path.join(root, name), encoding="utf-8") as f:
+                    texts += [p.strip() for p in f.read().split("\n\n") if p.strip()]
+    return texts
+
+
+def parity_check(backend: str, threshold: float = DEFAULT_PARITY_THRESHOLD, index_dir: str = None,
+                 kb_dir: str = "knowledge_base", limit: int = None) -> bool:
+    """
+    Compares a backend's embeddings with the torch model's on the knowledge base.
+
+    Returns:
+        bool: True if every text's cosine similarity reaches `threshold`.
+    """
+    texts = _knowledge_base_texts(index_dir or os.getenv("LOCAL_INDEX_DIR", "vector_index"), kb_dir)[:limit]
+    if not texts:
+        print("No knowledge-base texts found for the parity check.")
+        return False
+    results = {}
+    for name in ("torch", backend):
+        embedder = load_embedder(name)
+        embedder.encode(texts[:8])  # Warm-up, so one-off initialization is not timed.
+        started = time.perf_counter()
+        results[name] = _normalize(np.asarray(embedder.encode(texts), dtype=np.float32))
+        elapsed = time.perf_counter() - started
+        print(f"{name:>10}: {len(texts)} texts in {elapsed:.2f}s ({elapsed / len(texts) * 1000:.2f} ms/text)")
+    cosines = np.sum(results["torch"] * results[backend], axis=1)
+    print(f"Cosine similarity vs torch: min {cosines.min():.5f}, mean {cosines.mean():.5f}, "
+          f"p1 {np.percentile(cosines, 1):.5f}")
+    passed = bool(cosines.min() >= threshold)
+    print(f"Parity check {'passed' if passed else 'FAILED'} (threshold {threshold}).")
+    return passed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage the embedding runtime backends.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    export_parser = commands.add_parser("export", help="export the model to ONNX (fp32 and int8)")
+    export_parser.add_argument("--output-dir", default=DEFAULT_ONNX_DIR)
+    parity_parser = commands.add_parser("parity", help="compare a backend with the torch model")
+    parity_parser.add_argument("--backend", default="onnx-int8", choices=sorted(ONNX_FILES))
+    parity_parser.add_argument("--threshold", type=float, default=DEFAULT_PARITY_THRESHOLD)
+    parity_parser.add_argument("--limit", type=int, default=None, help="only check the first N texts")
+    args = parser.parse_args()
+    if args.command == "export":
+        export_onnx(output_dir=args.output_dir)
+    else:
+        sys.exit(0 if parity_check(args.backend, args.threshold, limit=args.limit) else 1)
@@ -0,0 +1,182 @@
+import os
+import hashlib
+import sqlite3
+import threading
+import unicodedata
+from collections import OrderedDict
+import numpy as np
+
+# --- Configuration ---
+# SQLite file backing the persistent tier of the embedding cache.
+DEFAULT_CACHE_DB = "embedding_cache.db"
+# Maximum number of vectors kept in the in-memory LRU tier per model.
+DEFAULT_MEMORY_ITEMS = 4096
+
+
+def normalize_text(text: str) -> str:
+    """Canonicalizes text before hashing so trivially different inputs share a cache entry."""
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+def cache_key(model_name: str, text: str) -> str:
+    """Returns the content address of a text's embedding under a given model."""
+    return hashlib.sha256(f"{model_name}\0{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    A two-tier, content-addressed cache of text embeddings for a single model.
+
+    Lookups go to an in-memory LRU first and then to an on-disk SQLite store. Only
+    texts missing from both tiers are passed to the (expensive) compute function,
+    in a single batch, and the results are written back to both tiers.
+    """
+
+    def __init__(self, model_name: str, db_path: str = None, max_memory_items: int = None):
+        self.model_name = model_name
+        self.db_path = db_path or os.getenv("EMBEDDING_CACHE_DB", DEFAULT_CACHE_DB)
+        self.max_memory_items = max_memory_items or int(os.getenv("EMBEDDING_CACHE_MEMORY_ITEMS", DEFAULT_MEMORY_ITEMS))
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._memory_hits = 0
+        self._disk_hits = 0
+        self._misses = 0
+
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+        CREATE TABLE IF NOT EXISTS embeddings (
+            key TEXT PRIMARY KEY,
+            model TEXT NOT NULL,
+            dim INTEGER NOT NULL,
+            vector BLOB NOT NULL
+        )
+        """)
+        self._conn.commit()
+
+    def _remember(self, key: str, vector: np.ndarray):
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_items:
+            self._memory.popitem(last=False)
+
+    def get_many(self, texts: list, compute_fn) -> list:
+        """
+        Returns one embedding per text, computing only the ones not already cached.
+
+        Args:
+            texts (list): The texts to embed.
+            compute_fn: Callable taking a list of texts and returning their embeddings
+                        in the same order.
+
+        Returns:
+            list: float32 NumPy vectors, aligned with `texts`.
+        """
+        keys = [cache_key(self.model_name, text) for text in texts]
+        results = [None] * len(texts)
+        missing = {}
+
+        with self._lock:
+            for i, key in enumerate(keys):
+                vector = self._memory.get(key)
+                if vector is not None:
+                    self._memory.move_to_end(key)
+                    self._memory_hits += 1
+                    results[i] = vector
+                else:
+                    missing.setdefault(key, []).append(i)
+
+            if missing:
+                # Look the remaining keys up in the on-disk tier in one round-trip per 500 keys.
+                pending = list(missing)
+                for start in range(0, len(pending), 500):
+                    batch = pending[start:start + 500]
+                    placeholders = ",".join("?" * len(batch))
+                    rows = self._conn.execute(
+                        f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", batch
+                    ).fetchall()
+                    for key, blob in rows:
+                        vector = np.frombuffer(blob, dtype=np.float32)
+                        self._remember(key, vector)
+                        for i in missing.pop(key):
+                            results[i] = vector
+                            self._disk_hits += 1
+
+        if missing:
+            # Compute each distinct missing text once, even if it appears several times.
+            to_compute = [texts[positions[0]] for positions in missing.values()]
+            computed = compute_fn(to_compute)
+            with self._lock:
+                rows = []
+                for (key, positions), vector in zip(missing.items(), computed):
+                    vector = np.asarray(vector, dtype=np.float32).reshape(-1)
+                    self._remember(key, vector)
+                    rows.append((key, self.model_name, vector.shape[0], vector.tobytes()))
+                    for i in positions:
+                        results[i] = vector
+                    self._misses += len(positions)
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO embeddings (key, model, dim, vector) VALUES (?, ?, ?, ?)", rows
+                )
+                self._conn.commit()
+        return results
+
+    def get(self, text: str, compute_fn) -> np.ndarray:
+        """Returns the embedding of a single text; see get_many."""
+        return self.get_many([text], compute_fn)[0]
+
+    def stats(self) -> dict:
+        """Returns hit/miss counters and hit rates for this cache since process start."""
+        with self._lock:
+            hits = self._memory_hits + self._disk_hits
+            total = hits + self._misses
+            return {
+                "model": self.model_name,
+                "memory_hits": self._memory_hits,
+                "disk_hits": self._disk_hits,
+                "misses": self._misses,
+                "hit_rate": hits / total if total else 0.0,
+                "memory_items": len(self._memory),
+            }
+
+
+class CachedEncoder:
+    """
+    Drop-in wrapper around a SentenceTransformer-like model whose encode() is cached.
+
+    encode(str) returns a 1-D vector and encode(list) returns a 2-D array, matching
+    SentenceTransformer.encode, so existing `.encode(text).tolist()` call sites keep working.
+    """
+
+    def __init__(self, model, model_name: str, cache: EmbeddingCache = None):
+        self.model = model
+        self.model_name = model_name
+        self.cache = cache or get_embedding_cache(model_name)
+
+    def encode(self, sentences, **kwargs):
+        single = isinstance(sentences, str)
+        texts = [sentences] if single else list(sentences)
+        vectors = self.cache.get_many(texts, lambda batch: self.model.encode(batch, **kwargs))
+        return vectors[0] if single else np.vstack(vectors) if vectors else np.zeros((0, 0), dtype=np.float32)
+
+
+# --- Process-wide caches, one per model ---
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_embedding_cache(model_name: str) -> EmbeddingCache:
+    """Returns the shared EmbeddingCache for a model, creating it on first use."""
+    with _caches_lock:
+        cache = _caches.get(model_name)
+        if cache is None:
+            cache = EmbeddingCache(model_name)
+            _caches[model_name] = cache
+        return cache
+
+
+def get_cache_stats() -> list:
+    """Returns the statistics of every embedding cache created in this process."""
+    with _caches_lock:
+        caches = list(_caches.values())
+    return [cache.stats() for cache in caches]
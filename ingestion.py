@@ -0,0 +1,194 @@
+import os
+import time
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import numpy as np
+
+from embedding_cache import get_embedding_cache
+from embedding_backend import load_embedder, cache_namespace, selected_backend
+
+# --- Configuration ---
+# Number of chunks embedded per batch (and sent to the vector store per write).
+DEFAULT_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "256"))
+# Number of embedding worker processes; defaults to one per available core.
+DEFAULT_WORKERS = int(os.getenv("INGEST_WORKERS", "0")) or (
+    len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1
+)
+# Batches allowed in flight per worker, which bounds memory regardless of corpus size.
+BATCHES_IN_FLIGHT_PER_WORKER = 2
+# Batches buffered between the embedder and the vector-store writer thread.
+WRITE_QUEUE_BATCHES = 4
+# Seconds between two throughput reports.
+PROGRESS_INTERVAL_SECONDS = 5.0
+
+
+# --- Worker process state ---
+_worker_model = None
+
+
+def _init_worker(model_name: str, backend: str, threads: int):
+    """Loads the embedding backend once per worker process."""
+    global _worker_model
+    # Each process gets a share of the cores, so the pool does not oversubscribe the CPU.
+    _worker_model = load_embedder(backend, model_name, threads=threads)
+
+
+def _embed_in_worker(texts: list) -> np.ndarray:
+    return np.asarray(_worker_model.encode(texts, batch_size=64), dtype=np.float32)
+
+
+def batched(iterable, size: int):
+    """Yields lists of up to `size` consecutive items from any iterable."""
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class EmbeddingPipeline:
+    """
+    Embeds a stream of chunks in bounded batches across a pool of worker processes.
+
+    Each batch is first resolved against the shared embedding cache; only cache
+    misses are sent to a worker. At most `workers * BATCHES_IN_FLIGHT_PER_WORKER`
+    batches are outstanding at any time, so memory stays flat however long the
+    input stream is. Batches are yielded in input order.
+
+    Use as a context manager so the worker processes are shut down afterwards.
+    """
+
+    def __init__(self, model_name: str, workers: int = None, batch_size: int = None, backend: str = None):
+        self.model_name = model_name
+        self.backend = backend or selected_backend()
+        self.workers = max(1, workers or DEFAULT_WORKERS)
+        self.batch_size = batch_size or DEFAULT_BATCH_SIZE
+        self.cache = get_embedding_cache(cache_namespace(model_name, self.backend))
+        self._processes = None
+        self._threads = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _ensure_pool(self):
+        # Worker processes are only started once something actually misses the cache.
+        if self._processes is None:
+            cores = os.cpu_count() or 1
+            print(f"Starting {self.workers} embedding worker process(es) ({self.backend} backend)...")
+            self._processes = ProcessPoolExecutor(
+                max_workers=self.workers,
+                initializer=_init_worker,
+                initargs=(self.model_name, self.backend, max(1, cores // self.workers))
+            )
+        return self._processes
+
+    def _compute(self, texts: list) -> np.ndarray:
+        return self._ensure_pool().submit(_embed_in_worker, texts).result()
+
+    def _embed_batch(self, texts: list) -> list:
+        return self.cache.get_many(texts, self._compute)
+
+    def embed(self, records):
+        """
+        Embeds (chunk_id, text, metadata) records.
+
+        Args:
+            records: Any iterable of (chunk_id, text, metadata) tuples; it is consumed lazily.
+
+        Yields:
+            tuple: (records_batch, vectors) for consecutive batches, where vectors is a
+                   float32 array with one row per record.
+        """
+        if self._threads is None:
+            # Cache lookups and result handling run on threads that wait on the process pool.
+            self._threads = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="ingest-embed")
+        in_flight = deque()
+        limit = self.workers * BATCHES_IN_FLIGHT_PER_WORKER
+        for batch in batched(records, self.batch_size):
+            in_flight.append((batch, self._threads.submit(self._embed_batch, [record[1] for record in batch])))
+            if len(in_flight) >= limit:
+                done, future = in_flight.popleft()
+                yield done, np.vstack(future.result())
+        while in_flight:
+            done, future = in_flight.popleft()
+            yield done, np.vstack(future.result())
+
+    def close(self):
+        if self._threads is not None:
+            self._threads.shutdown()
+            self._threads = None
+        if self._processes is not None:
+            self._processes.shutdown()
+            self._processes = None
+
+
+class BackgroundWriter:
+    """
+    Runs vector-store writes on a background thread, overlapping them with embedding.
+
+    put() hands a batch to the writer thread through a bounded queue (blocking when
+    the store falls behind), and close() waits for all writes and re-raises the
+    first error they hit.
+    """
+
+    def __init__(self, write_fn, name: str = "ingest-writer"):
+        self.write_fn = write_fn
+        self._queue = queue.Queue(maxsize=WRITE_QUEUE_BATCHES)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = self._queue.get()
+            if batch is None:
+                return
+            if self._error is None:
+                try:
+                    self.write_fn(batch)
+                except Exception as e:
+                    # Keep draining so producers never block on a dead writer.
+                    self._error = e
+
+    def put(self, batch):
+        if self._error is not None:
+            raise self._error
+        self._queue.put(batch)
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+
+class ThroughputMeter:
+    """Counts processed chunks and periodically prints the chunks/sec rate."""
+
+    def __init__(self, label: str = "Embedded"):
+        self.label = label
+        self.count = 0
+        self.started = time.monotonic()
+        self._next_report = self.started + PROGRESS_INTERVAL_SECONDS
+
+    @property
+    def rate(self) -> float:
+        elapsed = time.monotonic() - self.started
+        return self.count / elapsed if elapsed > 0 else 0.0
+
+    def update(self, n: int):
+        self.count += n
+        if time.monotonic() >= self._next_report:
+            print(f"{self.label} {self.count} chunks ({self.rate:.1f} chunks/s)...")
+            self._next_report = time.monotonic() + PROGRESS_INTERVAL_SECONDS
+
+    def summary(self) -> str:
+        return f"{self.label} {self.count} chunks in {time.monotonic() - self.started:.1f}s ({self.rate:.1f} chunks/s)."
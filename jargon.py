@@ -0,0 +1,167 @@
+import os
+import re
+import csv
+import json
+import threading
+import time
+
+# --- Configuration ---
+# Directory containing the glossary files; they ship next to this module.
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+# Glossary sources in priority order: when a term appears in several files, the
+# definition from the earliest source wins.
+DEFAULT_GLOSSARY_SOURCES = [
+    os.path.join(BASE_DIR, "Terminologies.csv"),
+    os.path.join(BASE_DIR, "glossary.json"),
+    os.path.join(BASE_DIR, "terminology.json"),
+]
+# Minimum number of seconds between two checks for modified glossary files.
+RELOAD_CHECK_INTERVAL_SECONDS = 2.0
+
+
+def _load_glossary_file(path: str) -> dict:
+    """Reads one glossary source (a term/explanation CSV or a {term: explanation} JSON object)."""
+    if path.endswith(".json"):
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        return {str(term): str(explanation) for term, explanation in data.items()}
+    with open(path, encoding="utf-8-sig", newline="") as f:
+        reader = csv.DictReader(f)
+        if not reader.fieldnames or "term" not in reader.fieldnames or "explanation" not in reader.fieldnames:
+            return {}
+        return {row["term"]: row["explanation"] for row in reader if row.get("term") and row.get("explanation")}
+
+
+def _trie_pattern(node: dict) -> str:
+    """Converts a character trie into an equivalent regular expression.
+
+    Shared prefixes are factored out and optional suffixes are greedy, so the
+    compiled pattern tries the longest term first at every position and scans the
+    query in a single pass regardless of how many terms the glossary holds.
+    """
+    terminal = "" in node
+    branches = []
+    single_chars = []
+    for char in sorted(key for key in node if key):
+        child = node[char]
+        if list(child) == [""]:
+            single_chars.append(re.escape(char))
+        else:
+            branches.append(re.escape(char) + _trie_pattern(child))
+    if single_chars:
+        branches.append(single_chars[0] if len(single_chars) == 1 else "[" + "".join(single_chars) + "]")
+    pattern = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+    return "(?:" + pattern + ")?" if terminal else pattern
+
+
+class JargonExpander:
+    """
+    Expands internal jargon in a query using every glossary source at once.
+
+    All sources are merged once and compiled into a single trie-shaped regex with
+    whole-word, longest-match semantics. The source files are re-checked at most
+    every RELOAD_CHECK_INTERVAL_SECONDS and the automaton is rebuilt when any of
+    them changes, so glossary edits take effect without a restart.
+    """
+
+    def __init__(self, sources: list = None):
+        self.sources = DEFAULT_GLOSSARY_SOURCES if sources is None else sources
+        self._lock = threading.Lock()
+        self._stamps = None
+        self._next_check = 0.0
+        # (compiled pattern, term -> explanation) swapped in as one tuple so readers
+        # never see a pattern paired with a different glossary.
+        self._compiled = (None, {})
+
+    def _current_stamps(self) -> tuple:
+        stamps = []
+        for path in self.sources:
+            try:
+                stamps.append(os.stat(path).st_mtime_ns)
+            except OSError:
+                stamps.append(None)
+        return tuple(stamps)
+
+    def _rebuild(self, stamps: tuple):
+        explanations = {}
+        for path, stamp in zip(self.sources, stamps):
+            if stamp is None:
+                continue
+            try:
+                for term, explanation in _load_glossary_file(path).items():
+                    explanations.setdefault(term.strip().lower(), explanation.strip().lower())
+            except (OSError, ValueError) as e:
+                print(f"Error loading glossary '{path}': {e}")
+        explanations.pop("", None)
+
+        trie = {}
+        for term in explanations:
+            node = trie
+            for char in term:
+                node = node.setdefault(char, {})
+            node[""] = {}
+        # Whole-word matching: a term may not start or end inside a larger word.
+        pattern = re.compile(r"(?<!\w)" + _trie_pattern(trie) + r"(?!\w)") if trie else None
+        self._compiled = (pattern, explanations)
+        self._stamps = stamps
+        print(f"Compiled jargon glossary with {len(explanations)} terms.")
+
+    def _refresh(self):
+        now = time.monotonic()
+        if now < self._next_check:
+            return
+        with self._lock:
+            if now < self._next_check:
+                return
+            stamps = self._current_stamps()
+            if stamps != self._stamps:
+                self._rebuild(stamps)
+            self._next_check = now + RELOAD_CHECK_INTERVAL_SECONDS
+
+    def expand(self, user_query: str) -> tuple:
+        """
+        Replaces every glossary term in the query with its explanation.
+
+        Like the original CSV-based expansion, the query is lower-cased and matching
+        is whole-word. Expansions are not themselves re-scanned for terms.
+
+        Args:
+            user_query (str): The original query string from the user.
+
+        Returns:
+            tuple: (expanded_query, expanded_terms), where expanded_terms lists each
+                   distinct glossary term that was replaced, in order of first appearance.
+        """
+        self._refresh()
+        pattern, explanations = self._compiled
+        expanded_query = user_query.lower()
+        if pattern is None:
+            return expanded_query, []
+        expanded_terms = []
+
+        def replace(match):
+            term = match.group(0)
+            if term not in expanded_terms:
+                expanded_terms.append(term)
+            return explanations[term]
+
+        return pattern.sub(replace, expanded_query), expanded_terms
+
+    @property
+    def term_count(self) -> int:
+        self._refresh()
+        return len(self._compiled[1])
+
+
+# --- Process-wide expander ---
+_expander = None
+_expander_lock = threading.Lock()
+
+
+def get_expander() -> JargonExpander:
+    """Returns the process-wide JargonExpander, creating it on first use."""
+    global _expander
+    with _expander_lock:
+        if _expander is None:
+            _expander = JargonExpander()
+        return _expander
@@ -0,0 +1,280 @@
+import os
+import csv
+import io
+import json
+import uuid
+import asyncio
+import datetime
+
+from database_utils import DATABASE_NAME, save_analysis, get_connection, retry_on_busy
+
+# --- Configuration ---
+# Number of analyses the worker pool runs concurrently.
+DEFAULT_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+# Capacity of the in-memory hand-off queue between the dispatcher and the workers.
+DEFAULT_QUEUE_SIZE = int(os.getenv("JOB_QUEUE_SIZE", "16"))
+# Upper bound on unfinished items across all jobs; new jobs are rejected beyond it.
+DEFAULT_MAX_PENDING_ITEMS = int(os.getenv("JOB_MAX_PENDING_ITEMS", "10000"))
+# How often (in seconds) the dispatcher polls SQLite when it has not been woken up.
+DISPATCH_POLL_SECONDS = 1.0
+
+
+class QueueFullError(Exception):
+    """Raised when a job is submitted while the queue is at capacity."""
+
+
+def parse_csv_features(raw: bytes) -> list:
+    """
+    Parses an uploaded CSV into feature dictionaries.
+
+    The CSV must have a 'feature_description' column and may have a 'feature_name'
+    column. Exports from Excel are often windows-1252 encoded, so that is tried if
+    the file is not valid UTF-8.
+
+    Raises:
+        ValueError: If the CSV has no 'feature_description' column.
+    """
+    try:
+        text = raw.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        text = raw.decode("windows-1252")
+    reader = csv.DictReader(io.StringIO(text))
+    if not reader.fieldnames or "feature_description" not in reader.fieldnames:
+        raise ValueError("CSV must contain a 'feature_description' column.")
+    return [
+        {"feature_name": row.get("feature_name"), "feature_description": row["feature_description"]}
+        for row in reader if row.get("feature_description")
+    ]
+
+
+def build_feature_text(feature_name, feature_description: str) -> str:
+    """Combines a feature's name and description into the text that gets analyzed."""
+    return f"{feature_name}: {feature_description}" if feature_name else feature_description
+
+
+class JobQueue:
+    """
+    A SQLite-backed job queue with a local asyncio worker pool.
+
+    Jobs and their items are persisted in the 'jobs' and 'job_items' tables of the
+    audit database, so queued work survives a restart. A dispatcher task moves
+    pending items into a bounded in-memory queue, which a fixed pool of worker
+    tasks drains. Every finished item is written to analysis_log like any other
+    analysis. Submissions are rejected with QueueFullError once too many items
+    are outstanding.
+    """
+
+    def __init__(self, analyze, workers: int = None, queue_size: int = None,
+                 max_pending_items: int = None, db_path: str = None):
+        self.analyze = analyze
+        self.workers = workers or DEFAULT_WORKERS
+        self.queue_size = queue_size or DEFAULT_QUEUE_SIZE
+        self.max_pending_items = max_pending_items or DEFAULT_MAX_PENDING_ITEMS
+        self.db_path = db_path or DATABASE_NAME
+        self._loop = None
+        self._queue = None
+        self._wakeup = None
+        self._tasks = []
+
+    def _connect(self):
+        # The calling thread's shared WAL connection; it is reused, not closed, after each operation.
+        return get_connection(self.db_path)
+
+    def init_tables(self):
+        """Creates the job tables and returns interrupted items to the pending state."""
+        conn = self._connect()
+        with conn:
+            conn.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                created_at DATETIME NOT NULL,
+                updated_at DATETIME NOT NULL,
+                total INTEGER NOT NULL,
+                completed INTEGER NOT NULL DEFAULT 0,
+                failed INTEGER NOT NULL DEFAULT 0
+            )
+            """)
+            conn.execute("""
+            CREATE TABLE IF NOT EXISTS job_items (
+                job_id TEXT NOT NULL,
+                item_index INTEGER NOT NULL,
+                feature_name TEXT,
+                feature_description TEXT NOT NULL,
+                status TEXT NOT NULL,
+                result TEXT,
+                log_id INTEGER,
+                PRIMARY KEY (job_id, item_index)
+            )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_job_items_status ON job_items (status)")
+            # Items that were dispatched or running when the process stopped start over.
+            conn.execute("UPDATE job_items SET status = 'pending' WHERE status IN ('queued', 'running')")
+
+    # --- Submission and status (synchronous; call from a threadpool in async code) ---
+
+    def submit(self, features: list) -> str:
+        """
+        Persists a new job and returns its ID.
+
+        Args:
+            features (list): Dictionaries with 'feature_description' and optionally 'feature_name'.
+
+        Raises:
+            ValueError: If no features were given.
+            QueueFullError: If accepting the job would exceed max_pending_items.
+        """
+        if not features:
+            raise ValueError("A job needs at least one feature.")
+        job_id = uuid.uuid4().hex
+        now = datetime.datetime.now()
+        conn = self._connect()
+        with conn:
+            outstanding = conn.execute(
+                "SELECT COUNT(*) FROM job_items WHERE status IN ('pending', 'queued', 'running')"
+            ).fetchone()[0]
+            if outstanding + len(features) > self.max_pending_items:
+                raise QueueFullError(
+                    f"Job queue is full ({outstanding} items outstanding, limit {self.max_pending_items})."
+                )
+            conn.execute(
+                "INSERT INTO jobs (id, status, created_at, updated_at, total) VALUES (?, 'queued', ?, ?, ?)",
+                (job_id, now, now, len(features))
+            )
+            conn.executemany(
+                "INSERT INTO job_items (job_id, item_index, feature_name, feature_description, status) "
+                "VALUES (?, ?, ?, ?, 'pending')",
+                [(job_id, i, f.get("feature_name"), f["feature_description"]) for i, f in enumerate(features)]
+            )
+        if self._wakeup is not None:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+        return job_id
+
+    def get_job(self, job_id: str, offset: int = 0, limit: int = 100):
+        """
+        Returns a job's progress and a page of its finished items, or None if unknown.
+        """
+        conn = self._connect()
+        job = conn.execute(
+            "SELECT id, status, created_at, updated_at, total, completed, failed FROM jobs WHERE id = ?",
+            (job_id,)
+        ).fetchone()
+        if job is None:
+            return None
+        items = conn.execute("""
+        SELECT item_index, feature_name, feature_description, status, result, log_id
+        FROM job_items
+        WHERE job_id = ? AND status IN ('done', 'failed')
+        ORDER BY item_index
+        LIMIT ? OFFSET ?
+        """, (job_id, limit, offset)).fetchall()
+        total, completed, failed = job[4], job[5], job[6]
+        return {
+            "job_id": job[0],
+            "status": job[1],
+            "created_at": job[2],
+            "updated_at": job[3],
+            "total": total,
+            "completed": completed,
+            "failed": failed,
+            "progress": (completed + failed) / total if total else 1.0,
+            "results": [
+                {
+                    "index": row[0],
+                    "feature_name": row[1],
+                    "feature_description": row[2],
+                    "status": row[3],
+                    "result": json.loads(row[4]) if row[4] else None,
+                    "log_id": row[5],
+                }
+                for row in items
+            ],
+        }
+
+    @retry_on_busy
+    def _claim_pending(self, limit: int) -> list:
+        conn = self._connect()
+        with conn:
+            rows = conn.execute("""
+            SELECT job_id, item_index, feature_name, feature_description
+            FROM job_items WHERE status = 'pending' ORDER BY rowid LIMIT ?
+            """, (limit,)).fetchall()
+            conn.executemany(
+                "UPDATE job_items SET status = 'queued' WHERE job_id = ? AND item_index = ?",
+                [(row[0], row[1]) for row in rows]
+            )
+            conn.executemany(
+                "UPDATE jobs SET status = 'running', updated_at = ? WHERE id = ? AND status = 'queued'",
+                [(datetime.datetime.now(), job_id) for job_id in {row[0] for row in rows}]
+            )
+            return rows
+
+    @retry_on_busy
+    def _finish_item(self, job_id: str, item_index: int, result: dict, log_id, succeeded: bool):
+        now = datetime.datetime.now()
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                "UPDATE job_items SET status = ?, result = ?, log_id = ? WHERE job_id = ? AND item_index = ?",
+                ("done" if succeeded else "failed", json.dumps(result), log_id, job_id, item_index)
+            )
+            column = "completed" if succeeded else "failed"
+            conn.execute(f"UPDATE jobs SET {column} = {column} + 1, updated_at = ? WHERE id = ?", (now, job_id))
+            conn.execute(
+                "UPDATE jobs SET status = 'completed', updated_at = ? WHERE id = ? AND completed + failed >= total",
+                (now, job_id)
+            )
+
+    # --- Worker pool ---
+
+    async def start(self):
+        """Initializes the tables and starts the dispatcher and worker tasks on the running loop."""
+        await asyncio.to_thread(self.init_tables)
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        self._wakeup = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._dispatch())]
+        self._tasks += [asyncio.create_task(self._work()) for _ in range(self.workers)]
+        print(f"Job queue started with {self.workers} workers.")
+
+    async def stop(self):
+        """Cancels the dispatcher and workers; unfinished items resume on the next start."""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _dispatch(self):
+        while True:
+            # Claim at least one item even when the queue is full, so the dispatcher
+            # parks on put() and refills the moment a worker frees a slot.
+            free = max(1, self._queue.maxsize - self._queue.qsize())
+            rows = await asyncio.to_thread(self._claim_pending, free)
+            for row in rows:
+                # Blocks while the workers are saturated, which is the queue's backpressure.
+                await self._queue.put(row)
+            if not rows:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=DISPATCH_POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _work(self):
+        while True:
+            job_id, item_index, feature_name, feature_description = await self._queue.get()
+            text = build_feature_text(feature_name, feature_description)
+            try:
+                result = await self.analyze(text)
+            except Exception as e:
+                result = {"flag": "Error", "reasoning": f"An exception occurred: {e}",
+                          "related_regulations": [], "citations": []}
+            try:
+                log_id = await asyncio.to_thread(save_analysis, result, text)
+                await asyncio.to_thread(
+                    self._finish_item, job_id, item_index, result, log_id, result.get("flag") != "Error"
+                )
+            except Exception as e:
+                print(f"Failed to record job item {job_id}/{item_index}: {e}")
+            finally:
+                self._queue.task_done()
@@ -0,0 +1,89 @@
+import os
+import json
+import hashlib
+
+# --- Configuration ---
+# Manifest recording what the last ingestion run put into the vector stores.
+DEFAULT_MANIFEST_FILE = "kb_manifest.json"
+# Bump when the manifest layout changes; older manifests then trigger a full rebuild.
+MANIFEST_VERSION = 1
+
+
+def file_sha256(path: str) -> str:
+    """Returns the SHA-256 of a file's bytes, read in 1 MB blocks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def chunk_ids(source: str, texts: list) -> list:
+    """
+    Returns stable, content-derived IDs for the chunks of one document.
+
+    An ID is the document's path plus a hash of the chunk text, so an edit only
+    changes the IDs of the chunks whose text actually changed. Identical chunks
+    within one document are told apart by an occurrence counter.
+    """
+    ids = []
+    seen = {}
+    for text in texts:
+        digest = hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+        occurrence = seen.get(digest, 0)
+        seen[digest] = occurrence + 1
+        ids.append(f"{source}:{digest}" + (f"#{occurrence}" if occurrence else ""))
+    return ids
+
+
+class KnowledgeBaseManifest:
+    """
+    Per-file and per-chunk content hashes of the ingested knowledge base.
+
+    For every source file the manifest stores the file's SHA-256 and the IDs of
+    its chunks, in order, plus the settings the chunks were produced with (model,
+    chunk size, overlap). Comparing it with the files on disk tells an ingestion
+    run which files to skip, which to re-split and which chunks to delete.
+    """
+
+    def __init__(self, path: str = None):
+        self.path = path or os.getenv("KB_MANIFEST_FILE", DEFAULT_MANIFEST_FILE)
+        self.settings = None
+        self.files = {}  # source -> {"sha256": ..., "chunks": [chunk ids]}
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if data.get("version") == MANIFEST_VERSION:
+            self.settings = data.get("settings")
+            self.files = data.get("files", {})
+
+    @property
+    def exists(self) -> bool:
+        return self.settings is not None
+
+    def diff(self, current_hashes: dict) -> tuple:
+        """
+        Compares the manifest with the current files.
+
+        Args:
+            current_hashes (dict): Source path -> SHA-256 of every file on disk.
+
+        Returns:
+            tuple: (changed, removed, unchanged) lists of source paths, where changed
+                   includes new files.
+        """
+        changed = [source for source, sha in current_hashes.items()
+                   if self.files.get(source, {}).get("sha256") != sha]
+        removed = [source for source in self.files if source not in current_hashes]
+        unchanged = [source for source in current_hashes if source not in changed]
+        return changed, removed, unchanged
+
+    def save(self, settings: dict, files: dict):
+        """Atomically replaces the manifest with the given settings and per-file entries."""
+        self.settings = settings
+        self.files = files
+        with open(self.path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({"version": MANIFEST_VERSION, "settings": settings, "files": files}, f, indent=2, sort_keys=True)
+        os.replace(self.path + ".tmp", self.path)
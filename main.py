@@ -1,18 +1,42 @@
 # main.py
+import io
+import csv
+import json
 import sqlite3
-from fastapi import FastAPI, HTTPException
+import asyncio
+from fastapi import FastAPI, HTTPException, Query, Request, Response
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse, PlainTextResponse
 from pydantic import BaseModel
 from typing import Optional, List
 
 # Import your existing logic functions
-from compliance_checker import check_feature
+from compliance_checker import check_feature_async, check_feature_stream, warm_up, readiness
+from embedding_cache import get_cache_stats as get_embedding_cache_stats
+from response_cache import get_response_cache
+from reranker import get_reranker
+from singleflight import get_single_flight
+from metrics import registry as metrics_registry, trace_request
+from job_queue import JobQueue, QueueFullError, parse_csv_features
 from database_utils import (
     init_db,
     save_analysis,
-    fetch_all_logs,
+    fetch_logs_page,
+    iter_logs,
+    search_logs,
+    fetch_analysis_details,
+    regulation_flag_counts,
+    citation_counts,
+    DEFAULT_SEARCH_PAGE_SIZE,
+    MAX_SEARCH_PAGE_SIZE,
+    LOG_COLUMNS,
+    DEFAULT_LOG_PAGE_SIZE,
+    MAX_LOG_PAGE_SIZE,
     update_feedback as db_update_feedback, # Renamed to avoid conflict
-    reset_database as db_reset_database
+    reset_database as db_reset_database,
+    start_batched_writer,
+    stop_batched_writer
 )
 
 # --- FastAPI App Initialization ---
@@ -35,6 +59,8 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # Lets the browser read the pagination cursor returned by GET /logs.
+    expose_headers=["X-Next-Cursor"],
 )
 
 # --- Pydantic Models for Data Validation ---
@@ -42,48 +68,300 @@ app.add_middleware(
 class AnalysisRequest(BaseModel):
     feature_description: str
 
+class JobFeature(BaseModel):
+    feature_name: Optional[str] = None
+    feature_description: str
+
+class JobRequest(BaseModel):
+    features: List[JobFeature]
+
 class FeedbackRequest(BaseModel):
     log_id: int
     status: str
     corrected_flag: Optional[str] = None
     corrected_reasoning: Optional[str] = None
 
+# --- Metrics ---
+# Statistics the caches already keep are read at scrape time rather than duplicated.
+metrics_registry.register_callback(
+    "regtok_embedding_cache_lookups_total", "Embedding cache lookups by outcome.", "counter",
+    lambda: [({"model": stats["model"], "result": result}, stats[key])
+             for stats in get_embedding_cache_stats()
+             for result, key in (("memory_hit", "memory_hits"), ("disk_hit", "disk_hits"), ("miss", "misses"))]
+)
+metrics_registry.register_callback(
+    "regtok_rerank_score_lookups_total", "Cross-encoder score cache lookups by outcome.", "counter",
+    lambda: [({"result": "hit"}, get_reranker().stats()["hits"]), ({"result": "miss"}, get_reranker().stats()["misses"])]
+)
+metrics_registry.register_callback(
+    "regtok_single_flight_requests_total", "Analyses that started a run or joined one in flight.", "counter",
+    lambda: [({"result": "run"}, get_single_flight().stats()["runs"]),
+             ({"result": "coalesced"}, get_single_flight().stats()["coalesced"])]
+)
+
 # --- API Endpoints ---
 
+# Background job queue for batch analyses; its workers run on the API's event loop.
+job_queue = JobQueue(analyze=check_feature_async)
+
 @app.on_event("startup")
-def on_startup():
-    """Initialize the database when the API starts."""
+async def on_startup():
+    """Initialize the database and start the audit-log writer and job workers when the API starts."""
     init_db()
+    start_batched_writer()
+    await job_queue.start()
+    # Load the embedding model and clients in the background so the server accepts
+    # connections immediately; GET /ready reports when they are warm.
+    asyncio.get_running_loop().run_in_executor(None, warm_up)
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    """Stop the job workers, then flush pending audit-log writes; unfinished items are resumed on the next start."""
+    await job_queue.stop()
+    stop_batched_writer()
+
+@app.get("/health", summary="Liveness check")
+def health():
+    return {"status": "ok"}
+
+@app.get("/ready", summary="Readiness check: are the model and clients warm?")
+def ready(response: Response):
+    report = readiness()
+    if not report["ready"]:
+        # Load balancers and autoscalers hold traffic back until this returns 200.
+        response.status_code = 503
+    return report
 
 @app.post("/analyze", summary="Analyze a feature for compliance")
-def analyze_feature(request: AnalysisRequest):
+async def analyze_feature(request: AnalysisRequest):
     """
     Receives a feature description, runs the compliance check, saves it,
     and returns the analysis result.
+
+    The pipeline is awaited end to end, so a single worker can hold many
+    analyses in flight while they wait on ChromaDB and Gemini.
     """
     if not request.feature_description:
         raise HTTPException(status_code=400, detail="Feature description cannot be empty.")
     
     try:
-        result = check_feature(request.feature_description)
-        # We don't save the analysis here anymore, we just return it.
-        # The frontend can decide when/how to save feedback later.
-        # However, for the audit log to work, we must save every analysis.
-        log_id = save_analysis(result, request.feature_description)
+        # One trace covers the analysis and the audit write, for the slow-request log.
+        with trace_request("POST /analyze"):
+            result = await check_feature_async(request.feature_description)
+            # We don't save the analysis here anymore, we just return it.
+            # The frontend can decide when/how to save feedback later.
+            # However, for the audit log to work, we must save every analysis.
+            # The SQLite write is blocking, so it runs in the threadpool.
+            log_id = await run_in_threadpool(save_analysis, result, request.feature_description)
         return {"result": result, "log_id": log_id}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.get("/logs", summary="Fetch all analysis logs")
-def get_all_logs():
-    """Retrieves all historical analysis logs from the database."""
+@app.post("/analyze/stream", summary="Analyze a feature and stream progress as Server-Sent Events")
+async def analyze_feature_stream(request: AnalysisRequest):
+    """
+    Streams the analysis as Server-Sent Events while it runs.
+
+    Emits 'expanded_query', 'sources' and 'examples' as soon as each stage is done,
+    then 'thought' events with incremental thought text, and finally a 'result'
+    event carrying {"result": ..., "log_id": ...} once the analysis is saved.
+    """
+    if not request.feature_description:
+        raise HTTPException(status_code=400, detail="Feature description cannot be empty.")
+
+    def format_event(event: str, data) -> str:
+        return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+    async def event_stream():
+        try:
+            async for event, data in check_feature_stream(request.feature_description):
+                if event == "result":
+                    # Every analysis is saved to the audit log, streamed or not.
+                    log_id = await run_in_threadpool(save_analysis, data, request.feature_description)
+                    data = {"result": data, "log_id": log_id}
+                yield format_event(event, data)
+        except Exception as e:
+            yield format_event("error", {"detail": str(e)})
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        # Disable caching and proxy buffering so events reach the client immediately.
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.post("/jobs", status_code=202, summary="Submit a batch of features for analysis")
+async def create_job(request: Request):
+    """
+    Queues a batch analysis job and returns its ID immediately.
+
+    Accepts either a JSON body of the form {"features": [{"feature_name": ...,
+    "feature_description": ...}, ...]} or a CSV with 'feature_name' and
+    'feature_description' columns, uploaded as the 'file' field of a multipart
+    form or sent directly with Content-Type text/csv.
+    """
+    content_type = request.headers.get("content-type", "")
+    try:
+        if content_type.startswith("multipart/form-data"):
+            form = await request.form()
+            upload = form.get("file")
+            if upload is None:
+                raise ValueError("Multipart uploads must include the CSV as the 'file' field.")
+            features = parse_csv_features(await upload.read())
+        elif content_type.startswith("text/csv"):
+            features = parse_csv_features(await request.body())
+        else:
+            job_request = JobRequest(**await request.json())
+            features = [feature.dict() for feature in job_request.features]
+        job_id = await run_in_threadpool(job_queue.submit, features)
+    except QueueFullError as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": "30"})
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"job_id": job_id, "total": len(features)}
+
+@app.get("/jobs/{job_id}", summary="Fetch a batch job's progress and results")
+async def get_job(job_id: str, offset: int = 0, limit: int = 100):
+    """Returns the job's progress and a page of the results finished so far."""
+    job = await run_in_threadpool(job_queue.get_job, job_id, offset, limit)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found.")
+    return job
+
+@app.get("/logs", summary="Fetch analysis logs, newest first")
+def get_all_logs(
+    response: Response,
+    limit: int = Query(DEFAULT_LOG_PAGE_SIZE, ge=1, le=MAX_LOG_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    status: Optional[str] = None,
+    flag: Optional[str] = None,
+    regulation: Optional[str] = None,
+    citation: Optional[str] = None,
+    start: Optional[str] = None,
+    end: Optional[str] = None,
+):
+    """
+    Retrieves one page of analysis logs matching the optional filters.
+
+    The body is a list of log records. When more rows match, the `X-Next-Cursor`
+    response header holds the cursor to pass as `cursor` for the next page.
+    """
+    try:
+        rows, next_cursor = fetch_logs_page(
+            limit=limit, cursor=cursor, status=status, flag=flag,
+            regulation=regulation, citation=citation, start=start, end=end
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return rows
+
+@app.get("/logs/search", summary="Full-text search the audit log")
+def search_audit_logs(
+    q: str,
+    limit: int = Query(DEFAULT_SEARCH_PAGE_SIZE, ge=1, le=MAX_SEARCH_PAGE_SIZE),
+    offset: int = Query(0, ge=0),
+    start: Optional[str] = None,
+    end: Optional[str] = None,
+):
+    """
+    Searches queries, reasoning, regulations and citations, best matches first.
+
+    `q` accepts FTS5 syntax (phrases, OR, NOT, prefix*). Each result carries a
+    highlighted `snippet`; pass `next_offset` back as `offset` for the next page.
+    """
+    try:
+        results, next_offset = search_logs(q, limit=limit, offset=offset, start=start, end=end)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    return {"query": q, "results": results, "next_offset": next_offset}
+
+@app.get("/logs/export", summary="Stream every matching analysis log")
+def export_logs(
+    format: str = Query("ndjson", pattern="^(ndjson|csv)$"),
+    status: Optional[str] = None,
+    flag: Optional[str] = None,
+    regulation: Optional[str] = None,
+    citation: Optional[str] = None,
+    start: Optional[str] = None,
+    end: Optional[str] = None,
+):
+    """
+    Streams the full (filtered) audit history as NDJSON or CSV.
+
+    Rows are read and sent page by page, so the export never holds the whole
+    table in memory.
+    """
+    rows = iter_logs(status=status, flag=flag, regulation=regulation, citation=citation, start=start, end=end)
+
+    def ndjson():
+        for row in rows:
+            yield json.dumps(row, ensure_ascii=False) + "\n"
+
+    def csv_lines():
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=LOG_COLUMNS)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(row)
+            # Flush roughly every 64 KB rather than once per row.
+            if buffer.tell() > 65536:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+
+    if format == "csv":
+        return StreamingResponse(csv_lines(), media_type="text/csv",
+                                 headers={"Content-Disposition": 'attachment; filename="audit_log.csv"'})
+    return StreamingResponse(ndjson(), media_type="application/x-ndjson",
+                             headers={"Content-Disposition": 'attachment; filename="audit_log.ndjson"'})
+
+@app.get("/logs/{log_id}/details", summary="Fetch the structured details of one analysis")
+def get_log_details(log_id: int):
+    """Returns an analysis's regulations and citations as lists, plus its thought process."""
+    try:
+        details = fetch_analysis_details(log_id)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    if details is None:
+        raise HTTPException(status_code=404, detail="Analysis not found.")
+    return details
+
+@app.get("/stats/regulations", summary="Count analyses per regulation and flag")
+def get_regulation_stats(start: Optional[str] = None, end: Optional[str] = None):
+    """Returns per-regulation flag counts, optionally limited to a date range."""
     try:
-        log_df = fetch_all_logs()
-        # Convert DataFrame to a list of dictionaries for JSON compatibility
-        return log_df.to_dict(orient="records")
+        return regulation_flag_counts(start=start, end=end)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/stats/citations", summary="Count analyses per cited source")
+def get_citation_stats(start: Optional[str] = None, end: Optional[str] = None):
+    """Returns how many analyses cite each source, optionally limited to a date range."""
+    try:
+        return citation_counts(start=start, end=end)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/metrics", summary="Prometheus metrics", response_class=PlainTextResponse)
+def get_metrics():
+    """Stage latencies, token counts, cache hits, LLM errors and flags in the Prometheus text format."""
+    return PlainTextResponse(metrics_registry.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/cache/stats", summary="Report cache hit rates")
+def get_cache_stats():
+    """Returns hit/miss statistics for the embedding and response caches in this worker."""
+    return {"embedding": get_embedding_cache_stats(), "response": get_response_cache().stats(),
+            "rerank": get_reranker().stats(), "single_flight": get_single_flight().stats()}
+
 @app.post("/feedback", summary="Submit feedback for an analysis")
 def update_feedback(request: FeedbackRequest):
     """Updates a log entry with user feedback (approved or corrected)."""
@@ -0,0 +1,295 @@
+import os
+import json
+import time
+import inspect
+import functools
+import threading
+import contextvars
+from contextlib import contextmanager
+
+# --- Configuration ---
+# Histogram buckets (seconds) covering in-process stages through slow LLM calls.
+DEFAULT_LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+# Requests at least this slow (in seconds) are logged with their stage breakdown; unset disables the log.
+SLOW_REQUEST_SECONDS = os.getenv("SLOW_REQUEST_SECONDS")
+# Optional file the slow-request log is appended to (one JSON object per line) besides stdout.
+SLOW_REQUEST_LOG_FILE = os.getenv("SLOW_REQUEST_LOG_FILE")
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if value not in (float("inf"), float("-inf")) else ("+Inf" if value > 0 else "-Inf")
+
+
+class Counter:
+    """A monotonically increasing value per label combination."""
+
+    type_name = "counter"
+
+    def __init__(self, name: str, documentation: str, label_names: tuple = ()):
+        self.name, self.documentation, self.label_names = name, documentation, tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.label_names)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def samples(self) -> list:
+        with self._lock:
+            return [(self.name, _format_labels(self.label_names, key), value) for key, value in sorted(self._values.items())]
+
+
+class Histogram:
+    """Observations counted into cumulative buckets, plus their sum and count, per label combination."""
+
+    type_name = "histogram"
+
+    def __init__(self, name: str, documentation: str, label_names: tuple = (), buckets: tuple = DEFAULT_LATENCY_BUCKETS):
+        self.name, self.documentation, self.label_names = name, documentation, tuple(label_names)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}  # labels -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.label_names)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def samples(self) -> list:
+        samples = []
+        with self._lock:
+            for key, series in sorted(self._series.items()):
+                for bound, count in zip(self.buckets, series):
+                    samples.append((f"{self.name}_bucket", _format_labels(self.label_names, key, f'le="{_format_value(bound)}"'), count))
+                samples.append((f"{self.name}_bucket", _format_labels(self.label_names, key, 'le="+Inf"'), series[-1]))
+                samples.append((f"{self.name}_sum", _format_labels(self.label_names, key), series[-2]))
+                samples.append((f"{self.name}_count", _format_labels(self.label_names, key), series[-1]))
+        return samples
+
+
+class MetricsRegistry:
+    """
+    Holds the process's metrics and renders them in the Prometheus text format.
+
+    Besides counters and histograms updated in place, callbacks can be registered
+    to report values that are already tracked elsewhere (e.g. cache statistics)
+    at scrape time.
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._callbacks = []  # (name, documentation, type, callback returning {labels dict tuple: value})
+        self._lock = threading.Lock()
+
+    def counter(self, name: str, documentation: str, label_names: tuple = ()) -> Counter:
+        metric = Counter(name, documentation, label_names)
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, documentation: str, label_names: tuple = (), buckets: tuple = DEFAULT_LATENCY_BUCKETS) -> Histogram:
+        metric = Histogram(name, documentation, label_names, buckets)
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def register_callback(self, name: str, documentation: str, metric_type: str, callback):
+        """
+        Registers a metric computed at scrape time.
+
+        Args:
+            callback: Returns a list of (labels dict, value) pairs.
+        """
+        with self._lock:
+            self._callbacks.append((name, documentation, metric_type, callback))
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            metrics, callbacks = list(self._metrics), list(self._callbacks)
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type_name}")
+            lines += [f"{name}{labels} {_format_value(value)}" for name, labels, value in metric.samples()]
+        for name, documentation, metric_type, callback in callbacks:
+            try:
+                values = callback()
+            except Exception as e:
+                print(f"Error collecting metric {name}: {e}")
+                continue
+            lines.append(f"# HELP {name} {documentation}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for labels, value in values:
+                names = tuple(labels)
+                lines.append(f"{name}{_format_labels(names, tuple(labels[n] for n in names))} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+# --- Process-wide registry and the application's metrics ---
+registry = MetricsRegistry()
+
+STAGE_SECONDS = registry.histogram(
+    "regtok_stage_duration_seconds", "Latency of each pipeline stage.", ("stage",))
+REQUEST_SECONDS = registry.histogram(
+    "regtok_request_duration_seconds", "End-to-end latency of traced requests.", ("request",))
+ANALYSES = registry.counter(
+    "regtok_analyses_total", "Completed analyses by flag (unexpected flags count as \"other\").", ("flag",))
+LLM_TOKENS = registry.counter(
+    "regtok_llm_tokens_total", "Gemini tokens reported per kind (prompt, cached, output, thoughts).", ("kind",))
+LLM_ERRORS = registry.counter(
+    "regtok_llm_errors_total", "Failed LLM analyses by API status code.", ("code",))
+CACHE_EVENTS = registry.counter(
+    "regtok_cache_events_total", "Cache lookups by cache and outcome.", ("cache", "result"))
+
+
+# --- Tracing ---
+_current_trace = contextvars.ContextVar("regtok_trace", default=None)
+
+
+class Trace:
+    """The stage spans of one request, collected across tasks and worker threads."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.started = time.perf_counter()
+        self.spans = []        # (stage, start offset, duration) in seconds
+        self.attributes = {}   # Extra context for the slow-request log, e.g. the flag.
+        self._lock = threading.Lock()
+
+    def add_span(self, stage: str, started: float, duration: float):
+        with self._lock:
+            self.spans.append((stage, started - self.started, duration))
+
+    def finish(self):
+        total = time.perf_counter() - self.started
+        REQUEST_SECONDS.observe(total, request=self.name)
+        if SLOW_REQUEST_SECONDS and total >= float(SLOW_REQUEST_SECONDS):
+            entry = json.dumps({
+                "request": self.name,
+                "total_ms": round(total * 1000, 1),
+                "attributes": self.attributes,
+                "stages": [
+                    {"stage": stage, "start_ms": round(offset * 1000, 1), "duration_ms": round(duration * 1000, 1)}
+                    for stage, offset, duration in sorted(self.spans, key=lambda span: span[1])
+                ],
+            }, default=str)
+            print(f"Slow request: {entry}")
+            if SLOW_REQUEST_LOG_FILE:
+                try:
+                    with open(SLOW_REQUEST_LOG_FILE, "a", encoding="utf-8") as f:
+                        f.write(entry + "\n")
+                except OSError as e:
+                    print(f"Error writing slow-request log: {e}")
+
+
+def current_trace():
+    """Returns the Trace of the request being handled, or None outside a traced request."""
+    return _current_trace.get()
+
+
+@contextmanager
+def trace_request(name: str):
+    """
+    Traces a request: spans recorded inside it are collected into one Trace.
+
+    Nested calls join the enclosing trace, so an endpoint can trace the analysis
+    and the audit write together while check_feature_async traces itself when
+    called on its own.
+    """
+    existing = _current_trace.get()
+    if existing is not None:
+        yield existing
+        return
+    trace = Trace(name)
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        try:
+            _current_trace.reset(token)
+        except ValueError:
+            # An async generator resumed in another context; the trace is finished anyway.
+            pass
+        trace.finish()
+
+
+@contextmanager
+def span(stage: str):
+    """Times a stage, recording it in the stage histogram and the current trace."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - started
+        STAGE_SECONDS.observe(duration, stage=stage)
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.add_span(stage, started, duration)
+
+
+def traced(stage: str):
+    """Decorator wrapping every call of a (sync or async) function in a span."""
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span(stage):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# Flag label values; anything else the model returns is counted as "other" so the
+# flag label stays bounded.
+FLAG_LABELS = ("Yes", "No", "Uncertain", "Error")
+
+
+def record_analysis(result: dict):
+    """Counts a finished analysis by flag; called once per request, whoever produced the result."""
+    flag = result.get("flag", "Error")
+    ANALYSES.inc(flag=flag if flag in FLAG_LABELS else "other")
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.attributes.update({"flag": flag, "cache_hit": result.get("cache_hit"), "run_id": result.get("run_id")})
+
+
+def record_llm_call(result: dict):
+    """
+    Updates the token and LLM-error metrics from the result of one Gemini call.
+
+    Called only where Gemini was actually called; results copied to coalesced
+    callers or served from the response cache are skipped, so no call is counted twice.
+    """
+    if result.get("coalesced") or result.get("cache_hit"):
+        return
+    if result.get("flag") == "Error":
+        LLM_ERRORS.inc(code=result.get("error_code") or "none")
+    usage = result.get("token_usage") or {}
+    for kind in ("prompt", "cached", "output", "thoughts"):
+        if usage.get(f"reported_{kind}"):
+            LLM_TOKENS.inc(usage[f"reported_{kind}"], kind=kind)
@@ -1,10 +1,18 @@
 import os
-import chromadb
+import sys
+import time
+import argparse
+import numpy as np
 from dotenv import load_dotenv
-from langchain_community.document_loaders import DirectoryLoader, TextLoader
+from langchain_community.document_loaders import TextLoader
 from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_huggingface import HuggingFaceEmbeddings
-from langchain_community.vectorstores import Chroma
+
+from vector_index import IndexWriter, LocalVectorIndex, META_FILE
+from bm25_index import build_bm25_index, LexicalIndex
+from response_cache import write_kb_version
+from kb_manifest import KnowledgeBaseManifest, file_sha256, chunk_ids
+from ingestion import EmbeddingPipeline, BackgroundWriter, ThroughputMeter
+from embedding_backend import cache_namespace
 
 # --- SCRIPT CONFIGURATION ---
 # Specifies the directory containing the source text documents for the knowledge base.
@@ -13,110 +21,306 @@ KNOWLEDGE_BASE_DIR = "knowledge_base"
 EMBEDDING_MODEL_NAME = "all-MiniLM-L6-v2"  # A fast and efficient sentence-transformer model.
 # The designated name for the vector collection within the ChromaDB instance.
 COLLECTION_NAME = "regulatory_docs"
+# Directory for the embedded, in-process vector index (used when RETRIEVAL_BACKEND=local).
+LOCAL_INDEX_DIR = os.getenv("LOCAL_INDEX_DIR", "vector_index")
+# Maximum number of records sent to ChromaDB in a single upsert() or delete() call.
+# Embedding batch size and worker count are set in ingestion (INGEST_BATCH_SIZE, INGEST_WORKERS).
+CHROMA_ADD_BATCH_SIZE = 500
+# Number of unchanged chunks copied from the previous local index per write.
+INDEX_COPY_BATCH_SIZE = 4096
+# Text splitter settings. Changing them (or the model or embedding backend) forces a full rebuild.
+CHUNK_SIZE = 1000
+CHUNK_OVERLAP = 200
+# How often (in seconds) watch mode polls the knowledge base for changes, and how long
+# the files must stay unchanged before a re-ingest starts (editors save in bursts).
+WATCH_INTERVAL_SECONDS = 2.0
+WATCH_SETTLE_SECONDS = 1.0
+
+def scan_knowledge_base(kb_dir: str = KNOWLEDGE_BASE_DIR) -> dict:
+    """Returns {source path: SHA-256} for every .txt file under the knowledge base directory."""
+    hashes = {}
+    for root, _, files in os.walk(kb_dir):
+        for name in files:
+            if name.endswith(".txt"):
+                path = os.path.join(root, name)
+                hashes[path] = file_sha256(path)
+    return dict(sorted(hashes.items()))
+
+def split_document(source: str, text_splitter) -> list:
+    """Loads one document and splits it into (chunk_id, text, metadata) records."""
+    documents = TextLoader(source).load()
+    splits = text_splitter.split_documents(documents)
+    texts = [doc.page_content for doc in splits]
+    return list(zip(chunk_ids(source, texts), texts, [doc.metadata for doc in splits]))
 
-def build_vector_store():
+def _load_existing_index(embedding: str):
+    """Returns the current local index (with a chunk-id -> row lookup), or None if unusable.
+
+    Args:
+        embedding (str): The model and backend the new vectors come from (see
+            embedding_backend.cache_namespace); an index built with others is unusable.
     """
-    Orchestrates the end-to-end pipeline for building a vector store in ChromaDB Cloud.
-    
+    try:
+        index = LocalVectorIndex(LOCAL_INDEX_DIR)
+    except (OSError, ValueError):
+        return None
+    if index.model_name != embedding:
+        return None
+    index.row_of = {chunk_id: i for i, chunk_id in enumerate(index.ids)}
+    return index
+
+def _ensure_lexical_index():
+    """Builds the BM25 index if it is missing or stale, e.g. for an index built before it existed."""
+    try:
+        LexicalIndex(LOCAL_INDEX_DIR)
+    except (OSError, ValueError):
+        if os.path.exists(os.path.join(LOCAL_INDEX_DIR, META_FILE)):
+            build_bm25_index(LOCAL_INDEX_DIR)
+
+def _open_chroma_writer(full: bool) -> BackgroundWriter:
+    """Returns a background writer upserting (ids, texts, metadatas, vectors) batches into ChromaDB."""
+    # Imported here so --skip-chroma and local-index-only builds work without chromadb installed.
+    from chroma_client import get_manager as get_chroma_manager
+    manager = get_chroma_manager()
+    if full:
+        # Chunk IDs from before the manifest existed are unknown, so start from a clean collection.
+        manager.delete_collection(COLLECTION_NAME)
+        print(f"Recreating collection '{COLLECTION_NAME}'.")
+    collection = manager.get_or_create_collection(COLLECTION_NAME)
+
+    def upsert(batch):
+        ids, texts, metadatas, vectors = batch
+        for start in range(0, len(ids), CHROMA_ADD_BATCH_SIZE):
+            end = start + CHROMA_ADD_BATCH_SIZE
+            collection.upsert(
+                ids=ids[start:end],
+                documents=texts[start:end],
+                metadatas=metadatas[start:end],
+                embeddings=np.asarray(vectors[start:end], dtype=np.float32).tolist()
+            )
+
+    return BackgroundWriter(upsert, name="chroma-writer")
+
+def _delete_chroma_chunks(chunk_ids: list):
+    """Deletes the given chunks from the ChromaDB collection in batches."""
+    if not chunk_ids:
+        return
+    from chroma_client import get_manager as get_chroma_manager
+    collection = get_chroma_manager().get_or_create_collection(COLLECTION_NAME)
+    for start in range(0, len(chunk_ids), CHROMA_ADD_BATCH_SIZE):
+        collection.delete(ids=chunk_ids[start:start + CHROMA_ADD_BATCH_SIZE])
+    print(f"Deleted {len(chunk_ids)} stale chunks from ChromaDB.")
+
+def build_vector_store(full: bool = False, skip_chroma: bool = False) -> bool:
+    """
+    Incrementally brings the vector stores in line with the knowledge base directory.
+
     This function performs the following steps:
-    1. Loads environment variables for ChromaDB credentials.
-    2. Scans a local directory to load text documents.
-    3. Splits the loaded documents into manageable, overlapping chunks.
-    4. Initializes a Hugging Face embedding model.
-    5. Connects to a ChromaDB Cloud instance.
-    6. Deletes any pre-existing collection with the same name to ensure a fresh start.
-    7. Generates embeddings for the text chunks and ingests them into the specified
-       ChromaDB collection.
-       
-    Requires a .env file with CHROMA_API_KEY, CHROMA_TENANT, and CHROMA_DATABASE.
+    1. Hashes every document and compares the hashes with the ingestion manifest.
+    2. Opens a streaming writer for the local index and a background ChromaDB writer.
+    3. Streams new and changed documents through splitting (into chunks with
+       stable, content-derived IDs) and batched, multi-process embedding; only
+       chunks whose text is new are embedded. Unchanged documents are skipped.
+    4. Copies the stored vectors of all surviving chunks from the previous index.
+    5. Commits the rebuilt local index.
+    6. Waits for the ChromaDB upserts and deletes the stale chunks.
+    7. Saves the manifest.
+
+    Memory stays bounded by the batch sizes, not by the size of the corpus.
+
+    A full rebuild happens on the first run, when the model or splitter settings
+    change, or when `full` is set.
+
+    Args:
+        full (bool): Re-ingest every document and recreate the ChromaDB collection.
+        skip_chroma (bool): Only update the local vector index.
+
+    Returns:
+        bool: True if the stores were updated (or already up to date).
     """
-    print("Starting the vectorization pipeline for ChromaDB Cloud...")
+    print("Starting the incremental vectorization pipeline...")
     # Load environment variables from a .env file for secure credential management.
     load_dotenv()
+    started = time.monotonic()
+    # Vectors from different backends (torch, ONNX, int8 ONNX) differ, so the backend is
+    # part of the settings and of the index metadata.
+    embedding = cache_namespace(EMBEDDING_MODEL_NAME)
+    settings = {"model": EMBEDDING_MODEL_NAME, "embedding": embedding, "chunk_size": CHUNK_SIZE,
+                "chunk_overlap": CHUNK_OVERLAP}
+    manifest = KnowledgeBaseManifest()
+    # Manifests from before the backend was recorded were always built with torch.
+    saved_settings = {"embedding": EMBEDDING_MODEL_NAME, **(manifest.settings or {})}
+    full = full or not manifest.exists or saved_settings != settings
 
-    # STEP 1: LOAD DOCUMENTS
-    # Recursively load all .txt files from the specified knowledge base directory.
-    print(f"Loading documents from '{KNOWLEDGE_BASE_DIR}'...")
-    loader = DirectoryLoader(KNOWLEDGE_BASE_DIR, glob="**/*.txt", loader_cls=TextLoader)
-    documents = loader.load()
-    if not documents:
+    # STEP 1: DETECT CHANGES
+    current_hashes = scan_knowledge_base()
+    if not current_hashes:
         print(f"No documents found in '{KNOWLEDGE_BASE_DIR}'. Aborting.")
-        return
-    print(f"Loaded {len(documents)} document(s).")
-
-    # STEP 2: SPLIT TEXT INTO CHUNKS
-    # Divide the documents into smaller chunks to ensure they fit within the embedding
-    # model's context window. Overlap helps maintain contextual continuity between chunks.
-    print("Splitting documents into chunks...")
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-    all_splits = text_splitter.split_documents(documents)
-    print(f"Split documents into {len(all_splits)} chunks.")
-
-    # STEP 3: INITIALIZE EMBEDDING MODEL
-    # Load the specified HuggingFace model for creating vector representations of the text chunks.
-    print(f"Initializing embedding model '{EMBEDDING_MODEL_NAME}'...")
-    model_kwargs = {'device': 'cpu'} # Explicitly set to use CPU.
-    encode_kwargs = {'normalize_embeddings': False} # Normalization can be handled by the vector store if needed.
-    embeddings = HuggingFaceEmbeddings(
-        model_name=EMBEDDING_MODEL_NAME,
-        model_kwargs=model_kwargs,
-        encode_kwargs=encode_kwargs
-    )
-    print("Embedding model loaded.")
-
-    # STEP 4: CONNECT TO CHROMADB CLOUD AND STORE VECTORS
-    # Establish a connection to the ChromaDB Cloud service and populate the collection.
-    print("Connecting to ChromaDB Cloud...")
+        return False
+    existing = None if full else _load_existing_index(embedding)
+    if full:
+        changed, removed, unchanged = list(current_hashes), [], []
+    else:
+        changed, removed, unchanged = manifest.diff(current_hashes)
+        # Documents whose chunks are missing from the local index have to be rebuilt too.
+        known = existing.row_of if existing is not None else {}
+        incomplete = [source for source in unchanged
+                      if any(cid not in known for cid in manifest.files[source]["chunks"])]
+        changed += incomplete
+        unchanged = [source for source in unchanged if source not in incomplete]
+    print(f"{len(changed)} new or changed, {len(removed)} removed, {len(unchanged)} unchanged document(s)"
+          + (" (full rebuild)." if full else "."))
+    if not changed and not removed:
+        print("Knowledge base is up to date.")
+        _ensure_lexical_index()
+        return True
+
+    # STEP 2: OPEN THE WRITERS
+    # The local index is rebuilt into temporary files; ChromaDB writes run on a background
+    # thread so they overlap with embedding. ChromaDB holds exactly the chunks of the last
+    # saved manifest (or nothing after a full reset), which determines what to upsert.
+    previous = {cid for entry in manifest.files.values() for cid in entry["chunks"]}
+    index_writer = IndexWriter(LOCAL_INDEX_DIR, embedding)
+    chroma_writer, chroma_error = None, None
+    if not skip_chroma:
+        try:
+            chroma_writer = _open_chroma_writer(full)
+        except Exception as e:
+            chroma_error = e
+
+    def write_batch(ids: list, texts: list, metadatas: list, vectors):
+        nonlocal chroma_error
+        index_writer.add(ids, texts, metadatas, vectors)
+        if chroma_writer is None or chroma_error is not None:
+            return
+        pending = [i for i, cid in enumerate(ids) if full or cid not in previous]
+        if pending:
+            try:
+                chroma_writer.put(([ids[i] for i in pending], [texts[i] for i in pending],
+                                   [metadatas[i] for i in pending], np.asarray(vectors)[pending]))
+            except Exception as e:
+                chroma_error = e
+
+    files = {source: manifest.files[source] for source in unchanged}
     try:
-        api_key = os.getenv("CHROMA_API_KEY")
-        tenant = os.getenv("CHROMA_TENANT")
-        database = os.getenv("CHROMA_DATABASE")
-
-        # Validate that all required credentials are present.
-        if not all([api_key, tenant, database]):
-            raise ValueError("ChromaDB credentials not found in .env file.")
-
-        # Initialize the ChromaDB Cloud client using credentials from the environment.
-        cloud_client = chromadb.CloudClient(
-            api_key=api_key,
-            tenant=tenant,
-            database=database
-        )
-
-        # To ensure a clean state, attempt to delete the collection if it already exists.
-        # This prevents duplicating data during subsequent runs of the script.
-        print(f"Checking for existing collection '{COLLECTION_NAME}'...")
+        # STEP 3: SPLIT AND EMBED CHANGED DOCUMENTS
+        # Documents are split lazily as the embedder asks for more chunks.
+        surviving = {cid for source in unchanged for cid in files[source]["chunks"]}
+        changed_records = set()
+
+        def split_changed():
+            text_splitter = RecursiveCharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
+            for source in changed:
+                records = split_document(source, text_splitter)
+                files[source] = {"sha256": current_hashes[source], "chunks": [record[0] for record in records]}
+                for record in records:
+                    # Chunks already in the index have identical text and keep their vector.
+                    if existing is not None and record[0] in existing.row_of:
+                        changed_records.add(record[0])
+                    else:
+                        yield record
+
+        new_count = 0
+        meter = ThroughputMeter("Embedded")
+        with EmbeddingPipeline(EMBEDDING_MODEL_NAME) as pipeline:
+            for batch, vectors in pipeline.embed(split_changed()):
+                write_batch([r[0] for r in batch], [r[1] for r in batch], [r[2] for r in batch], vectors)
+                meter.update(len(batch))
+                new_count += len(batch)
+        print(meter.summary())
+
+        # STEP 4: REUSE UNCHANGED CHUNKS
+        # Copy the stored vectors of every chunk that survives, batch by batch, straight from
+        # the memory-mapped previous index.
+        if existing is not None:
+            reused = [existing.row_of[cid] for cid in existing.ids if cid in surviving or cid in changed_records]
+            for start in range(0, len(reused), INDEX_COPY_BATCH_SIZE):
+                rows = reused[start:start + INDEX_COPY_BATCH_SIZE]
+                write_batch([existing.ids[i] for i in rows], [existing.documents[i] for i in rows],
+                            [existing.metadatas[i] for i in rows], existing.matrix[rows])
+            # Release the memory map before the index files are replaced.
+            existing = None
+        stats = pipeline.cache.stats()
+        print(f"{new_count} new chunks processed ({stats['misses']} computed, hit rate {stats['hit_rate']:.0%}).")
+    except BaseException:
+        index_writer.abort()
+        if chroma_writer is not None:
+            chroma_writer.close()
+        raise
+
+    # STEP 5: COMMIT THE LOCAL VECTOR INDEX
+    index_writer.commit()
+    # The BM25 index is derived from the committed chunks, so its rows match the vector index.
+    build_bm25_index(LOCAL_INDEX_DIR)
+    # Cached analyses cite the old knowledge base; bump the stamp so every process drops them.
+    write_kb_version()
+
+    # STEP 6: FINISH SYNCING CHROMADB
+    if not skip_chroma:
+        kept = {cid for entry in files.values() for cid in entry["chunks"]}
         try:
-            cloud_client.delete_collection(name=COLLECTION_NAME)
-            print(f"Deleted existing collection '{COLLECTION_NAME}'.")
-        except Exception:
-            # An exception is expected if the collection does not exist.
-            # This is benign, so we can safely ignore it and proceed.
-            print(f"Collection '{COLLECTION_NAME}' does not exist, creating a new one.")
-        
-        print(f"Creating collection and adding documents to ChromaDB Cloud...")
-        # Create embeddings from the document chunks and store them in the cloud collection.
-        # This is the main ingestion step.
-        vectorstore = Chroma.from_documents(
-            documents=all_splits,
-            embedding=embeddings,
-            client=cloud_client,
-            collection_name=COLLECTION_NAME
-        )
-        print("Documents embedded and stored in ChromaDB Cloud successfully!")
-
-    except Exception as e:
-        print(f"An error occurred while connecting to or updating ChromaDB Cloud: {e}")
-        return
+            if chroma_writer is not None:
+                chroma_writer.close()
+            if chroma_error is not None:
+                raise chroma_error
+            _delete_chroma_chunks(sorted(previous - kept))
+        except Exception as e:
+            # The manifest is left as it was, so the next run retries these changes.
+            print(f"An error occurred while connecting to or updating ChromaDB: {e}")
+            return False
+
+    # STEP 7: SAVE THE MANIFEST
+    manifest.save(settings, files)
+    print(f"\n--- Pipeline Complete ({time.monotonic() - started:.1f}s) ---")
+    print(f"Knowledge base holds {index_writer.count} chunks from {len(current_hashes)} document(s).")
+    return True
 
-    print("\n--- Pipeline Complete ---")
-    print(f"Your knowledge base is now ready in ChromaDB Cloud under the collection: '{COLLECTION_NAME}'")
-    # NOTE: The following line initializes a PersistentClient which is not used.
-    # This may be leftover code from a previous implementation.
-    client = chromadb.PersistentClient(path="D:/cs/Work/RegTok")
+def _snapshot(kb_dir: str) -> dict:
+    """Returns {path: (mtime, size)} for the knowledge base's .txt files, a cheap change detector."""
+    snapshot = {}
+    for root, _, files in os.walk(kb_dir):
+        for name in files:
+            if name.endswith(".txt"):
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                snapshot[path] = (stat.st_mtime_ns, stat.st_size)
+    return snapshot
+
+def watch(skip_chroma: bool = False):
+    """Re-ingests the knowledge base whenever a document is added, edited or removed."""
+    print(f"Watching '{KNOWLEDGE_BASE_DIR}' for changes (Ctrl+C to stop)...")
+    build_vector_store(skip_chroma=skip_chroma)
+    last = _snapshot(KNOWLEDGE_BASE_DIR)
+    try:
+        while True:
+            time.sleep(WATCH_INTERVAL_SECONDS)
+            current = _snapshot(KNOWLEDGE_BASE_DIR)
+            if current == last:
+                continue
+            # Wait for the burst of writes to settle before ingesting.
+            time.sleep(WATCH_SETTLE_SECONDS)
+            while _snapshot(KNOWLEDGE_BASE_DIR) != current:
+                current = _snapshot(KNOWLEDGE_BASE_DIR)
+                time.sleep(WATCH_SETTLE_SECONDS)
+            print("Change detected in the knowledge base.")
+            build_vector_store(skip_chroma=skip_chroma)
+            last = current
+    except KeyboardInterrupt:
+        print("Stopped watching.")
 
 
 # Standard Python entry point.
-# Ensures that the build_vector_store() function is called only when the script is executed directly.
+# Ensures that the pipeline runs only when the script is executed directly.
 if __name__ == "__main__":
-    build_vector_store()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Ingest the knowledge base into the vector stores.")
+    parser.add_argument("--full", action="store_true", help="re-ingest every document and recreate the collection")
+    parser.add_argument("--watch", action="store_true", help="keep running and re-ingest files as they change")
+    parser.add_argument("--skip-chroma", action="store_true", help="only update the local vector index (run with --full once ChromaDB is used again)")
+    args = parser.parse_args()
+    if args.watch:
+        watch(skip_chroma=args.skip_chroma)
+    else:
+        sys.exit(0 if build_vector_store(full=args.full, skip_chroma=args.skip_chroma) else 1)
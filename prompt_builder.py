@@ -0,0 +1,272 @@
+import os
+import time
+import asyncio
+import threading
+import weakref
+
+# --- Configuration ---
+# Version of the prompt templates below. Bump it whenever the prompt wording or the
+# JSON contract changes so that cached analyses from the old prompt are not reused.
+PROMPT_TEMPLATE_VERSION = "2"
+# Input-token budget for a whole prompt (static prefix included). Retrieved texts and
+# few-shot examples that would exceed it are left out, lowest priority first.
+DEFAULT_PROMPT_TOKEN_BUDGET = 8000
+# "implicit" relies on Gemini's automatic caching of the byte-stable system instruction;
+# "explicit" also creates a Gemini context cache holding it and references it by name.
+DEFAULT_CONTEXT_CACHE_MODE = "implicit"
+# Lifetime of an explicit context cache; it is recreated shortly before it expires.
+CONTEXT_CACHE_TTL_SECONDS = 3600
+# Seconds to wait before trying to create an explicit cache again after a failure.
+CONTEXT_CACHE_RETRY_SECONDS = 600
+# "tokenizer" counts tokens with Gemini's own tokenizer, run locally through the
+# google-genai SDK (its model file is downloaded once and cached); "heuristic" assumes
+# about 4 characters per token. The heuristic is also used if the tokenizer cannot load.
+DEFAULT_TOKEN_COUNTER = "tokenizer"
+# Model whose tokenizer is used; it should match compliance_checker.GEMINI_MODEL.
+DEFAULT_TOKENIZER_MODEL = "gemini-2.5-pro"
+
+# The static prefix: identical bytes on every request, so Gemini can reuse it from its
+# context cache. Nothing request-specific (examples, texts, the feature) may go here.
+SYSTEM_INSTRUCTION = """You are an expert compliance officer. Your task is to analyze a product feature and determine if it requires geo-specific logic, based on the provided legal texts.
+
+First, in your thought process, analyze the user's feature and compare it to the examples provided, if any.
+Then, review the "Relevant Legal Texts". Each text is tagged with a "Source Document".
+
+After your thought process, provide your final analysis as a structured JSON. The JSON must have four keys:
+1.  "flag": A single string ("Yes", "No", or "Uncertain").
+2.  "reasoning": A concise explanation for your flag. Your reasoning must mention the law that applies.
+3.  "related_regulations": A list of strings of specific regulation names (e.g., ["GDPR", "COPPA"]).
+4.  "citations": A list of strings containing the exact "Source Document" tags (e.g., ["GDPR Article 8", "Utah S.B. 152 Section 3a"]) you used to arrive at your conclusion. If no source was relevant, provide an empty list [].
+"""
+
+NO_CONTEXT_TEXT = "No specific regulatory documents were found for context."
+
+
+_tokenizer = None
+_tokenizer_ready = False
+_tokenizer_lock = threading.Lock()
+
+
+def load_tokenizer():
+    """
+    Loads the shared local Gemini tokenizer and returns it, or None to use the heuristic.
+
+    Loading can import the SDK and download the tokenizer model, so this blocks: call
+    it off the event loop (compliance_checker.warm_up does). count_tokens never loads
+    the tokenizer itself and uses the heuristic until this has finished.
+    """
+    global _tokenizer, _tokenizer_ready
+    if not _tokenizer_ready:
+        with _tokenizer_lock:
+            if not _tokenizer_ready:
+                if os.getenv("TOKEN_COUNTER", DEFAULT_TOKEN_COUNTER).lower() == "tokenizer":
+                    try:
+                        # Imported here: the SDK is slow to import and the tokenizer needs sentencepiece.
+                        from google.genai.local_tokenizer import LocalTokenizer
+                        _tokenizer = LocalTokenizer(model_name=os.getenv("TOKENIZER_MODEL", DEFAULT_TOKENIZER_MODEL))
+                    except Exception as e:
+                        print(f"Local Gemini tokenizer unavailable, estimating tokens from text length: {e}")
+                        _tokenizer = None
+                _tokenizer_ready = True
+    return _tokenizer
+
+
+def count_tokens(text: str) -> int:
+    """
+    Counts the tokens of a text locally.
+
+    This is the one token counter shared by prompt assembly, few-shot selection and
+    the batch rate limiter. It uses Gemini's tokenizer once load_tokenizer() has
+    loaded it (see TOKEN_COUNTER) and otherwise estimates about 4 characters per
+    token; it never blocks on loading the tokenizer.
+    """
+    tokenizer = _tokenizer if _tokenizer_ready else None
+    if tokenizer is not None and text:
+        try:
+            return tokenizer.count_tokens(text).total_tokens
+        except Exception as e:
+            print(f"Error counting tokens locally: {e}")
+    return len(text) // 4 + 1
+
+
+def format_chunk(document: str, metadata: dict) -> str:
+    """Formats one retrieved chunk, tagged with its source so the LLM can cite it."""
+    return f"Source Document: [{metadata.get('source', 'Unknown Source')}]\nContent: {document}\n---"
+
+
+def format_example(example: dict) -> str:
+    return f"### Example:\nProduct Feature: \"{example['feature']}\"\nCorrect Analysis:\n{example['correct_analysis']}"
+
+
+def _user_prompt(expanded_query: str, chunk_texts: list, example_texts: list) -> str:
+    examples_section = ""
+    if example_texts:
+        examples_section = "Here are some high-quality examples of correct analyses:\n" + "\n".join(example_texts) + "\n---\n"
+    context = "\n".join(chunk_texts) if chunk_texts else NO_CONTEXT_TEXT
+    return f"""{examples_section}
+## Product Feature:
+"{expanded_query}"
+
+## Relevant Legal Texts:
+"{context}"
+
+Provide your analysis in the required JSON format.
+"""
+
+
+class AssembledPrompt:
+    """
+    A prompt split into its static prefix and its request-specific part.
+
+    Attributes:
+        system_instruction (str): The byte-stable prefix (SYSTEM_INSTRUCTION).
+        contents (str): The request-specific user turn.
+        chunks (list): The (document, metadata) tuples that fit the budget, in rank order.
+        examples (list): The few-shot examples that fit the budget, in rank order.
+        token_usage (dict): Local token accounting (see build_prompt).
+    """
+
+    def __init__(self, system_instruction: str, contents: str, chunks: list, examples: list, token_usage: dict):
+        self.system_instruction = system_instruction
+        self.contents = contents
+        self.chunks = chunks
+        self.examples = examples
+        self.token_usage = token_usage
+
+
+def build_prompt(expanded_query: str, chunks: list, examples: list, token_budget: int = None) -> AssembledPrompt:
+    """
+    Assembles the prompt for one analysis within a token budget.
+
+    The static prefix and the feature description are always included. The rest is
+    added by priority until the budget is spent: the best retrieved text, the most
+    similar example, the remaining texts in rank order, then the remaining examples.
+    An item that does not fit is skipped, so a shorter one further down can still fit.
+
+    Args:
+        expanded_query (str): The jargon-expanded feature description.
+        chunks (list): Retrieved (document, metadata) tuples, most relevant first.
+        examples (list): Few-shot example dictionaries, most relevant first.
+        token_budget (int, optional): Defaults to PROMPT_TOKEN_BUDGET.
+
+    Returns:
+        AssembledPrompt: The prompt, with token_usage holding the estimated tokens of
+        the prefix, feature, context and examples, the total, the budget, and how
+        many texts and examples were dropped.
+    """
+    token_budget = token_budget or int(os.getenv("PROMPT_TOKEN_BUDGET", DEFAULT_PROMPT_TOKEN_BUDGET))
+    prefix_tokens = count_tokens(SYSTEM_INSTRUCTION)
+    base_tokens = count_tokens(_user_prompt(expanded_query, [], []))
+    remaining = token_budget - prefix_tokens - base_tokens
+
+    chunk_texts = [format_chunk(doc, meta) for doc, meta in chunks]
+    example_texts = [format_example(example) for example in examples]
+    candidates = [("chunk", 0)] if chunks else []
+    candidates += [("example", 0)] if examples else []
+    candidates += [("chunk", i) for i in range(1, len(chunks))]
+    candidates += [("example", i) for i in range(1, len(examples))]
+
+    kept = {"chunk": set(), "example": set()}
+    used = {"chunk": 0, "example": 0}
+    for kind, i in candidates:
+        cost = count_tokens(chunk_texts[i] if kind == "chunk" else example_texts[i])
+        if cost > remaining:
+            continue
+        kept[kind].add(i)
+        used[kind] += cost
+        remaining -= cost
+
+    chunk_rows = sorted(kept["chunk"])
+    example_rows = sorted(kept["example"])
+    contents = _user_prompt(expanded_query, [chunk_texts[i] for i in chunk_rows], [example_texts[i] for i in example_rows])
+    token_usage = {
+        "prompt_version": PROMPT_TEMPLATE_VERSION,
+        "budget": token_budget,
+        "prefix": prefix_tokens,
+        "feature": base_tokens,
+        "context": used["chunk"],
+        "examples": used["example"],
+        "total": prefix_tokens + count_tokens(contents),
+        "dropped_chunks": len(chunks) - len(chunk_rows),
+        "dropped_examples": len(examples) - len(example_rows),
+    }
+    return AssembledPrompt(
+        SYSTEM_INSTRUCTION, contents, [chunks[i] for i in chunk_rows], [examples[i] for i in example_rows], token_usage
+    )
+
+
+def usage_from_response(response) -> dict:
+    """Extracts Gemini's reported token counts (including cached prefix tokens) from a response."""
+    metadata = getattr(response, "usage_metadata", None)
+    if metadata is None:
+        return {}
+    fields = {
+        "prompt_token_count": "reported_prompt",
+        "cached_content_token_count": "reported_cached",
+        "candidates_token_count": "reported_output",
+        "thoughts_token_count": "reported_thoughts",
+    }
+    return {name: getattr(metadata, field) for field, name in fields.items() if getattr(metadata, field, None) is not None}
+
+
+class ContextCache:
+    """
+    Keeps one explicit Gemini context cache holding the static system instruction.
+
+    Only used when GEMINI_CONTEXT_CACHE=explicit. The cache is created on first use
+    and recreated before its TTL runs out. If creation fails (e.g. the prefix is
+    below the model's minimum cacheable size), callers fall back to sending the
+    system instruction inline, which Gemini can still cache implicitly.
+    """
+
+    def __init__(self, mode: str = None):
+        self.mode = (mode or os.getenv("GEMINI_CONTEXT_CACHE", DEFAULT_CONTEXT_CACHE_MODE)).lower()
+        self._name = None
+        self._expires_at = 0.0
+        self._retry_at = 0.0
+        # The cache is used from several event loops (the API's, run_sync's, each
+        # asyncio.run of a batch), and an asyncio.Lock is bound to one loop, so each
+        # loop gets its own creation lock.
+        self._locks = weakref.WeakKeyDictionary()
+        self._locks_guard = threading.Lock()
+
+    def _loop_lock(self) -> asyncio.Lock:
+        loop = asyncio.get_running_loop()
+        with self._locks_guard:
+            lock = self._locks.get(loop)
+            if lock is None:
+                lock = self._locks[loop] = asyncio.Lock()
+            return lock
+
+    async def get_name(self, client, model: str):
+        """Returns the name of a live context cache for the prefix, or None to send it inline."""
+        if self.mode != "explicit":
+            return None
+        now = time.monotonic()
+        if self._name and now < self._expires_at:
+            return self._name
+        if now < self._retry_at:
+            return None
+        async with self._loop_lock():
+            if self._name and time.monotonic() < self._expires_at:
+                return self._name
+            from google.genai import types
+            try:
+                cache = await client.aio.caches.create(
+                    model=model,
+                    config=types.CreateCachedContentConfig(
+                        display_name=f"regtok-prompt-v{PROMPT_TEMPLATE_VERSION}",
+                        system_instruction=SYSTEM_INSTRUCTION,
+                        ttl=f"{CONTEXT_CACHE_TTL_SECONDS}s",
+                    )
+                )
+            except Exception as e:
+                print(f"Could not create Gemini context cache, sending the prompt prefix inline: {e}")
+                self._name = None
+                self._retry_at = time.monotonic() + CONTEXT_CACHE_RETRY_SECONDS
+                return None
+            self._name = cache.name
+            # Renew a minute early so requests never reference an expired cache.
+            self._expires_at = time.monotonic() + CONTEXT_CACHE_TTL_SECONDS - 60
+            print(f"Created Gemini context cache '{cache.name}' for prompt version {PROMPT_TEMPLATE_VERSION}.")
+            return self._name
@@ -0,0 +1,147 @@
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+
+from response_cache import chunk_id
+
+# --- Configuration ---
+# Small CPU cross-encoder that scores (query, chunk) pairs jointly.
+DEFAULT_RERANKER_MODEL = "cross-encoder/ms-marco-MiniLM-L-6-v2"
+# Candidates fetched from retrieval for the reranker to choose from.
+DEFAULT_RERANK_CANDIDATES = 12
+# Time (in milliseconds) a request may spend reranking before the retrieval order is used.
+DEFAULT_RERANK_BUDGET_MS = 250
+# Maximum number of (query, chunk) scores kept; the least recently used is evicted first.
+DEFAULT_SCORE_CACHE_SIZE = 20000
+# Longest input (query plus chunk, in tokens) the cross-encoder reads.
+MAX_PAIR_LENGTH = 512
+
+
+def query_hash(query: str) -> str:
+    """Returns the key under which a query's scores are cached."""
+    return hashlib.sha1(query.strip().lower().encode("utf-8")).hexdigest()
+
+
+class CrossEncoderReranker:
+    """
+    Reorders retrieved chunks by a cross-encoder's relevance score.
+
+    All uncached (query, chunk) pairs of a request are scored in one batched
+    forward pass, and every score is kept in an LRU cache keyed on (query hash,
+    chunk ID), so a repeated query is reranked without touching the model. The
+    model is loaded lazily on first use.
+    """
+
+    def __init__(self, model_name: str = None, cache_size: int = None):
+        self.model_name = model_name or os.getenv("RERANKER_MODEL", DEFAULT_RERANKER_MODEL)
+        self.cache_size = cache_size or int(os.getenv("RERANK_CACHE_SIZE", DEFAULT_SCORE_CACHE_SIZE))
+        self._model = None
+        self._model_lock = threading.Lock()
+        self._scores = OrderedDict()  # (query hash, chunk id) -> score
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._timeouts = 0
+        self._skips = 0
+
+    def _get_model(self):
+        if self._model is None:
+            with self._model_lock:
+                if self._model is None:
+                    # Imported here so the reranker costs nothing when it is disabled.
+                    from sentence_transformers import CrossEncoder
+                    self._model = CrossEncoder(self.model_name, max_length=MAX_PAIR_LENGTH, device="cpu")
+        return self._model
+
+    def warm_up(self):
+        """Loads the model and runs one pair through it."""
+        self._get_model().predict([("warm-up", "warm-up")])
+
+    def scores(self, query: str, documents: list) -> np.ndarray:
+        """
+        Returns the relevance score of each document for the query.
+
+        Cached scores are reused; the rest are computed in a single batch and cached.
+        """
+        qhash = query_hash(query)
+        keys = [(qhash, chunk_id(doc)) for doc in documents]
+        scores = np.empty(len(documents), dtype=np.float32)
+        missing = []
+        with self._lock:
+            for i, key in enumerate(keys):
+                score = self._scores.get(key)
+                if score is None:
+                    missing.append(i)
+                else:
+                    self._scores.move_to_end(key)
+                    scores[i] = score
+            self._hits += len(documents) - len(missing)
+            self._misses += len(missing)
+        if missing:
+            computed = self._get_model().predict(
+                [(query, documents[i]) for i in missing], batch_size=len(missing), convert_to_numpy=True
+            )
+            with self._lock:
+                for i, score in zip(missing, computed):
+                    scores[i] = float(score)
+                    self._scores[keys[i]] = float(score)
+                while len(self._scores) > self.cache_size:
+                    self._scores.popitem(last=False)
+        return scores
+
+    def rerank(self, query: str, chunks: list, k: int) -> list:
+        """
+        Returns the k most relevant of the retrieved chunks.
+
+        Args:
+            query (str): The (expanded) feature description.
+            chunks (list): (document, metadata) tuples in retrieval order.
+            k (int): Number of chunks to keep.
+
+        Returns:
+            list: Up to k (document, metadata) tuples, most relevant first.
+        """
+        if len(chunks) <= 1:
+            return chunks[:k]
+        scores = self.scores(query, [doc for doc, _ in chunks])
+        # A stable sort keeps the retrieval order among equally scored chunks.
+        order = np.argsort(-scores, kind="stable")[:k]
+        return [chunks[i] for i in order]
+
+    def record_timeout(self):
+        with self._lock:
+            self._timeouts += 1
+
+    def record_skip(self):
+        """Counts a request that skipped reranking because every rerank worker was busy."""
+        with self._lock:
+            self._skips += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self._hits + self._misses
+            return {
+                "model": self.model_name,
+                "cached_scores": len(self._scores),
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": self._hits / total if total else 0.0,
+                "budget_timeouts": self._timeouts,
+                "saturated_skips": self._skips,
+            }
+
+
+# --- Process-wide reranker ---
+_reranker = None
+_reranker_lock = threading.Lock()
+
+
+def get_reranker() -> CrossEncoderReranker:
+    """Returns the process-wide CrossEncoderReranker, creating it on first use."""
+    global _reranker
+    with _reranker_lock:
+        if _reranker is None:
+            _reranker = CrossEncoderReranker()
+        return _reranker
@@ -0,0 +1,197 @@
+import os
+import copy
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+
+# --- Configuration ---
+# How long (in seconds) a cached analysis stays valid.
+DEFAULT_TTL_SECONDS = 24 * 60 * 60
+# Maximum number of analyses kept; the least recently used entry is evicted first.
+DEFAULT_MAX_ENTRIES = 1024
+# Stamp file rewritten by prepare_knowledge_base on every rebuild. Any change to it
+# invalidates the whole cache, since cached answers cite the old knowledge base.
+KB_VERSION_FILE = "kb_version.txt"
+
+
+def _stable_hash(value) -> str:
+    return hashlib.sha256(json.dumps(value, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+def chunk_id(document: str) -> str:
+    """Returns a content-derived identifier for a retrieved chunk."""
+    return hashlib.sha1(document.encode("utf-8")).hexdigest()
+
+
+def write_kb_version(path: str = KB_VERSION_FILE):
+    """Marks the knowledge base as rebuilt, invalidating response caches in every process."""
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(f"{time.time():.6f}\n")
+
+
+class ResponseCache:
+    """
+    A TTL- and size-bounded cache of complete compliance analyses.
+
+    The exact tier is keyed on everything that determines the LLM's answer: the
+    expanded query, the retrieved chunk IDs, the few-shot example set and the prompt
+    template version. The optional semantic tier returns a cached analysis when a new
+    query's embedding is at least `semantic_threshold` cosine-similar to a cached one.
+
+    The cache is cleared when the knowledge-base stamp file changes, when a lookup
+    sees a new feedback generation (see database_utils.feedback_generation, which
+    covers corrections recorded by other processes) and whenever invalidate() is
+    called (e.g. after a human correction is recorded in this process).
+    """
+
+    def __init__(self, ttl_seconds: float = None, max_entries: int = None, semantic_threshold: float = None):
+        self.ttl_seconds = ttl_seconds or float(os.getenv("RESPONSE_CACHE_TTL_SECONDS", DEFAULT_TTL_SECONDS))
+        self.max_entries = max_entries or int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", DEFAULT_MAX_ENTRIES))
+        threshold = os.getenv("SEMANTIC_CACHE_THRESHOLD") if semantic_threshold is None else semantic_threshold
+        # The semantic tier is disabled unless a threshold is configured.
+        self.semantic_threshold = float(threshold) if threshold not in (None, "") else None
+        self.kb_version_file = os.getenv("KB_VERSION_FILE", KB_VERSION_FILE)
+        self._entries = OrderedDict()  # key -> (expires_at, result, normalized embedding or None)
+        self._lock = threading.Lock()
+        self._kb_stamp = self._current_kb_stamp()
+        self._feedback_generation = None
+        self._exact_hits = 0
+        self._semantic_hits = 0
+        self._misses = 0
+
+    @property
+    def semantic_enabled(self) -> bool:
+        return self.semantic_threshold is not None
+
+    def _current_kb_stamp(self):
+        try:
+            return os.stat(self.kb_version_file).st_mtime_ns
+        except OSError:
+            return None
+
+    def _check_kb_version(self):
+        stamp = self._current_kb_stamp()
+        if stamp != self._kb_stamp:
+            if self._entries:
+                print("Knowledge base was rebuilt; clearing the response cache.")
+            self._entries.clear()
+            self._kb_stamp = stamp
+
+    def _check_feedback_generation(self, generation):
+        if generation is not None and generation != self._feedback_generation:
+            if self._entries and self._feedback_generation is not None:
+                print("Feedback was recorded; clearing the response cache.")
+            self._entries.clear()
+            self._feedback_generation = generation
+
+    @staticmethod
+    def make_key(expanded_query: str, chunk_ids: list, examples: list, template_version: str,
+                 feedback_generation: int = None) -> str:
+        """Builds the exact-match key for an analysis request."""
+        return _stable_hash({
+            "query": " ".join(expanded_query.split()),
+            "chunks": list(chunk_ids),
+            "examples": _stable_hash(examples),
+            "template": template_version,
+            "feedback": feedback_generation,
+        })
+
+    def get(self, key: str, query_embedding=None, feedback_generation: int = None) -> tuple:
+        """
+        Looks an analysis up, first by exact key and then (if enabled) semantically.
+
+        Args:
+            key (str): The key built by make_key.
+            query_embedding (optional): Embedding of the expanded query, for the semantic tier.
+            feedback_generation (int, optional): The current feedback generation; a new
+                value clears every analysis cached under an older one.
+
+        Returns:
+            tuple: (result, hit_kind) where hit_kind is "exact" or "semantic", or
+                   (None, None) on a miss. The result is a copy safe to mutate.
+        """
+        now = time.time()
+        with self._lock:
+            self._check_kb_version()
+            self._check_feedback_generation(feedback_generation)
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._entries.move_to_end(key)
+                    self._exact_hits += 1
+                    return copy.deepcopy(entry[1]), "exact"
+                del self._entries[key]
+
+            if self.semantic_enabled and query_embedding is not None and self._entries:
+                query = np.asarray(query_embedding, dtype=np.float32).reshape(-1)
+                norm = np.linalg.norm(query)
+                candidates = [(k, e) for k, e in self._entries.items() if e[2] is not None and e[0] > now]
+                if norm and candidates:
+                    matrix = np.vstack([e[2] for _, e in candidates])
+                    scores = matrix @ (query / norm)
+                    best = int(np.argmax(scores))
+                    if scores[best] >= self.semantic_threshold:
+                        best_key, best_entry = candidates[best]
+                        self._entries.move_to_end(best_key)
+                        self._semantic_hits += 1
+                        return copy.deepcopy(best_entry[1]), "semantic"
+
+            self._misses += 1
+            return None, None
+
+    def put(self, key: str, result: dict, query_embedding=None, feedback_generation: int = None):
+        """
+        Stores an analysis, evicting the least recently used entries beyond max_entries.
+
+        An analysis made under a feedback generation other than the one the cache last
+        saw (i.e. feedback landed while it was running) is not stored.
+        """
+        embedding = None
+        if query_embedding is not None:
+            embedding = np.asarray(query_embedding, dtype=np.float32).reshape(-1)
+            norm = np.linalg.norm(embedding)
+            embedding = embedding / norm if norm else None
+        with self._lock:
+            self._check_kb_version()
+            if self._feedback_generation is None:
+                self._check_feedback_generation(feedback_generation)
+            elif feedback_generation is not None and feedback_generation != self._feedback_generation:
+                return
+            self._entries[key] = (time.time() + self.ttl_seconds, copy.deepcopy(result), embedding)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, *args, **kwargs):
+        """Drops every cached analysis. Accepts and ignores listener arguments."""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self._exact_hits + self._semantic_hits + self._misses
+            return {
+                "entries": len(self._entries),
+                "exact_hits": self._exact_hits,
+                "semantic_hits": self._semantic_hits,
+                "misses": self._misses,
+                "hit_rate": (self._exact_hits + self._semantic_hits) / total if total else 0.0,
+                "semantic_threshold": self.semantic_threshold,
+            }
+
+
+# --- Process-wide cache ---
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_response_cache() -> ResponseCache:
+    """Returns the process-wide ResponseCache, creating it on first use."""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ResponseCache()
+        return _cache
@@ -0,0 +1,86 @@
+import re
+import copy
+import uuid
+import asyncio
+import hashlib
+import threading
+
+
+def normalize_query(query: str) -> str:
+    """Lowercases a query and collapses whitespace, so trivially different copies coalesce."""
+    return re.sub(r"\s+", " ", query).strip().lower()
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent identical analyses into one shared run.
+
+    The first caller for a key starts the run; callers arriving while it is in
+    flight await the same task instead of starting their own. Every caller gets
+    its own deep copy of the result, tagged with the shared run's ID, so callers
+    can annotate and store it independently. Nothing is kept once the run ends;
+    this is not a cache.
+
+    The shared run is shielded from cancellation, so one caller disconnecting
+    does not abort the analysis for the others.
+    """
+
+    def __init__(self):
+        self._in_flight = {}  # (event loop id, key) -> (task, run id)
+        self._lock = threading.Lock()
+        self._runs = 0
+        self._coalesced = 0
+
+    async def do(self, query: str, analyze) -> dict:
+        """
+        Runs `analyze()` for a query, or joins the run already in flight for it.
+
+        Args:
+            query (str): The expanded query; it is normalized to form the key.
+            analyze: A zero-argument callable returning the analysis coroutine.
+
+        Returns:
+            dict: A copy of the analysis with "run_id" (shared by every caller of the
+                  run) and "coalesced" (False for the caller that started it).
+        """
+        key = (id(asyncio.get_running_loop()), hashlib.sha256(normalize_query(query).encode("utf-8")).hexdigest())
+        with self._lock:
+            entry = self._in_flight.get(key)
+            leader = entry is None
+            if leader:
+                run_id = uuid.uuid4().hex
+                task = asyncio.ensure_future(analyze())
+                self._in_flight[key] = (task, run_id)
+                task.add_done_callback(lambda _: self._finish(key))
+                self._runs += 1
+            else:
+                task, run_id = entry
+                self._coalesced += 1
+        if not leader:
+            print(f"Joined in-flight analysis {run_id} for an identical request.")
+        result = copy.deepcopy(await asyncio.shield(task))
+        result['run_id'] = run_id
+        result['coalesced'] = not leader
+        return result
+
+    def _finish(self, key):
+        with self._lock:
+            self._in_flight.pop(key, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"in_flight": len(self._in_flight), "runs": self._runs, "coalesced": self._coalesced}
+
+
+# --- Process-wide instance ---
+_single_flight = None
+_single_flight_lock = threading.Lock()
+
+
+def get_single_flight() -> SingleFlight:
+    """Returns the process-wide SingleFlight, creating it on first use."""
+    global _single_flight
+    with _single_flight_lock:
+        if _single_flight is None:
+            _single_flight = SingleFlight()
+        return _single_flight
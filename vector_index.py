@@ -0,0 +1,238 @@
+import os
+import json
+import threading
+import numpy as np
+
+# --- Configuration ---
+# Directory holding the embedded, in-process vector index written at ingest time.
+DEFAULT_INDEX_DIR = "vector_index"
+# File layout inside the index directory.
+EMBEDDINGS_FILE = "embeddings.f32"  # Row-major float32 matrix, one L2-normalized row per chunk.
+CHUNKS_FILE = "chunks.jsonl"        # One {"id", "document", "metadata"} record per line, same order.
+META_FILE = "meta.json"             # {"dim", "count", "model"}; written last, marks the index complete.
+# "model" is the embedding cache namespace: the model name, plus "@<backend>" for non-torch backends.
+
+
+def _normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def metadata_mask(metadatas: list, key: str, condition) -> np.ndarray:
+    """
+    Evaluates one Chroma-style metadata condition against every chunk.
+
+    Args:
+        metadatas (list): Metadata dictionaries, one per chunk.
+        key (str): Metadata key to test.
+        condition: A plain value (equality) or {"$eq"|"$ne"|"$in"|"$nin": value}.
+
+    Returns:
+        np.ndarray: Boolean mask with one entry per chunk.
+    """
+    if isinstance(condition, dict):
+        (operator, value), = condition.items()
+    else:
+        operator, value = "$eq", condition
+    values = value if isinstance(value, (list, tuple, set)) else [value]
+    matches = np.array([m.get(key) in values for m in metadatas], dtype=bool)
+    if operator in ("$eq", "$in"):
+        return matches
+    if operator in ("$ne", "$nin"):
+        return ~matches
+    raise ValueError(f"Unsupported filter operator '{operator}'.")
+
+
+class IndexWriter:
+    """
+    Streams chunk embeddings and their documents/metadata into an on-disk index.
+
+    Rows can be appended in any number of batches, so an index of any size is
+    written with memory bounded by the batch size. Embeddings are L2-normalized so
+    that a plain dot product at query time is the cosine similarity. Files are
+    written to temporary names and only swapped in by commit(), so a running
+    process never sees a half-written index.
+    """
+
+    def __init__(self, index_dir: str, model_name: str):
+        os.makedirs(index_dir, exist_ok=True)
+        self.index_dir = index_dir
+        self.model_name = model_name
+        self.count = 0
+        self.dim = None
+        self._paths = [os.path.join(index_dir, name) for name in (EMBEDDINGS_FILE, CHUNKS_FILE, META_FILE)]
+        self._embeddings = open(self._paths[0] + ".tmp", "wb")
+        self._chunks = open(self._paths[1] + ".tmp", "w", encoding="utf-8")
+
+    def add(self, ids: list, documents: list, metadatas: list, embeddings):
+        """Appends a batch of chunks; all arguments are aligned with `ids`."""
+        if not len(ids):
+            return
+        matrix = np.ascontiguousarray(_normalize_rows(np.asarray(embeddings, dtype=np.float32)), dtype=np.float32)
+        if matrix.ndim != 2 or matrix.shape[0] != len(ids) or (self.dim is not None and matrix.shape[1] != self.dim):
+            raise ValueError("Embeddings must be a 2-D array with one row per chunk and a consistent dimension.")
+        self.dim = int(matrix.shape[1])
+        matrix.tofile(self._embeddings)
+        for chunk_id, document, metadata in zip(ids, documents, metadatas):
+            self._chunks.write(json.dumps({"id": chunk_id, "document": document, "metadata": metadata or {}}) + "\n")
+        self.count += len(ids)
+
+    def commit(self):
+        """Finishes the index and atomically replaces the previous one."""
+        self._embeddings.close()
+        self._chunks.close()
+        embeddings_path, chunks_path, meta_path = self._paths
+        with open(meta_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({"dim": self.dim or 0, "count": self.count, "model": self.model_name}, f)
+        os.replace(embeddings_path + ".tmp", embeddings_path)
+        os.replace(chunks_path + ".tmp", chunks_path)
+        os.replace(meta_path + ".tmp", meta_path)
+        print(f"Wrote local vector index with {self.count} chunks to '{self.index_dir}'.")
+
+    def abort(self):
+        """Discards everything written so far, leaving the previous index in place."""
+        self._embeddings.close()
+        self._chunks.close()
+        for path in self._paths[:2]:
+            try:
+                os.remove(path + ".tmp")
+            except OSError:
+                pass
+
+
+def write_index(index_dir: str, ids: list, documents: list, metadatas: list, embeddings, model_name: str):
+    """
+    Writes chunk embeddings and their documents/metadata to an on-disk index in one go.
+
+    Args:
+        index_dir (str): Target directory; created if missing.
+        ids (list): Chunk identifiers.
+        documents (list): Chunk texts, aligned with ids.
+        metadatas (list): Chunk metadata dictionaries, aligned with ids.
+        embeddings: A sequence of vectors (or 2-D array), aligned with ids.
+        model_name (str): Name of the embedding model, recorded for sanity checks.
+    """
+    writer = IndexWriter(index_dir, model_name)
+    try:
+        writer.add(ids, documents, metadatas, embeddings)
+    except Exception:
+        writer.abort()
+        raise
+    writer.commit()
+
+
+class LocalVectorIndex:
+    """
+    An embedded, read-only vector index answering cosine top-k queries in-process.
+
+    The embedding matrix is memory-mapped from disk, so loading is instant and the
+    pages are shared between worker processes on the same host. Queries are a single
+    matrix-vector product followed by a partial sort.
+    """
+
+    def __init__(self, index_dir: str = DEFAULT_INDEX_DIR):
+        self.index_dir = index_dir
+        with open(os.path.join(index_dir, META_FILE), encoding="utf-8") as f:
+            meta = json.load(f)
+        self.dim = meta["dim"]
+        self.count = meta["count"]
+        self.model_name = meta.get("model")
+
+        self.ids, self.documents, self.metadatas = [], [], []
+        with open(os.path.join(index_dir, CHUNKS_FILE), encoding="utf-8") as f:
+            for line in f:
+                record = json.loads(line)
+                self.ids.append(record["id"])
+                self.documents.append(record["document"])
+                self.metadatas.append(record["metadata"])
+        if len(self.ids) != self.count:
+            raise ValueError(f"Index at '{index_dir}' is inconsistent: {len(self.ids)} chunks, {self.count} vectors.")
+
+        if self.count:
+            self.matrix = np.memmap(
+                os.path.join(index_dir, EMBEDDINGS_FILE), dtype=np.float32, mode="r", shape=(self.count, self.dim)
+            )
+        else:
+            self.matrix = np.zeros((0, self.dim), dtype=np.float32)
+
+        # Encode the 'source' metadata as integer codes so source filters are vectorized.
+        source_names = sorted({str(m.get("source")) for m in self.metadatas})
+        self._source_code_map = {name: code for code, name in enumerate(source_names)}
+        self._source_codes = np.array(
+            [self._source_code_map[str(m.get("source"))] for m in self.metadatas], dtype=np.int32
+        )
+
+    def _source_mask(self, condition) -> np.ndarray:
+        if isinstance(condition, dict):
+            (operator, value), = condition.items()
+        else:
+            operator, value = "$eq", condition
+        values = value if isinstance(value, (list, tuple, set)) else [value]
+        codes = [self._source_code_map[str(v)] for v in values if str(v) in self._source_code_map]
+        mask = np.isin(self._source_codes, codes)
+        if operator in ("$eq", "$in"):
+            return mask
+        if operator in ("$ne", "$nin"):
+            return ~mask
+        raise ValueError(f"Unsupported filter operator '{operator}'.")
+
+    def query(self, query_embedding, n_results: int = 3, where: dict = None) -> list:
+        """
+        Returns the n_results chunks most similar to the query embedding.
+
+        Args:
+            query_embedding: The query vector (any length-`dim` sequence).
+            n_results (int): Number of chunks to return.
+            where (dict, optional): Chroma-style metadata filter, e.g. {"source": "x"} or
+                {"source": {"$in": ["x", "y"]}}. Supports $eq, $ne, $in and $nin.
+
+        Returns:
+            list: (document, metadata) tuples ordered by descending cosine similarity.
+        """
+        if not self.count or n_results <= 0:
+            return []
+        query = np.asarray(query_embedding, dtype=np.float32).reshape(-1)
+        norm = np.linalg.norm(query)
+        if norm == 0:
+            return []
+        scores = self.matrix @ (query / norm)
+
+        if where:
+            mask = np.ones(self.count, dtype=bool)
+            for key, condition in where.items():
+                mask &= self._source_mask(condition) if key == "source" else metadata_mask(self.metadatas, key, condition)
+            scores = np.where(mask, scores, -np.inf)
+            available = int(mask.sum())
+        else:
+            available = self.count
+
+        k = min(n_results, available)
+        if k == 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(self.documents[i], self.metadatas[i]) for i in top]
+
+
+# --- Process-wide index ---
+_index = None
+_index_stamp = None
+_index_lock = threading.Lock()
+
+
+def get_local_index(index_dir: str = None) -> LocalVectorIndex:
+    """
+    Returns the process-wide LocalVectorIndex, reloading it if the index was rebuilt.
+
+    Raises:
+        FileNotFoundError: If no index has been written to the directory yet.
+    """
+    global _index, _index_stamp
+    index_dir = index_dir or os.getenv("LOCAL_INDEX_DIR", DEFAULT_INDEX_DIR)
+    stamp = (index_dir, os.stat(os.path.join(index_dir, META_FILE)).st_mtime_ns)
+    with _index_lock:
+        if _index is None or _index_stamp != stamp:
+            _index = LocalVectorIndex(index_dir)
+            _index_stamp = stamp
+        return _index